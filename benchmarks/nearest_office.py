@@ -0,0 +1,147 @@
+"""Check-in latency of `repository.get_closest_office` with many offices per owner.
+
+Compares the query without LIMIT, the KNN query, and the in-memory geofence grid used
+before falling back to PostGIS. Runs against the database configured with the usual DB_*
+variables, with the migrations applied. Everything happens in one transaction that is rolled back at the end.
+
+    python -m benchmarks.nearest_office --offices 10000 --queries 500
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from dataclasses import dataclass
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from openpvz import db
+from openpvz import repository
+from openpvz.geofence import GeofenceGrid
+from openpvz.models import Office
+from openpvz.utils import Location
+
+
+# offices are spread over roughly 50x50 km around this point
+CENTER = Location(latitude=55.75, longitude=37.62)
+SPREAD = 0.25  # degrees
+
+
+async def _legacy_closest_office(location: Location, owner_id: int, session: AsyncSession) -> Office | None:
+    """The query before the spatial index and LIMIT: every match is loaded, the first one kept."""
+    point = func.ST_Point(location.longitude, location.latitude)
+    offices = await session.execute(
+        select(Office)
+        .where(func.ST_DWithin(Office.location, point, 100))
+        .where(Office.owner_id == owner_id)
+        .order_by(func.ST_Distance(Office.location, point)))
+    all_offices = list(offices.scalars().all())
+    return all_offices[0] if len(all_offices) > 0 else None
+
+
+async def _create_offices(session: AsyncSession, offices: int, owners: int) -> int:
+    """Creates the owners, spreads `offices` offices between them and returns the first owner's id."""
+    owner_ids = []
+    for n in range(owners):
+        result = await session.execute(
+            text("INSERT INTO users (chat_id, name, role) VALUES (:chat_id, :name, 'OWNER') RETURNING id"),
+            {"chat_id": -10_000_000_000 - n, "name": f"benchmark owner {n}"}
+        )
+        owner_ids.append(result.scalar_one())
+    await session.execute(
+        text(
+            "INSERT INTO offices (name, location, owner_id, timezone) "
+            "SELECT 'benchmark ' || i, "
+            "    ST_Point(:lon + (random() - 0.5) * :spread, :lat + (random() - 0.5) * :spread), "
+            "    (:owner_ids)[1 + i % cardinality(:owner_ids)], 'Europe/Moscow' "
+            "FROM generate_series(1, :offices) i"
+        ),
+        {
+            "lat": CENTER.latitude, "lon": CENTER.longitude, "spread": SPREAD,
+            "owner_ids": owner_ids, "offices": offices
+        }
+    )
+    await session.execute(text("ANALYZE offices"))
+    return owner_ids[0]
+
+
+async def _check_in_points(session: AsyncSession, owner_id: int, queries: int) -> list[Location]:
+    """Half of the points next to an office of the owner, half anywhere."""
+    result = await session.execute(
+        select(func.ST_X(func.geometry(Office.location)), func.ST_Y(func.geometry(Office.location)))
+        .where(Office.owner_id == owner_id)
+        .order_by(func.random())
+        .limit(queries // 2))
+    points = [
+        Location(latitude=y + random.uniform(-0.0003, 0.0003), longitude=x + random.uniform(-0.0003, 0.0003))
+        for x, y in result.tuples()
+    ]
+    while len(points) < queries:
+        points.append(Location(
+            latitude=CENTER.latitude + random.uniform(-SPREAD, SPREAD) / 2,
+            longitude=CENTER.longitude + random.uniform(-SPREAD, SPREAD) / 2,
+        ))
+    random.shuffle(points)
+    return points
+
+
+@dataclass
+class _Place:
+    id: int
+    location: Location
+    geofence_radius: int
+
+
+async def _geofence_lookup(session: AsyncSession, owner_id: int):
+    """A lookup in the in-memory geofence grid, built the way the office cache builds it."""
+    point = func.geometry(Office.location)
+    result = await session.execute(
+        select(Office.id, func.ST_X(point), func.ST_Y(point), Office.geofence_radius)
+        .where(Office.owner_id == owner_id))
+    grid = GeofenceGrid(
+        _Place(id, Location(latitude=y, longitude=x), radius) for id, x, y, radius in result.tuples())
+
+    async def lookup(location: Location, owner_id: int, session: AsyncSession) -> _Place | None:
+        return grid.nearest(location)
+    return lookup
+
+
+async def _measure(name: str, query, points: list[Location], owner_id: int, session: AsyncSession) -> None:
+    timings = []
+    found = 0
+    for point in points:
+        started = time.perf_counter()
+        office = await query(point, owner_id, session)
+        timings.append((time.perf_counter() - started) * 1000)
+        found += office is not None
+        session.expunge_all()
+    timings.sort()
+    print(
+        f"{name:>8}: median {statistics.median(timings):.2f}ms, "
+        f"p95 {timings[int(len(timings) * 0.95) - 1]:.2f}ms, max {timings[-1]:.2f}ms, "
+        f"{found}/{len(points)} check-ins matched an office"
+    )
+
+
+async def main(offices: int, owners: int, queries: int) -> None:
+    async with db.SessionMaker() as session:
+        try:
+            owner_id = await _create_offices(session, offices, owners)
+            points = await _check_in_points(session, owner_id, queries)
+            print(f"{offices} offices, {owners} owners, {queries} check-ins of one owner")
+            # warm up the connection and the caches
+            await _measure("warm-up", repository.get_closest_office, points[:20], owner_id, session)
+            await _measure("legacy", _legacy_closest_office, points, owner_id, session)
+            await _measure("knn", repository.get_closest_office, points, owner_id, session)
+            await _measure("geofence", await _geofence_lookup(session, owner_id), points, owner_id, session)
+        finally:
+            await session.rollback()
+    await db.get_engine().dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--offices', type=int, default=10_000)
+    parser.add_argument('--owners', type=int, default=1)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.offices, args.owners, args.queries))
@@ -0,0 +1,61 @@
+"""Latency of finding the timezone of a new office.
+
+Compares the offline lookup in the boundaries bundled with timezonefinder with the HTTP API
+used without it. The HTTP API is only called with --http, which needs network access.
+
+    python -m benchmarks.timezone_lookup --points 10000 --http 20
+"""
+import argparse
+import random
+import statistics
+import time
+from openpvz import tz_service
+
+
+# points over the inhabited latitudes, where offices are
+MIN_LATITUDE, MAX_LATITUDE = -55, 70
+
+
+def _points(count: int) -> list[tuple[float, float]]:
+    return [(random.uniform(-180, 180), random.uniform(MIN_LATITUDE, MAX_LATITUDE)) for _ in range(count)]
+
+
+def _measure(name: str, lookup, points: list[tuple[float, float]]) -> None:
+    timings = []
+    found = 0
+    for longitude, latitude in points:
+        started = time.perf_counter()
+        timezone = lookup(longitude, latitude)
+        timings.append((time.perf_counter() - started) * 1000)
+        found += timezone is not None
+    timings.sort()
+    print(
+        f"{name:>8}: median {statistics.median(timings):.3f}ms, "
+        f"p99 {timings[min(int(len(timings) * 0.99), len(timings) - 1)]:.3f}ms, max {timings[-1]:.3f}ms, "
+        f"{found}/{len(points)} points resolved"
+    )
+
+
+def main(points: int, http: int) -> None:
+    if tz_service.TimezoneFinder is None:
+        print("timezonefinder is not installed, skipping the offline lookup")
+    else:
+        started = time.perf_counter()
+        tz_service.lookup_timezone(37.62, 55.75)
+        print(f"loaded the boundaries in {(time.perf_counter() - started) * 1000:.0f}ms")
+        _measure("offline", tz_service.lookup_timezone, _points(points))
+    if http > 0:
+        sample = _points(http)
+        _measure("http", tz_service.fetch_timezone, sample)
+        if tz_service.TimezoneFinder is not None:
+            agree = sum(
+                tz_service.lookup_timezone(*point) == tz_service.fetch_timezone(*point) for point in sample)
+            print(f"{agree}/{len(sample)} points got the same timezone from both")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=10_000)
+    parser.add_argument('--http', type=int, default=0, help="points to look up with the HTTP API")
+    args = parser.parse_args()
+    main(args.points, args.http)
@@ -0,0 +1,60 @@
+-- row-per-key telegram bot persistence
+-- depends: openpvz_20230824_01_ukarJ
+
+CREATE TABLE telegram_bot_user_data (
+    user_id BIGINT NOT NULL,
+    data json NOT NULL,
+    PRIMARY KEY (user_id)
+);
+
+CREATE TABLE telegram_bot_chat_data (
+    chat_id BIGINT NOT NULL,
+    data json NOT NULL,
+    PRIMARY KEY (chat_id)
+);
+
+CREATE TABLE telegram_bot_conversations (
+    name VARCHAR NOT NULL,
+    key VARCHAR NOT NULL,
+    state json NOT NULL,
+    PRIMARY KEY (name, key)
+);
+
+-- bot_data and callback_data, one row each
+CREATE TABLE telegram_bot_data (
+    name VARCHAR NOT NULL,
+    data json NOT NULL,
+    PRIMARY KEY (name)
+);
+
+-- move data out of the legacy single-row blob, where every part is a serialized json string
+INSERT INTO telegram_bot_user_data (user_id, data)
+SELECT u.key::bigint, u.value
+FROM (SELECT NULLIF(data->>'user_data', '')::json AS blob FROM telegram_bot_persistence) p,
+    json_each(CASE WHEN json_typeof(p.blob) = 'object' THEN p.blob END) u
+WHERE json_typeof(u.value) = 'object';
+
+INSERT INTO telegram_bot_chat_data (chat_id, data)
+SELECT c.key::bigint, c.value
+FROM (SELECT NULLIF(data->>'chat_data', '')::json AS blob FROM telegram_bot_persistence) p,
+    json_each(CASE WHEN json_typeof(p.blob) = 'object' THEN p.blob END) c
+WHERE json_typeof(c.value) = 'object';
+
+INSERT INTO telegram_bot_conversations (name, key, state)
+SELECT h.key, s.key, s.value
+FROM (SELECT NULLIF(data->>'conversations', '')::json AS blob FROM telegram_bot_persistence) p,
+    json_each(CASE WHEN json_typeof(p.blob) = 'object' THEN p.blob END) h,
+    json_each(CASE WHEN json_typeof(h.value) = 'object' THEN h.value END) s
+WHERE json_typeof(s.value) <> 'null';
+
+INSERT INTO telegram_bot_data (name, data)
+SELECT 'bot_data', p.blob
+FROM (SELECT NULLIF(data->>'bot_data', '')::json AS blob FROM telegram_bot_persistence) p
+WHERE json_typeof(p.blob) = 'object';
+
+-- the buttons of inline keyboards sent before the upgrade, as PTB dumps them:
+-- [[[keyboard id, access time, {button id: data}], ...], {callback query id: keyboard id}]
+INSERT INTO telegram_bot_data (name, data)
+SELECT 'callback_data', p.blob
+FROM (SELECT NULLIF(data->>'callback_data', '')::json AS blob FROM telegram_bot_persistence) p
+WHERE json_typeof(p.blob) = 'array';
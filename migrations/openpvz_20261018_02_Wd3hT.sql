@@ -0,0 +1,22 @@
+-- one lateness notification per office, code and local date
+-- depends: openpvz_20261018_01_Rk7pQ
+
+ALTER TABLE notifications ADD COLUMN local_date DATE;
+
+UPDATE notifications n
+SET local_date = (n.created_at AT TIME ZONE 'UTC' AT TIME ZONE o.timezone)::date
+FROM offices o
+WHERE o.id = n.office_id
+    AND n.code IN ('office_not_opened_late', 'office_not_closed_late');
+
+DELETE FROM notifications n
+USING notifications earlier
+WHERE n.code IN ('office_not_opened_late', 'office_not_closed_late')
+    AND earlier.office_id = n.office_id
+    AND earlier.code = n.code
+    AND earlier.local_date = n.local_date
+    AND earlier.id < n.id;
+
+CREATE UNIQUE INDEX notifications_lateness_once_a_day
+ON notifications (office_id, code, local_date)
+WHERE code IN ('office_not_opened_late', 'office_not_closed_late');
@@ -0,0 +1,7 @@
+-- indexes for the nearest office lookup on check-in
+-- depends: openpvz_20261018_02_Wd3hT
+
+CREATE INDEX IF NOT EXISTS offices_location_idx ON offices USING gist (location);
+CREATE INDEX IF NOT EXISTS offices_owner_id_idx ON offices (owner_id);
+
+ANALYZE offices;
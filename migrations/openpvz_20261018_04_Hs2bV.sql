@@ -0,0 +1,5 @@
+-- per-office geofence radius for check-ins
+-- depends: openpvz_20261018_03_Gx4mN
+
+ALTER TABLE offices ADD COLUMN geofence_radius INTEGER NOT NULL DEFAULT 100;
+ALTER TABLE offices ADD CONSTRAINT offices_geofence_radius_check CHECK (geofence_radius BETWEEN 10 AND 1000);
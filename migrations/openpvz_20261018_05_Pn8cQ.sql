@@ -0,0 +1,68 @@
+-- monthly partitions of notifications by created_at
+-- depends: openpvz_20261018_04_Hs2bV
+
+ALTER TABLE notifications RENAME TO notifications_unpartitioned;
+ALTER SEQUENCE notifications_id_seq OWNED BY NONE;
+
+-- the primary key of a partitioned table has to include the partition key
+CREATE TABLE notifications (
+    id INTEGER NOT NULL DEFAULT nextval('notifications_id_seq'),
+    code VARCHAR NOT NULL,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+    office_id INTEGER NOT NULL,
+    source_user_id INTEGER,
+    local_date DATE,
+    PRIMARY KEY (id, created_at),
+    FOREIGN KEY (office_id) REFERENCES offices (id) ON DELETE CASCADE,
+    FOREIGN KEY (source_user_id) REFERENCES users (id) ON DELETE CASCADE
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE notifications_id_seq OWNED BY notifications.id;
+
+CREATE INDEX notifications_office_id_code_created_at_idx ON notifications (office_id, code, created_at);
+
+-- rows outside of every monthly partition, stays empty while partitions are created in advance
+CREATE TABLE notifications_default PARTITION OF notifications DEFAULT;
+
+-- a partition for every month since the first notification, up to the next month
+DO $$
+DECLARE
+    month DATE;
+BEGIN
+    FOR month IN
+        SELECT generate_series(
+            date_trunc('month', LEAST((SELECT min(created_at) FROM notifications_unpartitioned), now())),
+            date_trunc('month', now()) + interval '1 month',
+            interval '1 month'
+        )::date
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF notifications FOR VALUES FROM (%L) TO (%L)',
+            'notifications_' || to_char(month, 'YYYY_MM'),
+            month,
+            (month + interval '1 month')::date
+        );
+    END LOOP;
+END $$;
+
+INSERT INTO notifications (id, code, created_at, office_id, source_user_id, local_date)
+SELECT id, code, created_at, office_id, source_user_id, local_date
+FROM notifications_unpartitioned;
+
+-- unique indexes of a partitioned table have to include the partition key as well,
+-- so sending lateness notifications once a day is guarded by a table of its own
+CREATE TABLE lateness_notification_days (
+    office_id INTEGER NOT NULL,
+    code VARCHAR NOT NULL,
+    local_date DATE NOT NULL,
+    PRIMARY KEY (office_id, code, local_date),
+    FOREIGN KEY (office_id) REFERENCES offices (id) ON DELETE CASCADE
+);
+
+INSERT INTO lateness_notification_days (office_id, code, local_date)
+SELECT DISTINCT office_id, code, local_date
+FROM notifications_unpartitioned
+WHERE local_date IS NOT NULL
+    AND code IN ('office_not_opened_late', 'office_not_closed_late');
+
+DROP TABLE notifications_unpartitioned;
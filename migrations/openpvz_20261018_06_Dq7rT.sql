@@ -0,0 +1,51 @@
+-- daily rollup of office activity per user and local date
+-- depends: openpvz_20261018_05_Pn8cQ
+
+-- rows with user_id NULL hold what concerns the whole office, like lateness notifications
+CREATE TABLE daily_office_activity (
+    id BIGSERIAL NOT NULL,
+    office_id INTEGER NOT NULL,
+    user_id INTEGER,
+    local_date DATE NOT NULL,
+    first_opened_at TIMESTAMP WITHOUT TIME ZONE,
+    last_closed_at TIMESTAMP WITHOUT TIME ZONE,
+    opened_count INTEGER NOT NULL DEFAULT 0,
+    closed_count INTEGER NOT NULL DEFAULT 0,
+    -- minutes between the opening time and the first opening of the day
+    minutes_late INTEGER,
+    not_opened_late BOOLEAN NOT NULL DEFAULT FALSE,
+    not_closed_late BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (id),
+    CONSTRAINT daily_office_activity_office_user_date UNIQUE NULLS NOT DISTINCT (office_id, user_id, local_date),
+    FOREIGN KEY (office_id) REFERENCES offices (id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+);
+
+CREATE INDEX daily_office_activity_office_date_idx ON daily_office_activity (office_id, local_date);
+
+-- same as `python -m openpvz.rollup`
+INSERT INTO daily_office_activity (
+    office_id, user_id, local_date, first_opened_at, last_closed_at, opened_count, closed_count,
+    minutes_late, not_opened_late, not_closed_late
+)
+SELECT
+    e.office_id,
+    e.source_user_id,
+    e.local_date,
+    min(e.created_at) FILTER (WHERE e.code = 'office_opened'),
+    max(e.created_at) FILTER (WHERE e.code = 'office_closed'),
+    count(*) FILTER (WHERE e.code = 'office_opened'),
+    count(*) FILTER (WHERE e.code = 'office_closed'),
+    GREATEST(0, floor(extract(epoch FROM
+        min(e.local_time) FILTER (WHERE e.code = 'office_opened') - (e.local_date + wh.opening_time)
+    ) / 60))::integer,
+    bool_or(e.code = 'office_not_opened_late'),
+    bool_or(e.code = 'office_not_closed_late')
+FROM (
+    SELECT n.*, n.created_at AT TIME ZONE 'UTC' AT TIME ZONE o.timezone AS local_time,
+        (n.created_at AT TIME ZONE 'UTC' AT TIME ZONE o.timezone)::date AS local_date
+    FROM notifications n
+    JOIN offices o ON o.id = n.office_id
+) e
+LEFT JOIN working_hours wh ON wh.office_id = e.office_id AND wh.day_of_week = extract(isodow FROM e.local_date)
+GROUP BY e.office_id, e.source_user_id, e.local_date, wh.opening_time;
@@ -0,0 +1,14 @@
+-- users invited from a roster, until they open their invite link
+-- depends: openpvz_20261018_06_Dq7rT
+
+CREATE TABLE pending_users (
+    id SERIAL NOT NULL,
+    owner_id INTEGER NOT NULL,
+    name VARCHAR(50) NOT NULL,
+    role userrole NOT NULL,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (id),
+    FOREIGN KEY (owner_id) REFERENCES users (id) ON DELETE CASCADE
+);
+
+CREATE INDEX pending_users_created_at_idx ON pending_users (created_at);
@@ -0,0 +1,5 @@
+-- office locations were stored as ST_Point(latitude, longitude), PostGIS takes the longitude first
+-- depends: openpvz_20261018_07_Kv5sW
+
+UPDATE offices
+SET location = ST_SetSRID(ST_MakePoint(ST_Y(location::geometry), ST_X(location::geometry)), 4326)::geography;
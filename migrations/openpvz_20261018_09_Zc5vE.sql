@@ -0,0 +1,4 @@
+-- version of an office's daily activity, the cached watches reports are keyed by it
+-- depends: openpvz_20261018_08_Tm3xL
+
+ALTER TABLE offices ADD COLUMN activity_version BIGINT NOT NULL DEFAULT 0;
@@ -1,15 +1,18 @@
 from telegram.ext import Application, ConversationHandler, CommandHandler, MessageHandler
-from telegram.ext import filters, JobQueue
+from telegram.ext import filters, JobQueue, ContextTypes
 from openpvz import handlers
+from openpvz import auth
 from openpvz import strings as s
 from openpvz import keyboards as k
 from openpvz.consts import BotState, TELEGRAM_TOKEN
-from openpvz.db import db_connection_string
 from openpvz.persistence import PostgresPersistence
-from openpvz.scheduled_tasks import check_for_being_late
+from openpvz.sender import outbound
+from openpvz.scheduled_tasks import lateness_scheduler, report_pool_stats, report_cache_stats
+from openpvz.scheduled_tasks import compact_persisted_data, maintain_partitions, delete_expired_invites
+from openpvz.office_cache import office_cache
 import logging
 import sys
-from context import BotContext, ContextTypes
+from openpvz.context import BotContext
 from typing import List
 from datetime import timedelta
 
@@ -31,8 +34,11 @@ def run_bot():
     app: Application = Application.builder()\
         .token(TELEGRAM_TOKEN)\
         .context_types(ContextTypes(context=BotContext))\
-        .persistence(PostgresPersistence(db_connection_string("postgresql"), update_interval=10))\
+        .persistence(PostgresPersistence(write_behind=True, lazy=True, update_interval=10))\
         .job_queue(JobQueue())\
+        .post_init(_post_init)\
+        .post_stop(outbound.stop)\
+        .post_shutdown(_post_shutdown)\
         .build()
     to_main_handler = MessageHandler(_build_handler_regex(s.TO_MAIN_MENU), handlers.start)
     paged_list_handlers = [
@@ -56,6 +62,9 @@ def run_bot():
                 MessageHandler(_build_handler_regex(s.ADD_OPERATOR), handlers.add_operator),
                 MessageHandler(_build_handler_regex(s.ADD_OWNER), handlers.add_owner),
                 MessageHandler(_build_handler_regex(s.DELETE_OPERATOR), handlers.delete_operator),
+                MessageHandler(_build_handler_regex(s.EXPORT_REPORTS), handlers.export_reports),
+                MessageHandler(_build_handler_regex(s.BULK_INVITE), handlers.bulk_invite),
+                MessageHandler(_build_handler_regex(s.UPLOAD_ROSTER), handlers.upload_roster),
             ],
             BotState.OPERATOR_GEO: [
                 MessageHandler(filters.LOCATION, handlers.handle_current_geo),
@@ -84,11 +93,33 @@ def run_bot():
             BotState.OWNER_OFFICE_SETTINGS: [
                 MessageHandler(_build_handler_regex(s.DELETE_OFFICE), handlers.delete_office),
                 MessageHandler(_build_handler_regex(s.WATCHES_REPORT), handlers.watches_report),
+                MessageHandler(_build_handler_regex(s.GEOFENCE_RADIUS), handlers.geofence_radius),
                 to_main_handler
             ],
             BotState.REALLY_DELETE_OFFICE: [
                 MessageHandler(_build_handler_regex(s.YES, s.NO), handlers.really_delete_office)
             ],
+            BotState.OWNER_OFFICE_GEOFENCE_RADIUS: [
+                to_main_handler,
+                MessageHandler(filters.TEXT, handlers.handle_geofence_radius)
+            ],
+            BotState.OWNER_EXPORT_PERIOD: [
+                to_main_handler,
+                MessageHandler(filters.TEXT, handlers.handle_export_period)
+            ],
+            BotState.OWNER_EXPORT_FORMAT: [
+                to_main_handler,
+                MessageHandler(_build_handler_regex(s.EXPORT_CSV, s.EXPORT_CSV_GZ), handlers.handle_export_format)
+            ],
+            BotState.OWNER_BULK_INVITE: [
+                to_main_handler,
+                MessageHandler(filters.TEXT, handlers.handle_links_count)
+            ],
+            BotState.OWNER_ROSTER: [
+                to_main_handler,
+                MessageHandler(filters.Document.ALL, handlers.handle_roster),
+                MessageHandler(~filters.Document.ALL, handlers.upload_roster)
+            ],
         },
         fallbacks=[
             # TODO: обработка ошибок
@@ -98,12 +129,28 @@ def run_bot():
         name="main_handler"
     )
     app.add_handler(main_handler)
-    app.job_queue.run_repeating(check_for_being_late, timedelta(minutes=1))
+    app.job_queue.run_repeating(report_pool_stats, timedelta(minutes=5))
+    app.job_queue.run_repeating(report_cache_stats, timedelta(minutes=5))
+    app.job_queue.run_repeating(compact_persisted_data, timedelta(hours=1))
+    app.job_queue.run_repeating(delete_expired_invites, timedelta(hours=1))
+    app.job_queue.run_repeating(maintain_partitions, timedelta(hours=6), first=timedelta(minutes=1))
     app.run_polling(
         allowed_updates=["message", "inline_query", "chosen_inline_result", "callback_query"]
     )
 
 
+async def _post_init(app: Application):
+    await auth.start_prewarm()
+    await office_cache.start()
+    await lateness_scheduler.start(app)
+
+
+async def _post_shutdown(app: Application):
+    await auth.stop_prewarm()
+    await office_cache.stop()
+    await lateness_scheduler.stop(app)
+
+
 def _build_handler_regex(*options: List[str]) -> filters.Regex:
     return filters.Regex(rf"^{'|'.join(options)}$")
 
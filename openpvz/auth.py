@@ -1,21 +1,45 @@
+import asyncio
 import time
 import os
 import base64
 import binascii
+import secrets
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from logging import getLogger
 from openpvz.models import User, UserRole
 from openpvz.consts import TELEGRAM_BOT_NAME
-from typing import Tuple
+from typing import Dict, List, Tuple
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
 
 
+_logger = getLogger(__name__)
+
+
 SECRET_KEY = os.getenv('AUTH_SECRET_KEY')
 if SECRET_KEY is None:
     raise Exception("Please specify 'AUTH_SECRET_KEY'")
 
+INVITE_TTL = timedelta(days=1)
+
+# keys are derived from the 2-byte salt of a token, there are 65536 of them at most
+SALTS = 1 << 16
+# if set, the keys of the first AUTH_KEY_PREWARM salts are derived at startup
+# and new tokens use only these salts, so that creating and parsing them never waits
+AUTH_KEY_PREWARM = min(int(os.getenv('AUTH_KEY_PREWARM', 0)), SALTS)
+AUTH_KEY_CACHE_SIZE = max(int(os.getenv('AUTH_KEY_CACHE_SIZE', 4096)), AUTH_KEY_PREWARM)
+AUTH_WORKERS = int(os.getenv('AUTH_WORKERS', 2))
+
+# salt -> derived key, touched only from the event loop
+_keys: OrderedDict[bytes, bytes] = OrderedDict()
+_deriving: Dict[bytes, asyncio.Future] = {}
+_executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="auth")
+_prewarm_task: asyncio.Task | None = None
+
 
 _short_roles = {
     UserRole.SUPEROWNER: "SO",
@@ -25,39 +49,62 @@ _short_roles = {
 }
 
 
-def create_link(owner: User, role: UserRole):
+async def create_link(owner: User, role: UserRole):
+    return (await create_links(owner, role, [None]))[0]
+
+
+async def create_links(owner: User, role: UserRole, pending_user_ids: List[int | None]) -> List[str]:
+    """A link for each pending user, or a plain invite for None. The links share a salt,
+    so the whole batch costs at most one key derivation."""
     short_role = _short_roles.get(role)
-    token = encrypt_user_info(short_role, owner.id, int(time.time() + timedelta(days=1).total_seconds()))
-    return f"https://t.me/{TELEGRAM_BOT_NAME}?start={token}"
+    salt = _new_salt()
+    await derive_key(salt)
+    expire_time = int(time.time() + INVITE_TTL.total_seconds())
+    return [
+        f"https://t.me/{TELEGRAM_BOT_NAME}?start={encrypt_user_info(short_role, owner.id, expire_time, salt, id)}"
+        for id in pending_user_ids
+    ]
 
 
-def parse_token(token: str) -> Tuple[UserRole, int, bool]:
+async def parse_token(token: str) -> Tuple[UserRole, int, bool, int | None]:
+    """Role, owner id, whether the token expired and the pending user it was made for, if any."""
     try:
-        short_role, owner_id, expired = decrypt_user_info(token)
+        await derive_key(_token_salt(token))
+        short_role, owner_id, expired, pending_user_id = decrypt_user_info(token)
     except binascii.Error:
-        return None, None, None
+        return None, None, None, None
     short_roles_values = list(_short_roles.values())
     if short_role not in short_roles_values:
-        return None, None, None
+        return None, None, None, None
     role = list(_short_roles.keys())[short_roles_values.index(short_role)]
-    return role, owner_id, expired
+    return role, owner_id, expired, pending_user_id
 
 
 # Almost all credits for these two functions go to ChatGPT
-def encrypt_user_info(role: str, owner_id: int, expire_time: int) -> str:
-    salt = os.urandom(2)
+def encrypt_user_info(
+    role: str,
+    owner_id: int,
+    expire_time: int,
+    salt: bytes | None = None,
+    pending_user_id: int | None = None
+) -> str:
+    if salt is None:
+        salt = os.urandom(2)
     key = _get_key(salt)
     plaintext = f"{role}:{owner_id}:{expire_time}"
+    if pending_user_id is not None:
+        plaintext += f":{pending_user_id}"
     iv = os.urandom(16)
     cipher = Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend())
     encryptor = cipher.encryptor()
     ciphertext = encryptor.update(plaintext.encode()) + encryptor.finalize()
-    encrypted_string = base64.urlsafe_b64encode(iv + salt + ciphertext).decode()
+    # without padding, "=" is not allowed in a start parameter, which is also limited to 64 characters
+    encrypted_string = base64.urlsafe_b64encode(iv + salt + ciphertext).decode().rstrip("=")
     return encrypted_string
 
 
-def decrypt_user_info(encrypted_string: str) -> Tuple[str, int, bool]:
-    encrypted_data = base64.urlsafe_b64decode(encrypted_string.encode())
+def decrypt_user_info(encrypted_string: str) -> Tuple[str, int, bool, int | None]:
+    encrypted_data = _b64decode(encrypted_string)
     iv = encrypted_data[:16]
     salt = encrypted_data[16:18]
     ciphertext = encrypted_data[18:]
@@ -65,12 +112,89 @@ def decrypt_user_info(encrypted_string: str) -> Tuple[str, int, bool]:
     cipher = Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend())
     decryptor = cipher.decryptor()
     plaintext = decryptor.update(ciphertext) + decryptor.finalize()
-    role, owner_id, expire_time = plaintext.decode().split(':')
+    role, owner_id, expire_time, *pending_user_id = plaintext.decode().split(':')
     current_time = int(time.time())
-    return role, int(owner_id), int(expire_time) < current_time
+    pending_user_id = int(pending_user_id[0]) if pending_user_id else None
+    return role, int(owner_id), int(expire_time) < current_time, pending_user_id
+
+
+async def derive_key(salt: bytes) -> bytes:
+    """The key of `salt`, derived in a worker thread unless it is cached. Concurrent
+    calls for the same salt wait for the same derivation."""
+    key = _keys.get(salt)
+    if key is not None:
+        _keys.move_to_end(salt)
+        return key
+    future = _deriving.get(salt)
+    if future is None:
+        future = asyncio.get_running_loop().run_in_executor(_executor, _derive_key, salt)
+        _deriving[salt] = future
+        try:
+            # a cancelled caller doesn't cancel the derivation the others wait for
+            key = await asyncio.shield(future)
+        finally:
+            del _deriving[salt]
+        _put_key(salt, key)
+        return key
+    return await asyncio.shield(future)
+
+
+async def start_prewarm() -> None:
+    global _prewarm_task
+    if AUTH_KEY_PREWARM > 0 and _prewarm_task is None:
+        _prewarm_task = asyncio.create_task(_prewarm())
+
+
+async def stop_prewarm() -> None:
+    global _prewarm_task
+    if _prewarm_task is not None:
+        _prewarm_task.cancel()
+        try:
+            await _prewarm_task
+        except asyncio.CancelledError:
+            pass
+        _prewarm_task = None
+
+
+async def _prewarm() -> None:
+    started = time.perf_counter()
+    # one at a time, the other workers stay free for the tokens of users
+    for salt in range(AUTH_KEY_PREWARM):
+        await derive_key(salt.to_bytes(2, 'big'))
+    _logger.info(f"Derived {AUTH_KEY_PREWARM} token keys in {time.perf_counter() - started:.1f}s")
+
+
+def _new_salt() -> bytes:
+    if AUTH_KEY_PREWARM > 0:
+        return secrets.randbelow(AUTH_KEY_PREWARM).to_bytes(2, 'big')
+    return os.urandom(2)
+
+
+def _token_salt(token: str) -> bytes:
+    return _b64decode(token)[16:18]
+
+
+def _b64decode(token: str) -> bytes:
+    # tokens made before padding was dropped still have it
+    return base64.urlsafe_b64decode(token.rstrip("=") + "=" * (-len(token.rstrip("=")) % 4))
+
+
+def _put_key(salt: bytes, key: bytes) -> None:
+    _keys[salt] = key
+    _keys.move_to_end(salt)
+    while len(_keys) > AUTH_KEY_CACHE_SIZE:
+        _keys.popitem(last=False)
 
 
 def _get_key(salt: bytes) -> bytes:
+    key = _keys.get(salt)
+    if key is None:
+        key = _derive_key(salt)
+        _put_key(salt, key)
+    return key
+
+
+def _derive_key(salt: bytes) -> bytes:
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
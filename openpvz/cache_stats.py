@@ -0,0 +1,35 @@
+from logging import getLogger
+from typing import Callable, List
+
+
+_logger = getLogger(__name__)
+
+
+class CacheStats:
+    """Hits and misses of an in-memory cache since they were last logged."""
+
+    def __init__(self, name: str, size: Callable[[], int], unit: str = "entries") -> None:
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._size = size
+        self._unit = unit
+        _caches.append(self)
+
+    def report(self) -> None:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total > 0 else 0
+        _logger.info(
+            f"{self.name}: {self._size()} {self._unit}, {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1f}% hit rate)")
+        self.hits = 0
+        self.misses = 0
+
+
+_caches: List[CacheStats] = []
+
+
+def report_cache_stats() -> None:
+    """Logs the stats of every cache and starts counting anew."""
+    for stats in _caches:
+        stats.report()
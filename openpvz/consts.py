@@ -29,6 +29,11 @@ class BotState(IntEnum):
     OWNER_OFFICE_SETTINGS = auto()
     REALLY_DELETE_OPERATOR = auto()
     REALLY_DELETE_OFFICE = auto()
+    OWNER_OFFICE_GEOFENCE_RADIUS = auto()
+    OWNER_EXPORT_PERIOD = auto()
+    OWNER_EXPORT_FORMAT = auto()
+    OWNER_BULK_INVITE = auto()
+    OWNER_ROSTER = auto()
 
 
 class OfficeStatus(StrEnum):
@@ -1,13 +1,17 @@
 from telegram.ext import ContextTypes
 from telegram import Update
-import db
+from openpvz import db
 from openpvz.models import User, WorkingHours
 from openpvz.consts import OfficeStatus
 from openpvz import repository
 from openpvz.utils import Location
+from openpvz.statement_budget import statement_budget
 import functools
+import json
+import time
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List
+from typing import Any, Dict, List, Tuple
+from datetime import date, time as dtime, timedelta
 
 
 USER_ROLE = "USER_ROLE"
@@ -19,6 +23,22 @@ CURRENT_LIST = "CURRENT_LIST"
 LIST_PAGE = "LIST_PAGE"
 CURRENT_SIZE = "CURRENT_SIZE"
 CHOSEN_ID = "CHOSEN_ID"
+EXPORT_PERIOD = "EXPORT_PERIOD"
+EXPIRES_AT = "EXPIRES_AT"
+
+# how long a half-finished dialog keeps its data in user_data
+_TTL = {
+    USER_ROLE: timedelta(days=1),
+    USER_OWNER_ID: timedelta(days=1),
+    OFFICE_STATUS: timedelta(hours=1),
+    LOCATION: timedelta(hours=6),
+    WORKING_HOURS: timedelta(hours=6),
+    CURRENT_LIST: timedelta(hours=1),
+    LIST_PAGE: timedelta(hours=1),
+    CURRENT_SIZE: timedelta(hours=1),
+    CHOSEN_ID: timedelta(hours=1),
+    EXPORT_PERIOD: timedelta(hours=1),
+}
 
 
 class BotContext(ContextTypes.DEFAULT_TYPE):
@@ -44,87 +64,126 @@ class BotContext(ContextTypes.DEFAULT_TYPE):
         self._current_session = value
 
     def set_user_role(self, role: str):
-        self.user_data[USER_ROLE] = role
+        self._set(USER_ROLE, role)
 
     def unset_user_role(self):
-        del self.user_data[USER_ROLE]
+        self._unset(USER_ROLE)
 
     def get_user_role(self) -> str | None:
         return self.user_data.get(USER_ROLE)
 
     def set_user_owner_id(self, owner_id: int):
-        self.user_data[USER_OWNER_ID] = owner_id
+        self._set(USER_OWNER_ID, owner_id)
 
     def unset_user_owner_id(self):
-        del self.user_data[USER_OWNER_ID]
+        self._unset(USER_OWNER_ID)
 
     def get_user_owner_id(self) -> int | None:
         return self.user_data.get(USER_OWNER_ID)
 
     def set_office_status(self, office_status: OfficeStatus):
-        self.user_data[OFFICE_STATUS] = office_status
+        self._set(OFFICE_STATUS, office_status)
 
     def unset_office_status(self):
-        del self.user_data[OFFICE_STATUS]
+        self._unset(OFFICE_STATUS)
 
     def get_office_status(self) -> OfficeStatus | None:
         return self.user_data.get(OFFICE_STATUS)
 
     def set_location(self, location: Location):
-        self.user_data[LOCATION] = (location.latitude, location.longitude)
+        self._set(LOCATION, (location.latitude, location.longitude))
 
     def unset_location(self):
-        del self.user_data[LOCATION]
+        self._unset(LOCATION)
 
     def get_location(self) -> Location | None:
-        latitude, longitude = self.user_data.get(LOCATION)
+        location = self.user_data.get(LOCATION)
+        if location is None:
+            return None
+        latitude, longitude = location
         return Location(latitude=latitude, longitude=longitude)
 
     def set_working_hours(self, working_hours: List[WorkingHours]):
-        self.user_data[WORKING_HOURS] = working_hours
+        # plain values instead of ORM objects, so that they can be persisted
+        self._set(WORKING_HOURS, [
+            (w.day_of_week, w.opening_time.isoformat(), w.closing_time.isoformat()) for w in working_hours
+        ])
 
     def unset_working_hours(self):
-        del self.user_data[WORKING_HOURS]
+        self._unset(WORKING_HOURS)
 
     def get_working_hours(self) -> List[WorkingHours] | None:
-        return self.user_data.get(WORKING_HOURS)
+        working_hours = self.user_data.get(WORKING_HOURS)
+        if working_hours is None:
+            return None
+        return [WorkingHours(
+            day_of_week=day_of_week,
+            opening_time=dtime.fromisoformat(opening_time),
+            closing_time=dtime.fromisoformat(closing_time)
+        ) for day_of_week, opening_time, closing_time in working_hours]
 
     def set_current_page(self, page: int):
-        self.user_data[LIST_PAGE] = page
+        self._set(LIST_PAGE, page)
 
     def unset_current_page(self):
-        del self.user_data[LIST_PAGE]
+        self._unset(LIST_PAGE)
 
     def get_current_page(self) -> int | None:
         return self.user_data.get(LIST_PAGE)
 
     def set_current_list(self, _list: List[str]):
-        self.user_data[CURRENT_LIST] = _list.copy()
+        self._set(CURRENT_LIST, _list.copy())
 
     def unset_current_list(self):
-        del self.user_data[CURRENT_LIST]
+        self._unset(CURRENT_LIST)
 
     def get_current_list(self) -> List[str] | None:
         return self.user_data.get(CURRENT_LIST)
 
     def set_current_size(self, size: int):
-        self.user_data[CURRENT_SIZE] = size
+        self._set(CURRENT_SIZE, size)
 
     def unset_current_size(self):
-        del self.user_data[CURRENT_SIZE]
+        self._unset(CURRENT_SIZE)
 
     def get_current_size(self) -> int | None:
         return self.user_data.get(CURRENT_SIZE)
 
     def set_chosen_id(self, id: int):
-        self.user_data[CHOSEN_ID] = id
+        self._set(CHOSEN_ID, id)
 
     def unset_chosen_id(self):
-        del self.user_data[CHOSEN_ID]
+        self._unset(CHOSEN_ID)
 
     def get_chosen_id(self) -> int | None:
         return self.user_data.get(CHOSEN_ID)
 
+    def set_export_period(self, first_day: date, last_day: date):
+        self._set(EXPORT_PERIOD, (first_day.isoformat(), last_day.isoformat()))
+
+    def unset_export_period(self):
+        self._unset(EXPORT_PERIOD)
+
+    def get_export_period(self) -> Tuple[date, date] | None:
+        period = self.user_data.get(EXPORT_PERIOD)
+        if period is None:
+            return None
+        first_day, last_day = period
+        return date.fromisoformat(first_day), date.fromisoformat(last_day)
+
+    def _set(self, key: str, value: Any):
+        self.user_data[key] = value
+        expires_at = self.user_data.setdefault(EXPIRES_AT, {})
+        expires_at[key] = time.time() + _TTL[key].total_seconds()
+
+    def _unset(self, key: str):
+        del self.user_data[key]
+        expires_at = self.user_data.get(EXPIRES_AT)
+        if expires_at is not None:
+            expires_at.pop(key, None)
+            if len(expires_at) == 0:
+                del self.user_data[EXPIRES_AT]
+
     def unset_all(self):
         unset_func = [
             self.unset_user_role,
@@ -136,26 +195,64 @@ class BotContext(ContextTypes.DEFAULT_TYPE):
             self.unset_current_list,
             self.unset_current_size,
             self.unset_chosen_id,
+            self.unset_export_period,
         ]
         for f in unset_func:
             self.__unset_wo_exc(f)
 
     def __unset_wo_exc(self, func):
         try:
-            func(self)
+            func()
         except KeyError:
             pass
 
 
+def compact_user_data(user_data: Dict[str, Any], now: float) -> Tuple[bool, int]:
+    """Drops the temporary keys whose time to live has passed. Keys written before expiry was
+    tracked get the default time to live from now on.
+
+    Returns whether user_data changed and how many bytes of json the dropped keys took.
+    """
+    expires_at = user_data.get(EXPIRES_AT, {})
+    changed = False
+    expired = {}
+    for key, ttl in _TTL.items():
+        if key not in user_data:
+            if expires_at.pop(key, None) is not None:
+                changed = True
+        elif key not in expires_at:
+            expires_at[key] = now + ttl.total_seconds()
+            changed = True
+        elif expires_at[key] <= now:
+            expired[key] = user_data.pop(key)
+            del expires_at[key]
+            changed = True
+    if len(expires_at) == 0:
+        changed = user_data.pop(EXPIRES_AT, None) is not None or changed
+    else:
+        user_data[EXPIRES_AT] = expires_at
+    return changed, len(json.dumps(expired, default=str)) if expired else 0
+
+
 async def _fetch_current_user(update: Update, context: BotContext, session: AsyncSession):
-    context._current_user = await repository.get_user_by_chat_id(update.effective_chat.id, session)
+    context._current_user = await repository.get_cached_user_by_chat_id(update.effective_chat.id, session)
 
 
 def with_session(func):
+    """Runs the handler in a transaction committed when it returns. A handler called from
+    another decorated handler joins the caller's transaction. The session checks out a
+    connection only on its first statement, so with the user cached a handler that doesn't
+    use the database doesn't touch the pool."""
     @functools.wraps(func)
     async def wrapped(update: Update, context: BotContext):
-        async with db.begin() as session:
-            await _fetch_current_user(update, context, session)
-            context._current_session = session
+        if context.session is not None:
             return await func(update, context)
+        with statement_budget(func.__name__):
+            async with db.begin() as session:
+                context._current_session = session
+                try:
+                    await _fetch_current_user(update, context, session)
+                    return await func(update, context)
+                finally:
+                    context._current_session = None
     return wrapped
@@ -1,5 +1,11 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from logging import getLogger
 import os
+import time
+
+
+_logger = getLogger(__name__)
 
 
 def db_connection_string(schema: str):
@@ -18,9 +24,58 @@ def db_connection_string(schema: str):
     return connection_string
 
 
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))  # seconds, -1 to never recycle
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+SLOW_CHECKOUT_SECONDS = 1
+
+
+class PoolStats:
+    """Connection checkout wait times since the last report."""
+
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_checkout(self, wait: float) -> None:
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if wait > SLOW_CHECKOUT_SECONDS:
+            _logger.warning(f"Waited {wait:.3f}s for a database connection")
+
+    def reset(self) -> None:
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record_checkout(time.perf_counter() - started)
+
+
 DB_CONNECTION_STRING = db_connection_string("postgresql+psycopg")
 print(DB_CONNECTION_STRING)
-_engine = create_async_engine(DB_CONNECTION_STRING)
+_engine = create_async_engine(
+    DB_CONNECTION_STRING,
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
 SessionMaker = async_sessionmaker(_engine)
 
 
@@ -30,3 +85,14 @@ def get_engine() -> AsyncEngine:
 
 def begin() -> AsyncSession:
     return SessionMaker.begin()
+
+
+def report_pool_stats() -> None:
+    pool = _engine.pool
+    average_wait = pool_stats.total_wait / pool_stats.checkouts if pool_stats.checkouts else 0.0
+    _logger.info(
+        f"DB pool: {pool.checkedout()} checked out, {pool.overflow()} overflow, "
+        f"{pool_stats.checkouts} checkouts, wait avg {average_wait * 1000:.1f}ms, "
+        f"max {pool_stats.max_wait * 1000:.1f}ms"
+    )
+    pool_stats.reset()
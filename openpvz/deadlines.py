@@ -0,0 +1,87 @@
+import heapq
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Tuple
+from openpvz.models import Office, WorkingHours
+from openpvz.consts import NotificationCodes
+from openpvz.time_utils import local_to_utc, timezone_by_name
+
+
+# an office is late when it is still closed (or still open) this long after the working hours say
+LATE_AFTER = timedelta(minutes=15)
+# a deadline missed by more than this, e.g. while the bot was down, is not reported anymore
+REPORT_WITHIN = timedelta(minutes=15)
+
+
+class OfficeSchedule:
+    """What the scheduler needs to know about an office, detached from any session."""
+
+    def __init__(self, office_id: int, timezone: str, working_hours: List[WorkingHours]) -> None:
+        self.office_id = office_id
+        self.timezone = timezone_by_name(timezone)
+        self.hours: Dict[int, Tuple[time, time]] = {
+            w.day_of_week: (w.opening_time, w.closing_time) for w in working_hours
+        }
+
+    @classmethod
+    def from_office(cls, office: Office) -> 'OfficeSchedule':
+        return cls(office.id, office.timezone, office.working_hours)
+
+    def next_deadline(self, after: datetime) -> Tuple[datetime, NotificationCodes, date] | None:
+        """The first deadline strictly later than `after` (UTC) and the local working day it
+        belongs to, which a closing time late at night pushes past midnight. None if the
+        office never works."""
+        local_day = after.astimezone(self.timezone).date() - timedelta(days=1)
+        for _ in range(9):
+            hours = self.hours.get(local_day.isoweekday())
+            if hours is not None:
+                opening_time, closing_time = hours
+                opening = local_to_utc(self.timezone, local_day, opening_time) + LATE_AFTER
+                if opening > after:
+                    return opening, NotificationCodes.office_not_opened_late, local_day
+                closing = local_to_utc(self.timezone, local_day, closing_time) + LATE_AFTER
+                if closing > after:
+                    return closing, NotificationCodes.office_not_closed_late, local_day
+            local_day += timedelta(days=1)
+        return None
+
+
+class DeadlineHeap:
+    """Next deadline of every office, ordered by time. Rescheduling or removing an office
+    leaves its old entry in the heap, it is skipped when popped.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[datetime, int, int, NotificationCodes, date]] = []
+        self._versions: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+    def push(self, office_id: int, at: datetime, code: NotificationCodes, local_day: date) -> None:
+        version = self._versions.get(office_id, 0) + 1
+        self._versions[office_id] = version
+        heapq.heappush(self._heap, (at, office_id, version, code, local_day))
+
+    def remove(self, office_id: int) -> None:
+        self._versions.pop(office_id, None)
+
+    def next_time(self) -> datetime | None:
+        self._skip_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> List[Tuple[int, datetime, NotificationCodes, date]]:
+        due = []
+        self._skip_stale()
+        while self._heap and self._heap[0][0] <= now:
+            at, office_id, _, code, local_day = heapq.heappop(self._heap)
+            del self._versions[office_id]
+            due.append((office_id, at, code, local_day))
+            self._skip_stale()
+        return due
+
+    def _skip_stale(self) -> None:
+        while self._heap:
+            _, office_id, version, _, _ = self._heap[0]
+            if self._versions.get(office_id) == version:
+                return
+            heapq.heappop(self._heap)
@@ -4,3 +4,7 @@ class HandlerException(Exception):
 
 class FormatException(HandlerException):
     pass
+
+
+class StatementBudgetExceeded(Exception):
+    pass
@@ -0,0 +1,72 @@
+import math
+from collections import defaultdict
+from typing import Dict, Generic, Iterable, List, Protocol, Tuple, TypeVar
+from openpvz.utils import Location
+
+
+DEFAULT_GEOFENCE_RADIUS = 100  # meters
+MIN_GEOFENCE_RADIUS = 10
+MAX_GEOFENCE_RADIUS = 1000
+
+# mean Earth radius, the one PostGIS measures with on the sphere, so that the PostGIS fallback
+# of the office cache accepts the same check-ins as the geofences
+EARTH_RADIUS = 6_371_008.8  # meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+class Fenced(Protocol):
+    location: Location
+    geofence_radius: int
+
+
+F = TypeVar('F', bound=Fenced)
+
+
+def distance(a: Location, b: Location) -> float:
+    """Great-circle distance in meters."""
+    lat_a, lat_b = math.radians(a.latitude), math.radians(b.latitude)
+    d_lat = lat_b - lat_a
+    d_lon = math.radians(b.longitude - a.longitude)
+    h = math.sin(d_lat / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+class GeofenceGrid(Generic[F]):
+    """Places bucketed into a grid of cells of degrees, as high as the largest geofence radius
+    along a meridian and about as wide, with columns wrapping around at the antimeridian.
+    A lookup checks the cells the radius can reach from the point, which is the 3x3 cells
+    around it except close to the poles."""
+
+    def __init__(self, places: Iterable[F]) -> None:
+        places = list(places)
+        self._max_radius = max((p.geofence_radius for p in places), default=DEFAULT_GEOFENCE_RADIUS)
+        self._cell = self._max_radius / METERS_PER_DEGREE
+        # columns split the 360 degrees evenly, so that the last one meets the first
+        self._columns = math.ceil(360 / self._cell)
+        self._column_width = 360 / self._columns
+        self._cells: Dict[Tuple[int, int], List[F]] = defaultdict(list)
+        for place in places:
+            self._cells[self._key(place.location)].append(place)
+
+    def __len__(self) -> int:
+        return sum(len(cell) for cell in self._cells.values())
+
+    def nearest(self, location: Location) -> F | None:
+        """The nearest place whose geofence contains `location`."""
+        row, column = self._key(location)
+        # a degree of longitude gets shorter towards the poles
+        meters_per_lon_degree = METERS_PER_DEGREE * max(math.cos(math.radians(location.latitude)), 1e-6)
+        lon_span = min(math.ceil(self._max_radius / meters_per_lon_degree / self._column_width), self._columns)
+        columns = {c % self._columns for c in range(column - lon_span, column + lon_span + 1)}
+        nearest, nearest_distance = None, math.inf
+        for r in range(row - 1, row + 2):
+            for c in columns:
+                for place in self._cells.get((r, c), ()):
+                    d = distance(location, place.location)
+                    if d <= place.geofence_radius and d < nearest_distance:
+                        nearest, nearest_distance = place, d
+        return nearest
+
+    def _key(self, location: Location) -> Tuple[int, int]:
+        column = math.floor((location.longitude + 180) / self._column_width) % self._columns
+        return math.floor(location.latitude / self._cell), column
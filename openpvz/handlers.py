@@ -1,20 +1,27 @@
-from telegram import Update, error
-import strings as s
+import csv
+from telegram import Update
+import openpvz.strings as s
 from openpvz.consts import BotState, OfficeStatus
 import openpvz.keyboards as k
 from openpvz.utils import Location, first
-from context import BotContext, with_session
-from openpvz.sender import reply
+from openpvz.context import BotContext, with_session
+from openpvz.sender import reply, outbound
 from openpvz.models import UserRole, User, WorkingHours, Office
 from openpvz import repository
-from openpvz.auth import create_link, parse_token
-from datetime import time, timedelta, datetime
-from typing import List
-from openpvz.time_utils import tz_now, tz_today
+from openpvz.auth import create_link, create_links, parse_token
+from openpvz.invites import MAX_BULK_LINKS, MAX_NAME_LENGTH, MAX_ROSTER_BYTES, parse_roster, links_csv
+from datetime import date, time, timedelta, datetime
+from typing import List, Tuple
+from openpvz.time_utils import tz_now
 from logging import getLogger
 from openpvz.exceptions import HandlerException, FormatException
-from tz_service import get_timezone
-from reports import create_and_send_watches_report
+from openpvz.tz_service import get_timezone
+from openpvz.reports import create_and_send_watches_report, create_and_send_export
+from openpvz.scheduled_tasks import lateness_scheduler
+from openpvz.office_cache import office_cache
+from openpvz.geofence import MIN_GEOFENCE_RADIUS, MAX_GEOFENCE_RADIUS
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 _logger = getLogger(__name__)
@@ -30,7 +37,7 @@ async def start(update: Update, context: BotContext) -> BotState:
 
 async def _start_with_token(update: Update, context: BotContext) -> BotState:
     token = context.args[0]
-    role, owner_id, expired = parse_token(token)
+    role, owner_id, expired, pending_user_id = await parse_token(token)
     if role is None:
         await reply(
             update, context,
@@ -53,6 +60,14 @@ async def _start_with_token(update: Update, context: BotContext) -> BotState:
             )
             return BotState.END
 
+    pending_user = None
+    if pending_user_id is not None:
+        # locked until the end of the transaction, so that a double tap can't use the link twice
+        pending_user = await repository.get_pending_user(pending_user_id, context.session)
+        if pending_user is None or pending_user.owner_id != owner_id:
+            await reply(update, context, text=s.INVALID_TOKEN)
+            return BotState.END
+
     user = await repository.get_user_by_chat_id(update.effective_chat.id, context.session)
     if user is not None:
         if user.role == UserRole.SUPEROWNER or user.role == UserRole.OWNER or user.id == owner_id:
@@ -71,11 +86,16 @@ async def _start_with_token(update: Update, context: BotContext) -> BotState:
             )
         return await _start_logged_in(update, context)
 
-    context.set_user_role(role)
     if owner_id == 0:
         owner_id = None
+    if pending_user is not None:
+        # a link made for a pending user works once, for whoever joins with it
+        await repository.delete_pending_user(pending_user, context.session)
+        if await _create_user(update, context, pending_user.name, role, owner_id):
+            return await _start_logged_in(update, context)
+    context.set_user_role(role)
     context.set_user_owner_id(owner_id)
-    await reply(update, context, text=s.ASK_FOR_NAME)
+    await reply(update, context, text=s.ASK_FOR_NAME if pending_user is None else f"{s.NAME_TAKEN} {s.ASK_FOR_NAME}")
     return BotState.ASKING_FOR_NAME
 
 
@@ -84,18 +104,39 @@ async def handle_name(update: Update, context: BotContext) -> BotState:
     name = update.message.text.strip()
     role = context.get_user_role()
     owner_id = context.get_user_owner_id()
-    user = repository.create_user(User(
-        chat_id=update.effective_chat.id,
-        name=name,
-        role=role,
-        owner_id=owner_id
-    ), context.session)
-    context.user = user
+    if role is None:
+        # the invite expired while we were waiting for the name
+        return await _start_logged_in(update, context)
+    # names of pending users are kept for them
+    if len(await repository.get_taken_names([name], context.session)) > 0 \
+            or not await _create_user(update, context, name, role, owner_id):
+        await reply(update, context, text=f"{s.NAME_TAKEN} {s.ASK_FOR_NAME}")
+        return BotState.ASKING_FOR_NAME
     context.unset_user_role()
     context.unset_user_owner_id()
     return await _start_logged_in(update, context)
 
 
+async def _create_user(update: Update, context: BotContext, name: str, role: UserRole, owner_id: int | None) -> bool:
+    """Creates the user of the chat and logs them in. Returns False if someone else has
+    taken the name in the meantime."""
+    try:
+        async with context.session.begin_nested():
+            user = repository.create_user(User(
+                chat_id=update.effective_chat.id,
+                name=name,
+                role=role,
+                owner_id=owner_id
+            ), context.session)
+    except IntegrityError:
+        # the chat itself might have signed up meanwhile, e.g. with a double tap
+        user = await repository.get_user_by_chat_id(update.effective_chat.id, context.session)
+        if user is None:
+            return False
+    context.user = user
+    return True
+
+
 async def _start_logged_in(update: Update, context: BotContext) -> BotState:
     if context.user is None:
         await reply(update, context, text='You have to log in.')
@@ -128,23 +169,27 @@ async def handle_current_geo(update: Update, context: BotContext) -> BotState:
     location = update.message.location
     if location is None or location.live_period is None:
         return await ask_for_current_geo(update, context)
-    office = await repository.get_closest_office(location, context.user.owner_id, context.session)
+    if context.get_office_status() is None:
+        return await _start_logged_in(update, context)
+    office_id = await office_cache.find_office_at(location, context.user.owner_id, context.session)
+    office = await repository.get_office(office_id, context.session) if office_id is not None else None
     if office is not None:
         office_status = context.get_office_status()
         if office_status == OfficeStatus.OPENING and not office.is_open:
-            repository.office_doors_event(office, office_status, context.user.id, context.session)
+            # set before the event, so that one UPDATE writes it along with the activity version
+            office.is_open = True
+            await _office_doors_event(office, office_status, context)
             reply_text = _get_office_text(office, s.OFFICE_OPENED)
-            if await _owner_notification_needed(office, office_status):
+            if await _owner_notification_needed(office, office_status, context.session):
                 notification_text = _get_office_text(office, s.OFFICE_OPENED_NOTIFICATION)
                 await _notify_owner(context, text=notification_text)
-            office.is_open = True
         elif office_status == OfficeStatus.OPENING and office.is_open:
             reply_text = _get_office_text(office, s.OFFICE_ALREADY_OPENED)
         elif office_status == OfficeStatus.CLOSING and office.is_open:
             office.is_open = False
-            repository.office_doors_event(office, office_status, context.user.id, context.session)
+            await _office_doors_event(office, office_status, context)
             reply_text = _get_office_text(office, s.OFFICE_CLOSED)
-            if await _owner_notification_needed(office, office_status):
+            if await _owner_notification_needed(office, office_status, context.session):
                 notification_text = _get_office_text(office, s.OFFICE_CLOSED_NOTIFICATION)
                 await _notify_owner(context, text=notification_text)
         elif office_status == OfficeStatus.CLOSING and not office.is_open:
@@ -158,24 +203,38 @@ async def handle_current_geo(update: Update, context: BotContext) -> BotState:
     return BotState.MAIN_MENU
 
 
+async def _office_doors_event(office: Office, office_status: OfficeStatus, context: BotContext):
+    now = tz_now(office.timezone)
+    minutes_late = None
+    if office_status == OfficeStatus.OPENING:
+        cached = await office_cache.get(office.id, context.session)
+        today_wh = cached.hours_on(now.isoweekday()) if cached is not None else None
+        if today_wh is not None:
+            late = now.replace(tzinfo=None) - datetime.combine(now.date(), today_wh[0])
+            minutes_late = max(0, int(late.total_seconds() // 60))
+    await repository.office_doors_event(
+        office, office_status, context.user.id, now.date(), minutes_late, context.session)
+
+
 def _get_office_text(office: Office, text: str) -> str:
     return f"{office.name}: {text}"
 
 
-async def _owner_notification_needed(office: Office, office_status: OfficeStatus) -> bool:
+async def _owner_notification_needed(office: Office, office_status: OfficeStatus, session: AsyncSession) -> bool:
     now = tz_now(office.timezone)
-    today = tz_today(office.timezone)
+    today = now.date()
     weekday = now.isoweekday()
-    working_hours: List[WorkingHours] = await office.awaitable_attrs.working_hours
-    today_wh = first(working_hours, lambda w: w.day_of_week == weekday)
+    cached = await office_cache.get(office.id, session)
+    today_wh = cached.hours_on(weekday) if cached is not None else None
     if today_wh is None:
         _logger.warn(f"Missing WorkingHours: weekday = '{weekday}', office = '{office.id}'")
         return False
-    opening_time = datetime.combine(today, today_wh.opening_time)
+    opening_time, closing_time = today_wh
+    opening_time = datetime.combine(today, opening_time)
     opened_late = now.replace(tzinfo=None) - opening_time > timedelta(minutes=15)
     if office_status == OfficeStatus.OPENING and opened_late:
         return True
-    closing_time = datetime.combine(today, today_wh.closing_time)
+    closing_time = datetime.combine(today, closing_time)
     closed_early = closing_time - timedelta(minutes=10) > now.replace(tzinfo=None)
     closed_late = closing_time + timedelta(minutes=15) < now.replace(tzinfo=None)
     if office_status == OfficeStatus.CLOSING and (closed_early or closed_late):
@@ -183,12 +242,9 @@ async def _owner_notification_needed(office: Office, office_status: OfficeStatus
     return False
 
 
-async def _notify_owner(context: BotContext, *args, **kwargs):
-    chat_id = (await context.user.awaitable_attrs.owner).chat_id
-    try:
-        await context.bot.send_message(chat_id=chat_id, *args, **kwargs)
-    except error.Forbidden:
-        _logger.warn(f"Owner blocked the bot, chat_id: {chat_id}")
+async def _notify_owner(context: BotContext, **kwargs):
+    chat_id = await repository.get_chat_id(context.user.owner_id, context.session)
+    outbound.send_message(context.bot, chat_id, **kwargs)
 
 
 @with_session
@@ -243,8 +299,17 @@ async def handle_office_name(update: Update, context: BotContext) -> BotState:
     name = update.message.text.strip()
     location = context.get_location()
     working_hours = context.get_working_hours()
-    timezone = get_timezone(location.longitude, location.latitude)
-    repository.create_office(name, location, timezone, working_hours, context.user, context.session)
+    if location is None or working_hours is None:
+        return await _start_logged_in(update, context)
+    timezone = await get_timezone(location.longitude, location.latitude)
+    if timezone is None:
+        # the point is out at sea or the timezone API is down, the name can be sent again
+        await reply(update, context, text=s.TIMEZONE_NOT_FOUND)
+        return BotState.OWNER_OFFICE_NAME
+    office = repository.create_office(name, location, timezone, working_hours, context.user, context.session)
+    await context.session.flush()
+    await office_cache.office_saved(office, context.session)
+    lateness_scheduler.office_changed(office)
     context.unset_location()
     context.unset_working_hours()
     await reply(update, context, text=s.OFFICE_CREATED, reply_markup=k.main_menu(context.user.role))
@@ -262,15 +327,76 @@ async def add_owner(update: Update, context: BotContext) -> BotState:
 
 
 async def _add_user(update: Update, context: BotContext, role: UserRole) -> BotState:
-    link = create_link(context.user, role)
+    link = await create_link(context.user, role)
     await reply(update, context, text=s.SEND_THIS_LINK + f' {link}', reply_markup=k.main_menu(context.user.role))
     return BotState.MAIN_MENU
 
 
+@with_session
+async def bulk_invite(update: Update, context: BotContext) -> BotState:
+    await reply(update, context, text=s.ENTER_LINKS_COUNT)
+    return BotState.OWNER_BULK_INVITE
+
+
+@with_session
+async def handle_links_count(update: Update, context: BotContext) -> BotState:
+    try:
+        count = int(update.message.text.strip())
+    except ValueError:
+        count = None
+    if count is None or not 1 <= count <= MAX_BULK_LINKS:
+        await reply(update, context, text=s.ENTER_LINKS_COUNT)
+        return BotState.OWNER_BULK_INVITE
+    links = await create_links(context.user, UserRole.OPERATOR, [None] * count)
+    outbound.send_document(
+        context.bot, update.effective_chat.id,
+        document=links_csv(enumerate(links, start=1), '№'),
+        filename='links.csv',
+        reply_markup=k.main_menu(context.user.role)
+    )
+    return BotState.MAIN_MENU
+
+
+@with_session
+async def upload_roster(update: Update, context: BotContext) -> BotState:
+    await reply(update, context, text=s.SEND_ROSTER)
+    return BotState.OWNER_ROSTER
+
+
+@with_session
+async def handle_roster(update: Update, context: BotContext) -> BotState:
+    document = update.message.document
+    if document is None or document.file_size is None or document.file_size > MAX_ROSTER_BYTES:
+        await reply(update, context, text=s.SEND_ROSTER)
+        return BotState.OWNER_ROSTER
+    file = await document.get_file()
+    try:
+        names = parse_roster(bytes(await file.download_as_bytearray()))
+    except (UnicodeDecodeError, csv.Error):
+        names = []
+    names = names[:MAX_BULK_LINKS]
+    taken = await repository.get_taken_names(names, context.session)
+    new_names = [name for name in names if name not in taken and len(name) <= MAX_NAME_LENGTH]
+    if len(new_names) == 0:
+        await reply(update, context, text=s.NO_NEW_NAMES_IN_ROSTER, reply_markup=k.main_menu(context.user.role))
+        return BotState.MAIN_MENU
+    pending_users = await repository.create_pending_users(
+        context.user.id, UserRole.OPERATOR, new_names, context.session)
+    links = await create_links(context.user, UserRole.OPERATOR, [id for id, _ in pending_users])
+    skipped = len(names) - len(new_names)
+    outbound.send_document(
+        context.bot, update.effective_chat.id,
+        document=links_csv(zip((name for _, name in pending_users), links), 'Имя'),
+        filename='invites.csv',
+        caption=f"{s.ROSTER_SKIPPED} {skipped}" if skipped > 0 else None,
+        reply_markup=k.main_menu(context.user.role)
+    )
+    return BotState.MAIN_MENU
+
+
 @with_session
 async def delete_operator(update: Update, context: BotContext) -> BotState:
-    employees = await context.user.awaitable_attrs.employees
-    operators = list(filter(lambda e: e.role == UserRole.OPERATOR, employees))
+    operators = await repository.get_employees(context.user.id, UserRole.OPERATOR, context.session)
     if len(operators) == 0:
         await reply(update, context, text=s.NO_OPERATORS, reply_markup=k.main_menu(context.user.role))
         return BotState.MAIN_MENU
@@ -297,8 +423,7 @@ async def _send_paged_list(
 
 @with_session
 async def handle_delete_operator(update: Update, context: BotContext) -> BotState:
-    employees = await context.user.awaitable_attrs.employees
-    operators = list(filter(lambda e: e.role == UserRole.OPERATOR, employees))
+    operators = await repository.get_employees(context.user.id, UserRole.OPERATOR, context.session)
     operator = first(operators, lambda e: e.name == update.message.text)
     if operator is None:
         await reply(update, context, text=s.NO_SUCH_OPERATOR)
@@ -313,7 +438,9 @@ async def handle_delete_operator(update: Update, context: BotContext) -> BotStat
 async def really_delete_operator(update: Update, context: BotContext) -> BotState:
     if update.message.text == s.YES:
         user_to_delete = await repository.get_user(context.get_chosen_id(), context.session)
-        await context.session.delete(user_to_delete)
+        if user_to_delete is None:
+            return await _start_logged_in(update, context)
+        await repository.delete_user(user_to_delete, context.session)
         await reply(update, context, text=s.OPERATOR_DELETED, reply_markup=k.main_menu(context.user.role))
         return BotState.MAIN_MENU
     elif update.message.text == s.NO:
@@ -324,7 +451,7 @@ async def really_delete_operator(update: Update, context: BotContext) -> BotStat
 
 @with_session
 async def offices_settings(update: Update, context: BotContext) -> BotState:
-    offices = await context.user.awaitable_attrs.offices
+    offices = await office_cache.get_by_owner(context.user.id, context.session)
     if len(offices) == 0:
         await reply(update, context, text=s.NO_OFFICES, reply_markup=k.main_menu(context.user.role))
         return BotState.MAIN_MENU
@@ -335,7 +462,7 @@ async def offices_settings(update: Update, context: BotContext) -> BotState:
 
 @with_session
 async def show_office_settings(update: Update, context: BotContext) -> BotState:
-    offices = await context.user.awaitable_attrs.offices
+    offices = await office_cache.get_by_owner(context.user.id, context.session)
     office = first(offices, lambda e: e.name == update.message.text)
     if office is None:
         await reply(update, context, text=s.NO_SUCH_OFFICE)
@@ -350,22 +477,98 @@ async def show_office_settings(update: Update, context: BotContext) -> BotState:
 @with_session
 async def delete_office(update: Update, context: BotContext) -> BotState:
     office = await repository.get_office(context.get_chosen_id(), context.session)
+    if office is None:
+        return await _start_logged_in(update, context)
     await reply(update, context, text=f"{s.REALLY_DELETE_OFFICE} {office.name}?", reply_markup=k.yes_no())
     return BotState.REALLY_DELETE_OFFICE
 
 
+@with_session
+async def geofence_radius(update: Update, context: BotContext) -> BotState:
+    office = await repository.get_office(context.get_chosen_id(), context.session)
+    if office is None:
+        return await _start_logged_in(update, context)
+    await reply(
+        update, context, text=f"{s.CURRENT_GEOFENCE_RADIUS} {office.geofence_radius}. {s.ENTER_GEOFENCE_RADIUS}")
+    return BotState.OWNER_OFFICE_GEOFENCE_RADIUS
+
+
+@with_session
+async def handle_geofence_radius(update: Update, context: BotContext) -> BotState:
+    try:
+        radius = int(update.message.text.strip())
+    except ValueError:
+        radius = None
+    if radius is None or not MIN_GEOFENCE_RADIUS <= radius <= MAX_GEOFENCE_RADIUS:
+        await reply(update, context, text=s.ENTER_GEOFENCE_RADIUS)
+        return BotState.OWNER_OFFICE_GEOFENCE_RADIUS
+    office = await repository.get_office(context.get_chosen_id(), context.session)
+    if office is None:
+        return await _start_logged_in(update, context)
+    repository.update_geofence_radius(office, radius)
+    await office_cache.office_saved(office, context.session)
+    await reply(update, context, text=s.GEOFENCE_RADIUS_CHANGED, reply_markup=k.main_menu(context.user.role))
+    return BotState.MAIN_MENU
+
+
 @with_session
 async def watches_report(update: Update, context: BotContext) -> BotState:
     office = await repository.get_office(context.get_chosen_id(), context.session)
+    if office is None:
+        return await _start_logged_in(update, context)
     await create_and_send_watches_report(office, update, context)
     return BotState.MAIN_MENU
 
 
+@with_session
+async def export_reports(update: Update, context: BotContext) -> BotState:
+    await reply(update, context, text=s.ENTER_EXPORT_PERIOD)
+    return BotState.OWNER_EXPORT_PERIOD
+
+
+@with_session
+async def handle_export_period(update: Update, context: BotContext) -> BotState:
+    try:
+        first_day, last_day = _parse_period(update.message.text)
+    except ValueError:
+        await reply(update, context, text=s.ENTER_EXPORT_PERIOD)
+        return BotState.OWNER_EXPORT_PERIOD
+    except FormatException:
+        await reply(update, context, text=s.FIRST_DAY_AFTER_LAST)
+        return BotState.OWNER_EXPORT_PERIOD
+    context.set_export_period(first_day, last_day)
+    await reply(update, context, text=s.CHOOSE_EXPORT_FORMAT, reply_markup=k.export_formats())
+    return BotState.OWNER_EXPORT_FORMAT
+
+
+@with_session
+async def handle_export_format(update: Update, context: BotContext) -> BotState:
+    period = context.get_export_period()
+    if period is None:
+        return await _start_logged_in(update, context)
+    first_day, last_day = period
+    await create_and_send_export(first_day, last_day, update.message.text == s.EXPORT_CSV_GZ, update, context)
+    context.unset_export_period()
+    return BotState.MAIN_MENU
+
+
+def _parse_period(text: str) -> Tuple[date, date]:
+    # DD.MM.YYYY-DD.MM.YYYY
+    first_day, last_day = (datetime.strptime(d.strip(), "%d.%m.%Y").date() for d in text.split("-"))
+    if last_day < first_day:
+        raise FormatException(f"First day ({first_day}) can't be after the last one ({last_day})")
+    return first_day, last_day
+
+
 @with_session
 async def really_delete_office(update: Update, context: BotContext) -> BotState:
     if update.message.text == s.YES:
         office_to_delete = await repository.get_office(context.get_chosen_id(), context.session)
+        if office_to_delete is None:
+            return await _start_logged_in(update, context)
         await context.session.delete(office_to_delete)
+        await office_cache.office_deleted(office_to_delete, context.session)
+        lateness_scheduler.office_removed(office_to_delete.id)
         await reply(update, context, text=s.OFFICE_DELETED, reply_markup=k.main_menu(context.user.role))
         return BotState.MAIN_MENU
     elif update.message.text == s.NO:
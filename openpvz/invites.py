@@ -0,0 +1,40 @@
+import csv
+import io
+from typing import Iterable, List, Tuple
+
+
+MAX_BULK_LINKS = 500
+MAX_ROSTER_BYTES = 256 * 1024
+MAX_NAME_LENGTH = 50  # users.name
+_HEADERS = {'имя', 'фио', 'name'}
+
+
+def parse_roster(content: bytes) -> List[str]:
+    """Names from the first column of a csv roster, without blanks, a header or duplicates.
+    Rosters saved from Excel in cp1251 are accepted as well as utf-8."""
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = content.decode('cp1251')
+    dialect = csv.excel
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        pass
+    names = []
+    seen = set()
+    for row in csv.reader(io.StringIO(text), dialect):
+        name = " ".join(row[0].split()) if len(row) > 0 else ""
+        if name == "" or name.lower() in _HEADERS or name in seen:
+            continue
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def links_csv(rows: Iterable[Tuple[str, str]], first_column: str) -> bytes:
+    file = io.StringIO()
+    writer = csv.writer(file, lineterminator="\n")
+    writer.writerow([first_column, 'Ссылка'])
+    writer.writerows(rows)
+    return file.getvalue().encode('utf-8')
@@ -1,5 +1,5 @@
 from telegram import ReplyKeyboardMarkup
-import strings as s
+import openpvz.strings as s
 from openpvz.models import UserRole
 from typing import TypeVar, Iterable
 
@@ -22,12 +22,15 @@ def main_menu(role: UserRole) -> ReplyKeyboardMarkup:
             return _default_keyboard([
                 [s.ADD_OFFICE, s.ADD_OPERATOR,],
                 [s.ADD_OWNER, s.DELETE_OPERATOR],
-                [s.OFFICES_SETTINGS]
+                [s.OFFICES_SETTINGS, s.EXPORT_REPORTS],
+                [s.BULK_INVITE, s.UPLOAD_ROSTER]
             ])
         case UserRole.OWNER:
             return _default_keyboard([
                 [s.ADD_OFFICE, s.ADD_OPERATOR],
-                [s.OFFICES_SETTINGS, s.DELETE_OPERATOR]
+                [s.OFFICES_SETTINGS, s.DELETE_OPERATOR],
+                [s.EXPORT_REPORTS],
+                [s.BULK_INVITE, s.UPLOAD_ROSTER]
             ])
         case UserRole.MANAGER:
             return _default_keyboard([
@@ -71,4 +74,8 @@ def yes_no() -> ReplyKeyboardMarkup:
 
 
 def office_actions() -> ReplyKeyboardMarkup:
-    return _default_keyboard([[s.TO_MAIN_MENU, s.WATCHES_REPORT, s.DELETE_OFFICE]])
+    return _default_keyboard([[s.TO_MAIN_MENU, s.WATCHES_REPORT], [s.GEOFENCE_RADIUS, s.DELETE_OFFICE]])
+
+
+def export_formats() -> ReplyKeyboardMarkup:
+    return _default_keyboard([[s.EXPORT_CSV, s.EXPORT_CSV_GZ], [s.TO_MAIN_MENU]])
@@ -4,7 +4,7 @@ from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy import String, ForeignKey, BigInteger, func
 from geoalchemy2 import Geography
 from typing import List
-from datetime import datetime, time
+from datetime import datetime, time, date
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -41,6 +41,10 @@ class Office(Base):
     is_open: Mapped[bool] = mapped_column(nullable=False, default=False)
     owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=True)
     timezone: Mapped[str] = mapped_column(nullable=False, default="Europe/Moscow")
+    # meters around the office within which operators can open or close it
+    geofence_radius: Mapped[int] = mapped_column(nullable=False, default=100)
+    # bumped whenever the activity of the office's users changes, see `repository.bump_activity_version`
+    activity_version: Mapped[int] = mapped_column(BigInteger(), nullable=False, default=0)
 
     owner: Mapped['User'] = relationship(back_populates="offices")
     working_hours: Mapped[List['WorkingHours']] = relationship(back_populates="office", cascade="all, delete-orphan")
@@ -63,6 +67,48 @@ class Notification(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     code: Mapped[str] = mapped_column(String(20), nullable=False)
-    created_at: Mapped[datetime] = mapped_column(nullable=False, server_default=func.now())
+    # part of the key, the table is partitioned by it
+    created_at: Mapped[datetime] = mapped_column(primary_key=True, server_default=func.now())
     office_id: Mapped[int] = mapped_column(ForeignKey("offices.id"))
     source_user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=True)
+    # office's local date, set for lateness notifications that are sent once a day
+    local_date: Mapped[date] = mapped_column(nullable=True)
+
+
+class LatenessNotificationDay(Base):
+    """A lateness notification sent to an office on its local date, there is at most one."""
+    __tablename__ = 'lateness_notification_days'
+
+    office_id: Mapped[int] = mapped_column(ForeignKey("offices.id"), primary_key=True)
+    code: Mapped[str] = mapped_column(primary_key=True)
+    local_date: Mapped[date] = mapped_column(primary_key=True)
+
+
+class DailyOfficeActivity(Base):
+    """What happened in an office on its local date, per user who opened or closed it.
+    The row without a user holds the lateness notifications of the office."""
+    __tablename__ = 'daily_office_activity'
+
+    id: Mapped[int] = mapped_column(BigInteger(), primary_key=True, autoincrement=True)
+    office_id: Mapped[int] = mapped_column(ForeignKey("offices.id"), nullable=False)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=True)
+    local_date: Mapped[date] = mapped_column(nullable=False)
+    first_opened_at: Mapped[datetime] = mapped_column(nullable=True)
+    last_closed_at: Mapped[datetime] = mapped_column(nullable=True)
+    opened_count: Mapped[int] = mapped_column(nullable=False, default=0)
+    closed_count: Mapped[int] = mapped_column(nullable=False, default=0)
+    # minutes between the opening time and the first opening of the day
+    minutes_late: Mapped[int] = mapped_column(nullable=True)
+    not_opened_late: Mapped[bool] = mapped_column(nullable=False, default=False)
+    not_closed_late: Mapped[bool] = mapped_column(nullable=False, default=False)
+
+
+class PendingUser(Base):
+    """A user invited by name, who becomes a User on opening the invite link."""
+    __tablename__ = 'pending_users'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    name: Mapped[str] = mapped_column(String(50), nullable=False)
+    role: Mapped[UserRole] = mapped_column(nullable=False)
+    created_at: Mapped[datetime] = mapped_column(nullable=False, server_default=func.now())
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import os
+from dataclasses import dataclass
+from datetime import time
+from logging import getLogger
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+from uuid import uuid4
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from openpvz import db
+from openpvz import repository
+from openpvz.cache_stats import CacheStats
+from openpvz.deadlines import OfficeSchedule
+from openpvz.geofence import GeofenceGrid
+from openpvz.models import Office
+from openpvz.user_cache import USER_CACHE_NOTIFY, USER_CHANGES_CHANNEL, user_cache
+from openpvz.utils import Location
+
+
+_logger = getLogger(__name__)
+
+
+# publish changes with NOTIFY and listen for the changes made by other replicas
+OFFICE_CACHE_NOTIFY = os.getenv('OFFICE_CACHE_NOTIFY', 'true').lower() in ('1', 'true', 'yes')
+OFFICE_CHANGES_CHANNEL = 'office_changes'
+RELISTEN_DELAY = 5  # seconds
+
+
+@dataclass(frozen=True)
+class CachedOffice:
+    """Office data that rarely changes, detached from any session. Mutable state such as
+    `is_open` is not cached and has to be read from the database."""
+    id: int
+    owner_id: int | None
+    name: str
+    location: Location
+    geofence_radius: int
+    schedule: OfficeSchedule
+
+    @classmethod
+    def from_row(cls, office: Office, longitude: float, latitude: float) -> 'CachedOffice':
+        return cls(
+            id=office.id,
+            owner_id=office.owner_id,
+            name=office.name,
+            location=Location(latitude=latitude, longitude=longitude),
+            geofence_radius=office.geofence_radius,
+            schedule=OfficeSchedule.from_office(office)
+        )
+
+    def hours_on(self, weekday: int) -> Tuple[time, time] | None:
+        return self.schedule.hours.get(weekday)
+
+
+OfficeListener = Callable[[int, CachedOffice | None], Awaitable[None]]
+
+
+class OfficeCache:
+    """Read-through cache of offices and their working hours, keyed by office id, with an
+    index of the offices of every owner and a geofence grid for every owner fully cached.
+
+    Whoever changes an office calls `office_saved` or `office_deleted` in the same session.
+    That drops the local entry and, with OFFICE_CACHE_NOTIFY, sends a NOTIFY delivered on
+    commit, so every replica drops it as well and tells its listeners.
+    """
+
+    def __init__(self) -> None:
+        self.stats = CacheStats("Office cache", lambda: len(self._offices), "offices")
+        self._offices: Dict[int, CachedOffice] = {}
+        self._by_owner: Dict[int, Set[int]] = {}
+        # owners whose offices are all in the cache
+        self._complete_owners: Set[int] = set()
+        self._geofences: Dict[int, GeofenceGrid[CachedOffice]] = {}
+        self._warming_owners: Set[int] = set()
+        # misses are the check-ins matched by PostGIS
+        self.geofence_stats = CacheStats("Geofences", lambda: len(self._geofences), "owners")
+        self._listeners: List[OfficeListener] = []
+        self._origin = uuid4().hex
+        self._listen_task: asyncio.Task | None = None
+
+    async def get(self, office_id: int, session: AsyncSession) -> CachedOffice | None:
+        cached = self._offices.get(office_id)
+        if cached is not None:
+            self.stats.hits += 1
+            return cached
+        self.stats.misses += 1
+        for row in await repository.get_offices_with_working_hours(session, ids=[office_id]):
+            self._put(CachedOffice.from_row(*row))
+        return self._offices.get(office_id)
+
+    async def get_by_owner(self, owner_id: int, session: AsyncSession) -> List[CachedOffice]:
+        if owner_id in self._complete_owners:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+            for row in await repository.get_offices_with_working_hours(session, owner_id=owner_id):
+                self._put(CachedOffice.from_row(*row))
+            self._complete_owners.add(owner_id)
+        return sorted((self._offices[id] for id in self._by_owner.get(owner_id, ())), key=lambda o: o.id)
+
+    async def load_all(self, session: AsyncSession) -> List[CachedOffice]:
+        self.clear()
+        for row in await repository.get_offices_with_working_hours(session):
+            self._put(CachedOffice.from_row(*row))
+        self._complete_owners = set(self._by_owner)
+        for owner_id, office_ids in self._by_owner.items():
+            self._geofences[owner_id] = GeofenceGrid(self._offices[id] for id in office_ids)
+        return list(self._offices.values())
+
+    async def find_office_at(self, location: Location, owner_id: int, session: AsyncSession) -> int | None:
+        """Id of the nearest office of the owner whose geofence contains `location`.
+        Asks PostGIS if the owner's offices aren't cached, and caches them in the background."""
+        geofence = self._geofences.get(owner_id)
+        if geofence is None and owner_id in self._complete_owners:
+            geofence = GeofenceGrid(self._offices[id] for id in self._by_owner.get(owner_id, ()))
+            self._geofences[owner_id] = geofence
+        if geofence is not None:
+            self.geofence_stats.hits += 1
+            office = geofence.nearest(location)
+            return office.id if office is not None else None
+        self.geofence_stats.misses += 1
+        if owner_id not in self._warming_owners:
+            self._warming_owners.add(owner_id)
+            asyncio.create_task(self._warm_owner(owner_id))
+        office = await repository.get_closest_office(location, owner_id, session)
+        return office.id if office is not None else None
+
+    async def office_saved(self, office: Office, session: AsyncSession) -> None:
+        """Call after an office or its working hours were created or changed, once it has an id."""
+        self.invalidate(office.id, office.owner_id)
+        await self._publish(office.id, session)
+
+    async def office_deleted(self, office: Office, session: AsyncSession) -> None:
+        self.invalidate(office.id, office.owner_id)
+        await self._publish(office.id, session)
+
+    def invalidate(self, office_id: int, owner_id: int | None = None) -> None:
+        cached = self._offices.pop(office_id, None)
+        if cached is not None:
+            self._by_owner.get(cached.owner_id, set()).discard(office_id)
+            self._geofences.pop(cached.owner_id, None)
+        # a new office, or one moved to another owner, is not in the owner's index yet
+        self._complete_owners.discard(owner_id)
+        self._geofences.pop(owner_id, None)
+
+    def clear(self) -> None:
+        self._offices = {}
+        self._by_owner = {}
+        self._complete_owners = set()
+        self._geofences = {}
+
+    def subscribe(self, listener: OfficeListener) -> None:
+        """`listener` is called with the office id and its new data, or None if the office
+        is gone, whenever another replica changes an office."""
+        self._listeners.append(listener)
+
+    async def start(self) -> None:
+        """Listens for the changes of other replicas, to users as well as to offices."""
+        if (OFFICE_CACHE_NOTIFY or USER_CACHE_NOTIFY) and self._listen_task is None:
+            self._listen_task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+            try:
+                await self._listen_task
+            except asyncio.CancelledError:
+                pass
+            self._listen_task = None
+
+    def _put(self, cached: CachedOffice) -> None:
+        self._offices[cached.id] = cached
+        self._by_owner.setdefault(cached.owner_id, set()).add(cached.id)
+        self._geofences.pop(cached.owner_id, None)
+
+    async def _warm_owner(self, owner_id: int) -> None:
+        try:
+            async with db.begin() as session:
+                await self.get_by_owner(owner_id, session)
+        except Exception:
+            _logger.exception(f"Failed to cache the offices of owner {owner_id}")
+        finally:
+            self._warming_owners.discard(owner_id)
+
+    async def _publish(self, office_id: int, session: AsyncSession) -> None:
+        if not OFFICE_CACHE_NOTIFY:
+            return
+        payload = json.dumps({"office_id": office_id, "origin": self._origin})
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": OFFICE_CHANGES_CHANNEL, "payload": payload}
+        )
+
+    async def _listen(self) -> None:
+        reconnecting = False
+        while True:
+            connection: AsyncConnection | None = None
+            try:
+                connection = await db.get_engine().connect()
+                connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+                if OFFICE_CACHE_NOTIFY:
+                    await connection.execute(text(f"LISTEN {OFFICE_CHANGES_CHANNEL}"))
+                if USER_CACHE_NOTIFY:
+                    await connection.execute(text(f"LISTEN {USER_CHANGES_CHANNEL}"))
+                if reconnecting:
+                    # changes made while nobody was listening are lost
+                    self.clear()
+                    user_cache.clear()
+                reconnecting = True
+                raw = await connection.get_raw_connection()
+                async for notify in raw.driver_connection.notifies():
+                    if notify.channel == USER_CHANGES_CHANNEL:
+                        user_cache.on_notify(notify.payload)
+                    else:
+                        await self._on_notify(notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                _logger.exception(f"Lost the change listener, listening again in {RELISTEN_DELAY}s")
+                await asyncio.sleep(RELISTEN_DELAY)
+            finally:
+                if connection is not None:
+                    # a listening connection must not go back to the pool
+                    await connection.invalidate()
+                    await connection.close()
+
+    async def _on_notify(self, payload: str) -> None:
+        message = json.loads(payload)
+        office_id = message["office_id"]
+        # also from this replica: the office might have been read again before the commit
+        self.invalidate(office_id)
+        if message["origin"] == self._origin:
+            return
+        try:
+            # reloading keeps the index of a possibly new owner complete
+            async with db.begin() as session:
+                cached = await self.get(office_id, session)
+            for listener in self._listeners:
+                await listener(office_id, cached)
+        except Exception:
+            _logger.exception(f"Failed to handle a change of office {office_id}")
+
+
+office_cache = OfficeCache()
@@ -0,0 +1,108 @@
+import gzip
+import os
+import re
+from datetime import date, timedelta
+from logging import getLogger
+from typing import List
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from openpvz import db
+from openpvz.time_utils import utc_now
+
+
+_logger = getLogger(__name__)
+
+
+# monthly partitions created in advance, besides the current month's
+NOTIFICATIONS_PARTITIONS_AHEAD = int(os.getenv('NOTIFICATIONS_PARTITIONS_AHEAD', 2))
+# partitions of months older than this many full months are detached, 0 keeps all of them
+NOTIFICATIONS_RETENTION_MONTHS = int(os.getenv('NOTIFICATIONS_RETENTION_MONTHS', 0))
+# if set, detached partitions are exported here as gzipped csv and dropped,
+# otherwise they stay in the database as standalone tables
+NOTIFICATIONS_ARCHIVE_DIR = os.getenv('NOTIFICATIONS_ARCHIVE_DIR')
+# only today's lateness notifications are looked up, keep a few days for time zones and debugging
+LATENESS_DAYS_RETENTION = timedelta(days=7)
+
+_PARTITION_NAME = re.compile(r"^notifications_(\d{4})_(\d{2})$")
+# single-key advisory lock, keeps replicas from maintaining the partitions at the same time
+_LOCK_KEY = 0x6f70767a0001
+
+
+def partition_name(month: date) -> str:
+    return f"notifications_{month.year:04d}_{month.month:02d}"
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+async def maintain_notification_partitions(today: date | None = None) -> None:
+    """Creates the partitions of the next months, detaches the ones past retention and
+    exports them if NOTIFICATIONS_ARCHIVE_DIR is set. Safe to run on every replica."""
+    if today is None:
+        today = utc_now().date()
+    this_month = today.replace(day=1)
+    detached = []
+    async with db.get_engine().begin() as connection:
+        locked = await connection.scalar(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": _LOCK_KEY})
+        if not locked:
+            return
+        for months in range(NOTIFICATIONS_PARTITIONS_AHEAD + 1):
+            await _create_partition(connection, add_months(this_month, months))
+        if NOTIFICATIONS_RETENTION_MONTHS > 0:
+            oldest_kept = add_months(this_month, -NOTIFICATIONS_RETENTION_MONTHS)
+            for name in await _partitions_before(connection, oldest_kept):
+                await connection.execute(text(f'ALTER TABLE notifications DETACH PARTITION "{name}"'))
+                detached.append(name)
+                _logger.info(f"Detached notifications partition {name}")
+        await connection.execute(
+            text("DELETE FROM lateness_notification_days WHERE local_date < :before"),
+            {"before": today - LATENESS_DAYS_RETENTION}
+        )
+    if NOTIFICATIONS_ARCHIVE_DIR is not None:
+        for name in detached:
+            await _archive(name)
+
+
+async def _create_partition(connection: AsyncConnection, month: date) -> None:
+    name = partition_name(month)
+    await connection.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF notifications '
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    ))
+
+
+async def _partitions_before(connection: AsyncConnection, month: date) -> List[str]:
+    result = await connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'notifications'"
+    ))
+    names = []
+    for name in result.scalars():
+        match = _PARTITION_NAME.match(name)
+        if match is not None and date(int(match[1]), int(match[2]), 1) < month:
+            names.append(name)
+    return sorted(names)
+
+
+async def _archive(name: str) -> None:
+    """Exports a detached partition and drops it. On failure the table stays in place."""
+    path = os.path.join(NOTIFICATIONS_ARCHIVE_DIR, f"{name}.csv.gz")
+    try:
+        os.makedirs(NOTIFICATIONS_ARCHIVE_DIR, exist_ok=True)
+        async with db.get_engine().connect() as connection:
+            raw = await connection.get_raw_connection()
+            async with raw.driver_connection.cursor() as cursor:
+                with gzip.open(path + ".part", "wb") as file:
+                    async with cursor.copy(f'COPY "{name}" TO STDOUT WITH (FORMAT csv, HEADER)') as copy:
+                        async for chunk in copy:
+                            file.write(chunk)
+            os.replace(path + ".part", path)
+            await connection.execute(text(f'DROP TABLE "{name}"'))
+            await connection.commit()
+        _logger.info(f"Archived notifications partition {name} to {path}")
+    except Exception:
+        _logger.exception(f"Failed to archive notifications partition {name}, it is left detached")
@@ -1,44 +1,70 @@
+import asyncio
 import json
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from dataclasses import dataclass, field
 from logging import getLogger
-from typing import Any, Dict, List, Optional, Tuple, Callable
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 from telegram.ext import DictPersistence
+from sqlalchemy import text, bindparam
+from sqlalchemy.ext.asyncio import AsyncEngine
 from openpvz import db
-import psycopg
 
 
 CDCData = Tuple[List[Tuple[str, float, Dict[str, Any]]], Dict[str, str]]
-
-
-def db_connection():
-    return psycopg.connect(db.db_connection_string("postgresql"))
-
-
-class PersistentDbConnection:
-    def __init__(self, db_connection_factory: Callable) -> None:
-        self.db_connection_factory = db_connection_factory
-        self.db_connection = None
-        db_connection = db_connection_factory()
-        if not callable(getattr(db_connection, 'close', None)):
-            raise ValueError("This connection is a non-closable!")
-        self.db_connection = db_connection
-
-    def __del__(self):
-        if self.db_connection is not None:
-            self.db_connection.close()
-
-    def acquire(self):
-        if self.db_connection.closed:
-            self.db_connection = self.db_connection_factory()
-        return self.db_connection
+ConversationKey = Tuple[int, ...]
+# user/chat id -> (monotonic time of the last access, the application's data dict for it)
+LazyCache = OrderedDict[int, Tuple[float, Dict[Any, Any]]]
+
+BOT_DATA = "bot_data"
+CALLBACK_DATA = "callback_data"
+
+
+@dataclass
+class _PendingChanges:
+    user_rows: List[Dict[str, Any]] = field(default_factory=list)
+    dropped_user_ids: List[int] = field(default_factory=list)
+    chat_rows: List[Dict[str, Any]] = field(default_factory=list)
+    dropped_chat_ids: List[int] = field(default_factory=list)
+    conversation_rows: List[Dict[str, Any]] = field(default_factory=list)
+    conversation_deletes: List[Dict[str, Any]] = field(default_factory=list)
+    named_rows: List[Dict[str, Any]] = field(default_factory=list)
+    # the keys the rows above were built from, to mark them dirty again if the write fails
+    user_ids: Set[int] = field(default_factory=set)
+    chat_ids: Set[int] = field(default_factory=set)
+    conversations: Set[Tuple[str, ConversationKey]] = field(default_factory=set)
+    bot_data: bool = False
+    callback_data: bool = False
 
 
 class PostgresPersistence(DictPersistence):
     """Using Postgresql database to make user/chat/bot data persistent across reboots.
 
+    Every user, chat and conversation key is stored in a row of its own, and only the keys
+    changed since the last flush are written back. Data is loaded when the application asks
+    for it during initialization, or, in lazy mode, only the conversation states are: user and
+    chat data is then fetched when an update for that user or chat comes in.
+
     Args:
-        url (:obj:`str`) the postgresql database url.
+        engine (:class:`AsyncEngine`, optional): the engine to take connections from. Defaults to
+            the one shared with the ORM, see :func:`openpvz.db.get_engine`.
         on_flush (:obj:`bool`, optional): if set to :obj:`True` :class:`PostgresPersistence`
             will only update bot/chat/user data when :meth:flush is called.
+        write_behind (:obj:`bool`, optional): if set to :obj:`True` updates only mark the data as
+            changed, and a background task writes the changes in batches.
+            Takes precedence over ``on_flush``. :meth:flush drains everything that is left.
+        flush_interval (:obj:`float`, optional): how long, in seconds, the write-behind task
+            collects changes before writing them. Defaults to 0.5.
+        flush_batch_size (:obj:`int`, optional): amount of changed keys that triggers a write
+            before ``flush_interval`` has passed. Defaults to 100.
+        max_pending (:obj:`int`, optional): amount of changed keys not yet written after which
+            updates wait for the write-behind task to catch up. Defaults to 1000.
+        lazy (:obj:`bool`, optional): if set to :obj:`True` user_data and chat_data are loaded per
+            key on first access and kept in an LRU cache of ``cache_size`` entries.
+        cache_size (:obj:`int`, optional): amount of users and of chats kept in memory in lazy
+            mode. Entries with unsaved changes or used within the last two update intervals
+            are not evicted, so the cache may grow past it for a while. Defaults to 5000.
         **kwargs (:obj:`dict`): Arbitrary keyword Arguments to be passed to
             the DictPersistence constructor.
 
@@ -49,71 +75,370 @@ class PostgresPersistence(DictPersistence):
 
     def __init__(
         self,
-        url: str,
+        engine: AsyncEngine | None = None,
         on_flush: bool = False,
+        write_behind: bool = False,
+        flush_interval: float = 0.5,
+        flush_batch_size: int = 100,
+        max_pending: int = 1000,
+        lazy: bool = False,
+        cache_size: int = 5000,
         **kwargs: Any,
     ) -> None:
-        if url is None:
-            raise TypeError("You must need to provide either url or session.")
-
-        if not url.startswith("postgresql://"):
-            raise TypeError(f"{url} isn't a valid PostgreSQL database URL.")
-
-        self._connection = PersistentDbConnection(db_connection)
+        self._engine = engine if engine is not None else db.get_engine()
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
 
         self.logger = getLogger(__name__)
 
         self.on_flush = on_flush
-        self.logger.info("Loading persisted data...")
-        with self._acquire_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT data FROM telegram_bot_persistence")
-                data_ = cur.fetchone()
-                data = data_[0] if data_ is not None else {}
-
-                chat_data_json = data.get("chat_data", "")
-                user_data_json = data.get("user_data", "")
-                bot_data_json = data.get("bot_data", "")
-                conversations_json = data.get("conversations", "{}")
-                callback_data_json = data.get("callback_data_json", "")
-
-                self.logger.info("Persisted data loaded successfully!")
-
-                # if it is a fresh setup we'll add some placeholder data so we
-                # can perform `UPDATE` operations on it, cause SQL only allows
-                # `UPDATE` operations if column have some data already present inside it.
-                if not data:
-                    cur.execute("""
-                        INSERT INTO telegram_bot_persistence (data) VALUES (%s)
-                    """, ("{}",))
-
-                super().__init__(
-                    **kwargs,
-                    chat_data_json=chat_data_json,
-                    user_data_json=user_data_json,
-                    bot_data_json=bot_data_json,
-                    callback_data_json=callback_data_json,
-                    conversations_json=conversations_json,
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.max_pending = max(max_pending, flush_batch_size)
+        self._writer: asyncio.Task | None = None
+        self._writer_stopping = False
+        self._changes_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._batch_written = asyncio.Event()
+        self._dirty_user_ids: Set[int] = set()
+        self._dropped_user_ids: Set[int] = set()
+        self._dirty_chat_ids: Set[int] = set()
+        self._dropped_chat_ids: Set[int] = set()
+        self._dirty_conversations: Set[Tuple[str, ConversationKey]] = set()
+        self._dirty_bot_data = False
+        self._dirty_callback_data = False
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self._user_cache: LazyCache = OrderedDict()
+        self._chat_cache: LazyCache = OrderedDict()
+        # evicted keys whose dicts the application may still hand out or write to
+        self._evicted_user_ids: Set[int] = set()
+        self._evicted_chat_ids: Set[int] = set()
+
+        super().__init__(**kwargs)
+
+    async def _load(self) -> None:
+        async with self._load_lock:
+            if self._loaded:
+                return
+            self.logger.info("Loading persisted data...")
+            async with self._engine.connect() as conn:
+                if self.lazy:
+                    self._user_data = {}
+                    self._chat_data = {}
+                else:
+                    result = await conn.execute(text("SELECT user_id, data FROM telegram_bot_user_data"))
+                    self._user_data = {user_id: _decode_keys(data) for user_id, data in result}
+                    result = await conn.execute(text("SELECT chat_id, data FROM telegram_bot_chat_data"))
+                    self._chat_data = {chat_id: _decode_keys(data) for chat_id, data in result}
+                result = await conn.execute(text("SELECT name, key, state FROM telegram_bot_conversations"))
+                self._conversations = {}
+                for name, key, state in result:
+                    self._conversations.setdefault(name, {})[tuple(json.loads(key))] = state
+                result = await conn.execute(text("SELECT name, data FROM telegram_bot_data"))
+                named_data = dict(result.all())
+            self._bot_data = named_data.get(BOT_DATA)
+            callback_data = named_data.get(CALLBACK_DATA)
+            if callback_data is not None:
+                self._callback_data = (
+                    [(one, float(two), three) for one, two, three in callback_data[0]],
+                    callback_data[1],
                 )
+            self._loaded = True
+            self.logger.info(
+                "Persisted data loaded successfully: %s users, %s chats",
+                len(self._user_data), len(self._chat_data)
+            )
+
+    async def get_user_data(self) -> Dict[int, Dict[object, object]]:
+        await self._load()
+        return await super().get_user_data()
+
+    async def get_chat_data(self) -> Dict[int, Dict[object, object]]:
+        await self._load()
+        return await super().get_chat_data()
+
+    async def get_bot_data(self) -> Dict[object, object]:
+        await self._load()
+        return await super().get_bot_data()
+
+    async def get_callback_data(self) -> Optional[CDCData]:
+        await self._load()
+        return await super().get_callback_data()
+
+    async def get_conversations(self, name: str) -> Dict[ConversationKey, object]:
+        await self._load()
+        return await super().get_conversations(name)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        """In lazy mode fetches the user_data of a user that is not in memory yet.
+        Args:
+            user_id (:obj:`int`): The user ID this :attr:`user_data` is associated with.
+            user_data (:obj:`dict`): The ``user_data`` of a single user.
+        """
+        if self.lazy:
+            await self._refresh_lazily(
+                "telegram_bot_user_data", "user_id", user_id, user_data,
+                self._user_data, self._user_cache, self._dirty_user_ids, self._evicted_user_ids
+            )
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        """In lazy mode fetches the chat_data of a chat that is not in memory yet.
+        Args:
+            chat_id (:obj:`int`): The chat ID this :attr:`chat_data` is associated with.
+            chat_data (:obj:`dict`): The ``chat_data`` of a single chat.
+        """
+        if self.lazy:
+            await self._refresh_lazily(
+                "telegram_bot_chat_data", "chat_id", chat_id, chat_data,
+                self._chat_data, self._chat_cache, self._dirty_chat_ids, self._evicted_chat_ids
+            )
 
-    def _dump_into_json(self) -> Any:
-        """Dumps data into json format for inserting in db."""
-
-        to_dump = {
-            "chat_data": self.chat_data_json,
-            "user_data": self.user_data_json,
-            "bot_data": self.bot_data_json,
-            "conversations": self.conversations_json,
-            "callback_data": self.callback_data_json,
-        }
-        self.logger.debug("Dumping %s", to_dump)
-        return json.dumps(to_dump)
-
-    def _update_database(self) -> None:
+    async def _refresh_lazily(
+        self,
+        table: str,
+        key_column: str,
+        key: int,
+        target: Dict[Any, Any],
+        persisted: Dict[int, Dict[Any, Any]],
+        cache: LazyCache,
+        dirty: Set[int],
+        evicted: Set[int]
+    ) -> None:
+        if key not in cache:
+            async with self._engine.connect() as conn:
+                result = await conn.execute(
+                    text(f"SELECT data FROM {table} WHERE {key_column} = :key"), {"key": key}
+                )
+                data = result.scalar_one_or_none()
+            if data is not None and key not in persisted:
+                persisted[key] = _decode_keys(data)
+                if key in evicted:
+                    # whatever a job or handler still holding the evicted dict wrote into it
+                    # goes on top of the persisted data
+                    written = dict(target)
+                    target.clear()
+                    target.update(deepcopy(persisted[key]))
+                    target.update(written)
+                # never clobber what the application has put there in the meantime
+                elif not target:
+                    target.update(deepcopy(persisted[key]))
+            evicted.discard(key)
+        cache[key] = (time.monotonic(), target)
+        cache.move_to_end(key)
+        self._evict(persisted, cache, dirty, evicted)
+
+    async def get_user_ids_with_data(self, user_ids: Iterable[int]) -> Set[int]:
+        """The users among `user_ids` with any user_data, in memory or persisted. In lazy mode
+        an empty dict in memory may only mean the user's data was evicted from the cache."""
+        user_ids = set(user_ids)
+        with_data = {user_id for user_id in user_ids if (self._user_data or {}).get(user_id)}
+        unknown = list(user_ids - with_data - self._dirty_user_ids - self._dropped_user_ids)
+        if len(unknown) == 0:
+            return with_data
+        async with self._engine.connect() as conn:
+            result = await conn.execute(
+                text("SELECT user_id FROM telegram_bot_user_data WHERE user_id IN :ids AND data::text <> '{}'")
+                .bindparams(bindparam("ids", expanding=True)),
+                {"ids": unknown}
+            )
+            with_data.update(result.scalars())
+        return with_data
+
+    def _evict(
+        self, persisted: Dict[int, Dict[Any, Any]], cache: LazyCache, dirty: Set[int], evicted: Set[int]
+    ) -> None:
+        """Drops the least recently used entries, both here and in the application. The
+        application keeps the emptied dicts, so they are marked evicted and filled again
+        before they are handed out or written back."""
+        # the application hands changed data over only every update_interval seconds
+        recently = time.monotonic() - 2 * self.update_interval
+        while len(cache) > self.cache_size:
+            key, (accessed, target) = next(iter(cache.items()))
+            if accessed > recently or key in dirty:
+                return
+            del cache[key]
+            persisted.pop(key, None)
+            target.clear()
+            evicted.add(key)
+
+    def _pending_count(self) -> int:
+        return (
+            len(self._dirty_user_ids) + len(self._dropped_user_ids)
+            + len(self._dirty_chat_ids) + len(self._dropped_chat_ids)
+            + len(self._dirty_conversations)
+            + int(self._dirty_bot_data) + int(self._dirty_callback_data)
+        )
+
+    def _dump_rows(self, key_name: str, keys: Set[Any], data: Dict[Any, Any]) -> List[Dict[str, Any]]:
+        """Serializes the changed entries of user/chat data, skipping the ones that can't be dumped."""
+        rows = []
+        for key in keys:
+            if key not in data:
+                continue
+            try:
+                rows.append({key_name: key, "data": json.dumps(data[key])})
+            except TypeError:
+                self.logger.exception("Can't serialize persisted data for key %s", key)
+        return rows
+
+    def _collect_changes(self) -> _PendingChanges:
+        """Serializes everything changed since the last call and resets the change tracking."""
+        changes = _PendingChanges(
+            user_rows=self._dump_rows("user_id", self._dirty_user_ids, self._user_data or {}),
+            dropped_user_ids=list(self._dropped_user_ids),
+            chat_rows=self._dump_rows("chat_id", self._dirty_chat_ids, self._chat_data or {}),
+            dropped_chat_ids=list(self._dropped_chat_ids),
+            user_ids=self._dirty_user_ids | self._dropped_user_ids,
+            chat_ids=self._dirty_chat_ids | self._dropped_chat_ids,
+            conversations=self._dirty_conversations,
+            bot_data=self._dirty_bot_data,
+            callback_data=self._dirty_callback_data,
+        )
+        for name, key in self._dirty_conversations:
+            state = (self._conversations or {}).get(name, {}).get(key)
+            if state is None:
+                changes.conversation_deletes.append({"name": name, "key": json.dumps(key)})
+            else:
+                changes.conversation_rows.append({"name": name, "key": json.dumps(key), "state": json.dumps(state)})
+        if self._dirty_bot_data and self._bot_data is not None:
+            changes.named_rows.append({"name": BOT_DATA, "data": self.bot_data_json})
+        if self._dirty_callback_data and self._callback_data is not None:
+            changes.named_rows.append({"name": CALLBACK_DATA, "data": self.callback_data_json})
+
+        self._dirty_user_ids = set()
+        self._dropped_user_ids = set()
+        self._dirty_chat_ids = set()
+        self._dropped_chat_ids = set()
+        self._dirty_conversations = set()
+        self._dirty_bot_data = False
+        self._dirty_callback_data = False
+        return changes
+
+    def _restore_changes(self, changes: _PendingChanges) -> None:
+        """Marks the keys of a failed write as changed again, unless they were changed since."""
+        for user_id in changes.user_ids - self._dirty_user_ids - self._dropped_user_ids:
+            if self._user_data is not None and user_id in self._user_data:
+                self._dirty_user_ids.add(user_id)
+            else:
+                self._dropped_user_ids.add(user_id)
+        for chat_id in changes.chat_ids - self._dirty_chat_ids - self._dropped_chat_ids:
+            if self._chat_data is not None and chat_id in self._chat_data:
+                self._dirty_chat_ids.add(chat_id)
+            else:
+                self._dropped_chat_ids.add(chat_id)
+        self._dirty_conversations |= changes.conversations
+        self._dirty_bot_data = self._dirty_bot_data or changes.bot_data
+        self._dirty_callback_data = self._dirty_callback_data or changes.callback_data
+
+    async def _write_changes(self, changes: _PendingChanges) -> None:
         self.logger.debug("Updating database...")
-        with self._acquire_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("UPDATE telegram_bot_persistence SET data = %s", (self._dump_into_json(),))
+        async with self._engine.begin() as conn:
+            if changes.user_rows:
+                await conn.execute(text("""
+                    INSERT INTO telegram_bot_user_data (user_id, data) VALUES (:user_id, CAST(:data AS json))
+                    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data
+                """), changes.user_rows)
+            if changes.dropped_user_ids:
+                await conn.execute(
+                    text("DELETE FROM telegram_bot_user_data WHERE user_id IN :ids")
+                    .bindparams(bindparam("ids", expanding=True)),
+                    {"ids": changes.dropped_user_ids}
+                )
+            if changes.chat_rows:
+                await conn.execute(text("""
+                    INSERT INTO telegram_bot_chat_data (chat_id, data) VALUES (:chat_id, CAST(:data AS json))
+                    ON CONFLICT (chat_id) DO UPDATE SET data = EXCLUDED.data
+                """), changes.chat_rows)
+            if changes.dropped_chat_ids:
+                await conn.execute(
+                    text("DELETE FROM telegram_bot_chat_data WHERE chat_id IN :ids")
+                    .bindparams(bindparam("ids", expanding=True)),
+                    {"ids": changes.dropped_chat_ids}
+                )
+            if changes.conversation_rows:
+                await conn.execute(text("""
+                    INSERT INTO telegram_bot_conversations (name, key, state)
+                    VALUES (:name, :key, CAST(:state AS json))
+                    ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state
+                """), changes.conversation_rows)
+            if changes.conversation_deletes:
+                await conn.execute(
+                    text("DELETE FROM telegram_bot_conversations WHERE name = :name AND key = :key"),
+                    changes.conversation_deletes
+                )
+            if changes.named_rows:
+                await conn.execute(text("""
+                    INSERT INTO telegram_bot_data (name, data) VALUES (:name, CAST(:data AS json))
+                    ON CONFLICT (name) DO UPDATE SET data = EXCLUDED.data
+                """), changes.named_rows)
+        self.logger.debug(
+            "Persisted %s users, %s chats, %s conversations",
+            len(changes.user_ids), len(changes.chat_ids), len(changes.conversations)
+        )
+
+    async def _update_database(self) -> None:
+        if self._pending_count() == 0:
+            return
+        await self._write_changes(self._collect_changes())
+
+    async def _changed(self) -> None:
+        if self.write_behind:
+            await self._enqueue_write()
+        elif not self.on_flush:
+            await self.flush()
+
+    async def _enqueue_write(self) -> None:
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._run_writer())
+        self._changes_pending.set()
+        if self._pending_count() >= self.flush_batch_size:
+            self._batch_full.set()
+        # backpressure: don't let changes pile up faster than the database takes them
+        while self._pending_count() >= self.max_pending and not self._writer_stopping:
+            self._batch_full.set()
+            self._batch_written.clear()
+            await self._batch_written.wait()
+
+    async def _run_writer(self) -> None:
+        while True:
+            await self._changes_pending.wait()
+            if not self._writer_stopping:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            if self._writer_stopping:
+                return
+            self._changes_pending.clear()
+            self._batch_full.clear()
+            await self._write_pending()
+
+    async def _write_pending(self) -> None:
+        changes = self._collect_changes()
+        try:
+            await self._write_changes(changes)
+        except Exception:
+            self.logger.exception("Failed to persist changes, will retry")
+            self._restore_changes(changes)
+            self._changes_pending.set()
+            await asyncio.sleep(self.flush_interval)
+        finally:
+            self._batch_written.set()
+
+    async def _stop_writer(self) -> None:
+        if self._writer is None:
+            return
+        self._writer_stopping = True
+        self._changes_pending.set()
+        self._batch_full.set()
+        self._batch_written.set()
+        try:
+            await self._writer
+        finally:
+            self._writer = None
+            self._writer_stopping = False
 
     async def update_conversation(
         self, name: str, key: Tuple[int, ...], new_state: Optional[object]
@@ -125,9 +450,11 @@ class PostgresPersistence(DictPersistence):
             key (:obj:`tuple`): The key the state is changed for.
             new_state (:obj:`tuple` | :obj:`any`): The new state for the given key.
         """
+        if self._conversations and self._conversations.get(name, {}).get(key) == new_state:
+            return
         await super().update_conversation(name, key, new_state)
-        if not self.on_flush:
-            await self.flush()
+        self._dirty_conversations.add((name, key))
+        await self._changed()
 
     async def update_user_data(self, user_id: int, data: Dict) -> None:
         """Will update the user_data (if changed).
@@ -135,9 +462,15 @@ class PostgresPersistence(DictPersistence):
             user_id (:obj:`int`): The user the data might have been changed for.
             data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.user_data` ``[user_id]``.
         """
+        if user_id in self._evicted_user_ids:
+            # written to after eviction, the rest of the data has to be loaded before it's saved
+            await self.refresh_user_data(user_id, data)
+        if self._user_data is not None and self._user_data.get(user_id) == data:
+            return
         await super().update_user_data(user_id, data)
-        if not self.on_flush:
-            await self.flush()
+        self._dirty_user_ids.add(user_id)
+        self._dropped_user_ids.discard(user_id)
+        await self._changed()
 
     async def update_chat_data(self, chat_id: int, data: Dict) -> None:
         """Will update the chat_data (if changed).
@@ -145,18 +478,25 @@ class PostgresPersistence(DictPersistence):
             chat_id (:obj:`int`): The chat the data might have been changed for.
             data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.chat_data` ``[chat_id]``.
         """
+        if chat_id in self._evicted_chat_ids:
+            await self.refresh_chat_data(chat_id, data)
+        if self._chat_data is not None and self._chat_data.get(chat_id) == data:
+            return
         await super().update_chat_data(chat_id, data)
-        if not self.on_flush:
-            await self.flush()
+        self._dirty_chat_ids.add(chat_id)
+        self._dropped_chat_ids.discard(chat_id)
+        await self._changed()
 
     async def update_bot_data(self, data: Dict) -> None:
         """Will update the bot_data (if changed).
         Args:
             data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.bot_data`.
         """
+        if self._bot_data == data:
+            return
         await super().update_bot_data(data)
-        if not self.on_flush:
-            await self.flush()
+        self._dirty_bot_data = True
+        await self._changed()
 
     async def update_callback_data(self, data: CDCData) -> None:
         """Will update the callback_data (if changed).
@@ -166,17 +506,54 @@ class PostgresPersistence(DictPersistence):
                 Dict[:obj:`str`, :obj:`str`]]): The relevant data to restore
                 :class:`telegram.ext.CallbackDataCache`.
         """
+        if self._callback_data == data:
+            return
         await super().update_callback_data(data)
-        if not self.on_flush:
-            await self.flush()
+        self._dirty_callback_data = True
+        await self._changed()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        """Will delete the specified key from the user_data.
+        Args:
+            user_id (:obj:`int`): The user id to delete from the persistence.
+        """
+        await super().drop_user_data(user_id)
+        self._user_cache.pop(user_id, None)
+        self._evicted_user_ids.discard(user_id)
+        self._dirty_user_ids.discard(user_id)
+        self._dropped_user_ids.add(user_id)
+        await self._changed()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        """Will delete the specified key from the chat_data.
+        Args:
+            chat_id (:obj:`int`): The chat id to delete from the persistence.
+        """
+        await super().drop_chat_data(chat_id)
+        self._chat_cache.pop(chat_id, None)
+        self._evicted_chat_ids.discard(chat_id)
+        self._dirty_chat_ids.discard(chat_id)
+        self._dropped_chat_ids.add(chat_id)
+        await self._changed()
 
     async def flush(self) -> None:
         """Will be called by :class:`telegram.ext.Updater` upon receiving a stop signal. Gives the
         persistence a chance to finish up saving or close a database connection gracefully.
+        In write-behind mode stops the background task and writes everything that is left.
         """
-        self._update_database()
+        if self.write_behind:
+            await self._stop_writer()
+        await self._update_database()
         if not self.on_flush:
             self.logger.debug("Context persisted!")
 
-    def _acquire_db_connection(self):
-        return self._connection.acquire()
+
+def _decode_keys(data: Dict[str, Any]) -> Dict[Any, Any]:
+    """json turns every key into a string, this restores the integer ones like DictPersistence does."""
+    decoded = {}
+    for key, value in data.items():
+        try:
+            decoded[int(key)] = value
+        except ValueError:
+            decoded[key] = value
+    return decoded
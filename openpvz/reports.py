@@ -1,61 +1,328 @@
+import asyncio
+import csv
+import gzip
+import hashlib
+import io
+import os
 import tempfile
-from models import Office, User
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from openpvz import db
+from openpvz import repository
+from openpvz.cache_stats import CacheStats
+from openpvz.models import Office, UserRole
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List
-from repository import get_report_notifications
-from datetime import datetime, timedelta
-from telegram import Update
-from context import BotContext
+from openpvz.repository import stream_watches, stream_owner_activity
+from openpvz.time_utils import timezone_by_name, utc_now
+from datetime import date, datetime, timedelta
+from telegram import Bot, Message, Update
+from telegram.error import BadRequest, TelegramError
+from openpvz.context import BotContext
+from openpvz.sender import outbound, reply
 from io import TextIOWrapper
-from keyboards import main_menu
+from typing import Awaitable, BinaryIO, Callable, Generic, List, Set, Tuple, TypeVar
+from openpvz.keyboards import main_menu
+import openpvz.strings as s
 from logging import getLogger
-from utils import first
 
 
 _logger = getLogger(__name__)
 
 
+REPORT_DAYS = 30
+# threads that format reports, so that the event loop keeps serving updates meanwhile
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', 2))
+REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', 256))  # reports
+FILE_ID_CACHE_SIZE = int(os.getenv('FILE_ID_CACHE_SIZE', 1024))  # documents
+# bytes of an export kept in memory, a larger one is moved to a temporary file
+EXPORT_SPOOL_SIZE = int(os.getenv('EXPORT_SPOOL_SIZE', 1024 * 1024))
+EXPORT_BATCH_SIZE = 1000  # rows
+PROGRESS_INTERVAL = 5  # seconds
+
+_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="reports")
+
+# (office id, first local day, last local day, activity version of the office)
+ReportKey = Tuple[int, date, date, int]
+# (file name, sha256 of the content)
+DocumentKey = Tuple[str, str]
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+class LruCache(Generic[K, V]):
+    def __init__(self, name: str, max_size: int) -> None:
+        self.name = name
+        self.max_size = max_size
+        self.stats = CacheStats(name, lambda: len(self._entries))
+        self._entries: OrderedDict[K, V] = OrderedDict()
+
+    def get(self, key: K) -> V | None:
+        value = self._entries.get(key)
+        if value is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: K) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries = OrderedDict()
+
+
+# finished watches reports. Whatever changes the activity of an office's users bumps its
+# activity_version, which is part of the key, so an entry is never served stale. Old entries
+# are only evicted when the cache is full
+report_cache: LruCache[ReportKey, bytes] = LruCache("Report cache", REPORT_CACHE_SIZE)
+# Telegram file ids of the documents sent, an unchanged document is sent again without uploading it
+file_id_cache: LruCache[DocumentKey, str] = LruCache("File id cache", FILE_ID_CACHE_SIZE)
+
+# (chat id, office id or None for an export) being prepared, one at a time
+_running: Set[Tuple[int, int | None]] = set()
+
+
 async def create_and_send_watches_report(office: Office, update: Update, context: BotContext):
-    to = datetime.utcnow()
-    since = to - timedelta(days=30)
-    prefix = f'{office.name}{to.strftime("%Y%m%d")}'
-    with tempfile.TemporaryFile("r+", prefix=prefix, suffix=".csv", encoding='utf-8') as fpw:
-        await create_report(fpw, office, since, to, context.session)
+    """Sends a cached report right away, otherwise builds it in the background and sends
+    it when it's ready."""
+    chat_id = update.effective_chat.id
+    to = utc_now()
+    since = to - timedelta(days=REPORT_DAYS)
+    timezone = timezone_by_name(office.timezone)
+    first_day = since.astimezone(timezone).date()
+    last_day = to.astimezone(timezone).date()
+    key = (office.id, first_day, last_day, office.activity_version)
+    filename = f'{office.name}{to.strftime("%Y%m%d")}.csv'
+    content = report_cache.get(key)
+    if content is not None:
+        await _send_report(context.bot, chat_id, content, filename, context.user.role)
+        return
+    if not _start(chat_id, office.id):
+        await reply(update, context, text=s.REPORT_IN_PROGRESS, reply_markup=main_menu(context.user.role))
+        return
+    await reply(update, context, text=s.REPORT_STARTED, reply_markup=main_menu(context.user.role))
+    context.application.create_task(
+        _build_and_send_watches_report(key, filename, chat_id, context.user.role, context.bot))
+
+
+async def _build_and_send_watches_report(key: ReportKey, filename: str, chat_id: int, role: UserRole, bot: Bot):
+    office_id, first_day, last_day, _ = key
+    try:
+        async with db.begin() as session:
+            office = await repository.get_office(office_id, session)
+            if office is None:
+                return
+            # the rows are read after the version, so they are at least as new as it says
+            key = (office_id, first_day, last_day, office.activity_version)
+            rows = [tuple(row) async for row in await stream_watches(office, first_day, last_day, session)]
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(_executor, create_report, first_day, last_day, rows)
+        report_cache.put(key, content)
         _logger.info("Report created")
-        fpw.seek(0)
-        await context.bot.send_document(
-            update.effective_chat.id,
-            fpw,
-            filename=f'{prefix}.csv',
-            reply_markup=main_menu(context.user.role)
-        )
-        _logger.info("Document sent")
-
-
-async def create_report(file: TextIOWrapper, office: Office, since: datetime, to: datetime, session: AsyncSession):
-    owner = await office.awaitable_attrs.owner
-    employees: List[User] = list(await owner.awaitable_attrs.employees)
-    notifications = list(await get_report_notifications(office, since, to, session))
-    d = since
-    dates: List[datetime] = []
-    while d <= to:
-        dates.append(d.date())
-        d += timedelta(days=1)
-
-    header = ','.join(['Дата', *list(map(lambda d: d.strftime("%m.%d"), dates))])
-    file.write(f"{header}\n")
-
-    rows = {e.id: {d.strftime("%m.%d"): 0 for d in dates} for e in employees}
-    for n in notifications:
-        rows[n.source_user_id][n.created_at.strftime("%m.%d")] += 1 #TODO timezone
-    
-    keys_to_delete = []
-    for key, _row in list(rows.items()):
-        if not any(list(_row.values())):
-            keys_to_delete.append(key)
-    for k in keys_to_delete:
-        del rows[k]
-    
-    for key, _row in list(rows.items()):
-        row = [first(employees, lambda e: e.id == key).name, *list(map(lambda v: str(v) if v > 0 else "", list(_row.values())))]
-        file.write(f"{','.join(row)}\n")
+        await _send_report(bot, chat_id, content, filename, role)
+    except Exception:
+        _logger.exception(f"Failed to create the watches report of office {office_id}")
+        await _report_failed(bot, chat_id, role)
+    finally:
+        _running.discard((chat_id, office_id))
+
+
+def create_report(first_day: date, last_day: date, rows: List[Tuple[int, str, date, int]]) -> bytes:
+    """Csv with a row per user and a column per day from (user id, user name, local date,
+    count) rows ordered by user."""
+    columns = {first_day + timedelta(days=i): i for i in range((last_day - first_day).days + 1)}
+    file = io.StringIO()
+    writer = csv.writer(file, lineterminator="\n")
+    writer.writerow(['Дата', *(d.strftime("%m.%d") for d in columns)])
+
+    last_user_id, name, counts = None, None, None
+    for user_id, user_name, day, count in rows:
+        if user_id != last_user_id:
+            if counts is not None:
+                writer.writerow([name, *counts])
+            last_user_id, name, counts = user_id, user_name, [""] * len(columns)
+        column = columns.get(day)
+        if column is not None:
+            counts[column] = str(count)
+    if counts is not None:
+        writer.writerow([name, *counts])
+    return file.getvalue().encode('utf-8')
+
+
+async def create_and_send_export(first_day: date, last_day: date, compress: bool, update: Update, context: BotContext):
+    chat_id = update.effective_chat.id
+    if not _start(chat_id, None):
+        await reply(update, context, text=s.REPORT_IN_PROGRESS, reply_markup=main_menu(context.user.role))
+        return
+    await reply(update, context, text=s.REPORT_STARTED, reply_markup=main_menu(context.user.role))
+    context.application.create_task(
+        _build_and_send_export(context.user.id, first_day, last_day, compress, chat_id, context.user.role, context.bot))
+
+
+async def _build_and_send_export(
+    owner_id: int,
+    first_day: date,
+    last_day: date,
+    compress: bool,
+    chat_id: int,
+    role: UserRole,
+    bot: Bot
+):
+    filename = f'{first_day.strftime("%Y%m%d")}-{last_day.strftime("%Y%m%d")}.csv'
+    if compress:
+        filename += '.gz'
+    progress = _Progress(bot, chat_id)
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as file:
+            async with db.begin() as session:
+                await export_activity(file, owner_id, first_day, last_day, compress, session, progress.update)
+            _logger.info(f"Export of {file.tell()} bytes created")
+            file.seek(0)
+            await _send_report(bot, chat_id, file, filename, role)
+    except Exception:
+        _logger.exception(f"Failed to export the offices of owner {owner_id}")
+        await _report_failed(bot, chat_id, role)
+    finally:
+        _running.discard((chat_id, None))
+
+
+async def export_activity(
+    file: BinaryIO,
+    owner_id: int,
+    first_day: date,
+    last_day: date,
+    compress: bool,
+    session: AsyncSession,
+    on_progress: Callable[[int], Awaitable[None]] | None = None
+):
+    """Writes the daily activity of all the owner's offices as csv, gzipped if `compress`.
+    Rows are written in batches as they come from the database, `file` is left open."""
+    # no timestamp in the header, so that the same export is the same file and is not uploaded again
+    output = gzip.GzipFile(fileobj=file, mode="wb", mtime=0) if compress else file
+    text = TextIOWrapper(output, encoding='utf-8', newline='')
+    loop = asyncio.get_running_loop()
+    try:
+        writer = csv.writer(text, lineterminator="\n")
+        writer.writerow([
+            'Пункт', 'Сотрудник', 'Дата', 'Открыт', 'Закрыт', 'Открытий', 'Закрытий',
+            'Опоздание, мин', 'Не открыт вовремя', 'Не закрыт вовремя'
+        ])
+        written = 0
+        result = await stream_owner_activity(owner_id, first_day, last_day, session, EXPORT_BATCH_SIZE)
+        async for rows in result.partitions():
+            # one batch at a time, the writer is never used by two threads at once
+            await loop.run_in_executor(_executor, _write_export_rows, writer, rows)
+            written += len(rows)
+            if on_progress is not None:
+                await on_progress(written)
+        text.flush()
+    finally:
+        # leaves `output` open
+        text.detach()
+        if compress:
+            # writes the gzip trailer, `file` stays open
+            output.close()
+
+
+def _write_export_rows(writer, rows: List[tuple]) -> None:
+    writer.writerows(_export_row(*row) for row in rows)
+
+
+def _export_row(
+    office_name: str,
+    user_name: str | None,
+    day: date,
+    first_opened_at: datetime | None,
+    last_closed_at: datetime | None,
+    opened_count: int,
+    closed_count: int,
+    minutes_late: int | None,
+    not_opened_late: bool,
+    not_closed_late: bool
+) -> list:
+    return [
+        office_name,
+        user_name or "",
+        day.strftime("%d.%m.%Y"),
+        first_opened_at.strftime("%H:%M") if first_opened_at is not None else "",
+        last_closed_at.strftime("%H:%M") if last_closed_at is not None else "",
+        opened_count or "",
+        closed_count or "",
+        minutes_late if minutes_late is not None else "",
+        "да" if not_opened_late else "",
+        "да" if not_closed_late else "",
+    ]
+
+
+class _Progress:
+    """A message with the number of rows written, sent once an export takes a while and
+    edited at most every PROGRESS_INTERVAL."""
+
+    def __init__(self, bot: Bot, chat_id: int) -> None:
+        self._bot = bot
+        self._chat_id = chat_id
+        self._message: Message | None = None
+        self._next_at = time.monotonic() + PROGRESS_INTERVAL
+
+    async def update(self, rows: int) -> None:
+        now = time.monotonic()
+        if now < self._next_at:
+            return
+        self._next_at = now + PROGRESS_INTERVAL
+        text = f"{s.EXPORT_PROGRESS} {rows}"
+        try:
+            if self._message is None:
+                self._message = await outbound.send(self._bot, self._chat_id, 'send_message', text=text)
+            else:
+                await outbound.send(
+                    self._bot, self._chat_id, 'edit_message_text', message_id=self._message.message_id, text=text)
+        except TelegramError as e:
+            _logger.warning(f"Failed to report progress to chat {self._chat_id}: {e}")
+
+
+def _start(chat_id: int, office_id: int | None) -> bool:
+    if (chat_id, office_id) in _running:
+        return False
+    _running.add((chat_id, office_id))
+    return True
+
+
+async def _send_report(bot: Bot, chat_id: int, content: bytes | BinaryIO, filename: str, role: UserRole):
+    key = (filename, await asyncio.get_running_loop().run_in_executor(_executor, _digest, content))
+    file_id = file_id_cache.get(key)
+    if file_id is not None:
+        try:
+            await outbound.send(bot, chat_id, 'send_document', document=file_id, reply_markup=main_menu(role))
+            _logger.info("Document sent again")
+            return
+        except BadRequest as e:
+            _logger.warning(f"Failed to send file {file_id} again, uploading it: {e}")
+            file_id_cache.invalidate(key)
+    message = await outbound.send(
+        bot, chat_id, 'send_document', document=content, filename=filename, reply_markup=main_menu(role))
+    file_id_cache.put(key, message.document.file_id)
+    _logger.info("Document sent")
+
+
+def _digest(content: bytes | BinaryIO) -> str:
+    if isinstance(content, bytes):
+        return hashlib.sha256(content).hexdigest()
+    digest = hashlib.sha256()
+    content.seek(0)
+    while chunk := content.read(64 * 1024):
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+async def _report_failed(bot: Bot, chat_id: int, role: UserRole):
+    outbound.send_message(bot, chat_id, text=s.REPORT_FAILED, reply_markup=main_menu(role))
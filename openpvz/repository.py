@@ -1,20 +1,40 @@
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from sqlalchemy.orm import joinedload
-from openpvz.models import User, UserRole, Office, WorkingHours, Notification
+from sqlalchemy.ext.asyncio import AsyncResult, AsyncSession
+from sqlalchemy import select, delete, update, union, func, cast, tuple_, DateTime
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.dialects.postgresql import insert
+from geoalchemy2 import Geography
+from openpvz.models import (
+    User, UserRole, Office, WorkingHours, Notification, LatenessNotificationDay, DailyOfficeActivity, PendingUser
+)
 from openpvz.utils import Location
 from openpvz.consts import OfficeStatus, NotificationCodes
-from typing import List, Tuple
-from datetime import datetime, timedelta
-import pytz
-from openpvz.time_utils import tz_today, date_to_tz_datetime
+from typing import Iterable, List, Set, Tuple
+from datetime import date, datetime
+from openpvz.user_cache import user_cache
+from openpvz.geofence import MAX_GEOFENCE_RADIUS
 
 
 def create_user(user: User, session: AsyncSession) -> User:
     session.add(user)
+    user_cache.user_changed(user)
     return user
 
 
+async def delete_user(user: User, session: AsyncSession) -> None:
+    user_cache.user_deleted(user)
+    # the user's activity goes along with them
+    await session.execute(
+        update(Office)
+        .where(Office.id.in_(select(DailyOfficeActivity.office_id).where(DailyOfficeActivity.user_id == user.id)))
+        .values(activity_version=Office.activity_version + 1))
+    await session.delete(user)
+
+
+def location_point(location: Location):
+    """The location as a geography, PostGIS takes the longitude first."""
+    return cast(func.ST_SetSRID(func.ST_Point(location.longitude, location.latitude), 4326), Geography)
+
+
 def create_office(
     name: str,
     location: Location,
@@ -25,7 +45,7 @@ def create_office(
 ) -> Office:
     office = Office(
         name=name,
-        location=func.ST_Point(location.latitude, location.longitude),
+        location=location_point(location),
         working_hours=working_hours,
         owner_id=owner.id,
         timezone=timezone
@@ -42,9 +62,29 @@ async def get_office(id: int, session: AsyncSession) -> Office | None:
     return await session.get(Office, id)
 
 
-async def all_offices_with_working_hours(session: AsyncSession) -> List[Office]:
-    result = await session.execute(select(Office).options(joinedload(Office.working_hours)))
-    return result.unique().scalars().all()
+async def get_offices_with_owners(ids: Iterable[int], session: AsyncSession) -> List[Office]:
+    result = await session.execute(
+        select(Office)
+        .where(Office.id.in_(list(ids)))
+        .options(joinedload(Office.owner)))
+    return result.scalars().all()
+
+
+async def get_offices_with_working_hours(
+    session: AsyncSession,
+    ids: Iterable[int] | None = None,
+    owner_id: int | None = None
+) -> List[Tuple[Office, float, float]]:
+    """Offices with their working hours loaded, and the longitude and latitude of their location.
+    All offices if no filter is given."""
+    point = func.geometry(Office.location)
+    stmt = select(Office, func.ST_X(point), func.ST_Y(point)).options(selectinload(Office.working_hours))
+    if ids is not None:
+        stmt = stmt.where(Office.id.in_(list(ids)))
+    if owner_id is not None:
+        stmt = stmt.where(Office.owner_id == owner_id)
+    result = await session.execute(stmt)
+    return result.tuples().all()
 
 
 async def get_user_by_chat_id(chat_id: int, session: AsyncSession) -> User | None:
@@ -52,82 +92,261 @@ async def get_user_by_chat_id(chat_id: int, session: AsyncSession) -> User | Non
     return result.scalar_one_or_none()
 
 
+async def get_cached_user_by_chat_id(chat_id: int, session: AsyncSession) -> User | None:
+    found, cached = user_cache.get(chat_id)
+    if found:
+        return cached.attach(session) if cached is not None else None
+    user = await get_user_by_chat_id(chat_id, session)
+    user_cache.put(chat_id, user)
+    return user
+
+
+async def get_chat_id(user_id: int, session: AsyncSession) -> int | None:
+    result = await session.execute(select(User.chat_id).where(User.id == user_id))
+    return result.scalar_one_or_none()
+
+
+async def get_employees(owner_id: int, role: UserRole, session: AsyncSession) -> List[User]:
+    result = await session.execute(
+        select(User)
+        .where(User.owner_id == owner_id)
+        .where(User.role == role)
+        .order_by(User.id))
+    return result.scalars().all()
+
+
+async def get_registered_chat_ids(chat_ids: Iterable[int], session: AsyncSession) -> Set[int]:
+    result = await session.execute(select(User.chat_id).where(User.chat_id.in_(list(chat_ids))))
+    return set(result.scalars().all())
+
+
+async def get_taken_names(names: Iterable[str], session: AsyncSession) -> Set[str]:
+    """The names among `names` of users and pending users."""
+    names = list(names)
+    result = await session.execute(union(
+        select(User.name).where(User.name.in_(names)),
+        select(PendingUser.name).where(PendingUser.name.in_(names))))
+    return set(result.scalars().all())
+
+
+async def create_pending_users(
+    owner_id: int,
+    role: UserRole,
+    names: List[str],
+    session: AsyncSession,
+    batch_size: int = 500
+) -> List[Tuple[int, str]]:
+    """Inserts a pending user for each name, `batch_size` rows per statement. Returns their
+    (id, name) pairs."""
+    created = []
+    for i in range(0, len(names), batch_size):
+        result = await session.execute(
+            insert(PendingUser)
+            .values([{"owner_id": owner_id, "role": role, "name": name} for name in names[i:i + batch_size]])
+            .returning(PendingUser.id, PendingUser.name))
+        created.extend(result.tuples().all())
+    return created
+
+
+async def get_pending_user(id: int, session: AsyncSession) -> PendingUser | None:
+    """The pending user, locked until the end of the transaction."""
+    return await session.get(PendingUser, id, with_for_update=True)
+
+
+async def delete_pending_user(pending_user: PendingUser, session: AsyncSession) -> None:
+    await session.delete(pending_user)
+
+
+async def delete_pending_users_created_before(before: datetime, session: AsyncSession) -> int:
+    result = await session.execute(delete(PendingUser).where(PendingUser.created_at < before))
+    return result.rowcount
+
+
 def update_role(user: User, role: UserRole):
     user.role = role
+    user_cache.user_changed(user)
 
 
 def update_owner_id(user: User, owner_id: int):
     user.owner_id = owner_id
+    user_cache.user_changed(user)
 
 
 async def get_closest_office(location: Location, owner_id: int, session: AsyncSession) -> Office | None:
-    max_distance = 100  # meters
-    offices = await session.execute(
+    """The nearest office of the owner whose geofence contains `location`."""
+    point = location_point(location)
+    # the constant radius lets ST_DWithin use the gist index, <-> orders the candidates by distance.
+    # Measured on the sphere, like the geofences of the office cache
+    result = await session.execute(
         select(Office)
-        .where(func.ST_DWithin(
-            Office.location, func.ST_Point(location.latitude, location.longitude), max_distance))
+        .where(func.ST_DWithin(Office.location, point, MAX_GEOFENCE_RADIUS, False))
+        .where(func.ST_DWithin(Office.location, point, Office.geofence_radius, False))
         .where(Office.owner_id == owner_id)
-        .order_by(func.ST_Distance(Office.location, func.ST_Point(location.latitude, location.longitude))))
-    all_offices = list(offices.scalars().all())
-    return all_offices[0] if len(all_offices) > 0 else None
+        .order_by(Office.location.distance_centroid(point))
+        .limit(1))
+    return result.scalar_one_or_none()
 
 
-def office_doors_event(office: Office, office_status: OfficeStatus, user_id: int | None, session: AsyncSession):
+def update_geofence_radius(office: Office, radius: int):
+    office.geofence_radius = radius
+
+
+async def office_doors_event(
+    office: Office,
+    office_status: OfficeStatus,
+    user_id: int | None,
+    local_date: date,
+    minutes_late: int | None,
+    session: AsyncSession
+):
     match office_status:
         case OfficeStatus.CLOSING:
             code = NotificationCodes.office_closed
+            activity = {"last_closed_at": func.now(), "closed_count": 1}
         case OfficeStatus.OPENING:
             code = NotificationCodes.office_opened
+            activity = {"first_opened_at": func.now(), "opened_count": 1, "minutes_late": minutes_late}
         case _:
             raise Exception(f"Unknown office status: {office_status}")
+    bump_activity_version(office)
     session.add(Notification(
         code=code,
         office_id=office.id,
         source_user_id=user_id
     ))
+    await add_office_activity(office.id, user_id, local_date, session, **activity)
 
 
-async def check_not_open_notification_today(office: Office, session: AsyncSession) -> bool:
-    return await already_notified(office, NotificationCodes.office_not_opened_late, session)
-
-
-async def check_not_closed_notification_today(office: Office, session: AsyncSession) -> bool:
-    return await already_notified(office, NotificationCodes.office_not_closed_late, session)
-
-
-async def already_notified(
+async def add_lateness_notification(
     office: Office,
     code: NotificationCodes,
+    local_date: date,
     session: AsyncSession
 ) -> bool:
-    start_time, end_time = _get_utc_date_border(pytz.timezone(office.timezone))
+    """Inserts the notification unless the office already got one with this code on
+    `local_date`, possibly from another replica. Returns whether it was inserted."""
     result = await session.execute(
-        select(Notification)
-        .where(Notification.office_id == office.id)
-        .where(Notification.code == code)
-        .where(Notification.created_at >= start_time)
-        .where(Notification.created_at < end_time))
-    return result.first() is not None
+        insert(LatenessNotificationDay)
+        .values(office_id=office.id, code=code, local_date=local_date)
+        .on_conflict_do_nothing()
+        .returning(LatenessNotificationDay.office_id))
+    if result.scalar_one_or_none() is None:
+        return False
+    session.add(Notification(code=code, office_id=office.id, local_date=local_date))
+    if code == NotificationCodes.office_not_opened_late:
+        await add_office_activity(office.id, None, local_date, session, not_opened_late=True)
+    else:
+        await add_office_activity(office.id, None, local_date, session, not_closed_late=True)
+    return True
+
+
+def bump_activity_version(office: Office) -> None:
+    """Marks the activity of the office's users changed. Part of the office's UPDATE, which
+    also orders the versions of concurrent changes."""
+    office.activity_version = Office.activity_version + 1
+
 
+async def add_office_activity(
+    office_id: int,
+    user_id: int | None,
+    local_date: date,
+    session: AsyncSession,
+    **activity
+):
+    """Adds an event to the office's day in `daily_office_activity`, creating the row if needed.
+    `activity` holds the row's columns as they would be for this event alone."""
+    stmt = insert(DailyOfficeActivity).values(
+        office_id=office_id, user_id=user_id, local_date=local_date, **activity)
+    row, new = DailyOfficeActivity, stmt.excluded
+    await session.execute(stmt.on_conflict_do_update(
+        constraint='daily_office_activity_office_user_date',
+        set_={
+            # LEAST and GREATEST skip nulls
+            "first_opened_at": func.least(row.first_opened_at, new.first_opened_at),
+            "last_closed_at": func.greatest(row.last_closed_at, new.last_closed_at),
+            "opened_count": row.opened_count + new.opened_count,
+            "closed_count": row.closed_count + new.closed_count,
+            "minutes_late": func.coalesce(row.minutes_late, new.minutes_late),
+            "not_opened_late": row.not_opened_late | new.not_opened_late,
+            "not_closed_late": row.not_closed_late | new.not_closed_late,
+        }))
 
-def _get_utc_date_border(timezone: pytz.BaseTzInfo) -> Tuple[datetime, datetime]:
-    today = tz_today(timezone)
-    today_datetime = date_to_tz_datetime(today, timezone)
-    start_time = today_datetime.astimezone(pytz.utc)
-    end_time = start_time + timedelta(days=1)
-    return (start_time, end_time)
+
+async def get_notified_on(
+    office_days: Iterable[Tuple[int, date]],
+    codes: Iterable[NotificationCodes],
+    session: AsyncSession
+) -> Set[Tuple[int, date, str]]:
+    """(office_id, local date, code) of the lateness notifications sent on the given local
+    days of the offices."""
+    codes = list(codes)
+    result = await session.execute(
+        select(
+            DailyOfficeActivity.office_id,
+            DailyOfficeActivity.local_date,
+            DailyOfficeActivity.not_opened_late,
+            DailyOfficeActivity.not_closed_late)
+        .select_from(DailyOfficeActivity)
+        .where(tuple_(DailyOfficeActivity.office_id, DailyOfficeActivity.local_date).in_(list(office_days)))
+        .where(DailyOfficeActivity.user_id.is_(None)))
+    notified = set()
+    for office_id, local_date, not_opened_late, not_closed_late in result.tuples():
+        if not_opened_late and NotificationCodes.office_not_opened_late in codes:
+            notified.add((office_id, local_date, NotificationCodes.office_not_opened_late))
+        if not_closed_late and NotificationCodes.office_not_closed_late in codes:
+            notified.add((office_id, local_date, NotificationCodes.office_not_closed_late))
+    return notified
 
 
-async def get_report_notifications(
+async def stream_watches(
     office: Office,
-    since: datetime,
-    to: datetime,
+    first_day: date,
+    last_day: date,
     session: AsyncSession
-) -> List[Notification]:
-    stmt = (select(Notification)
-        .where(Notification.office_id == office.id)
-        .where(Notification.code == NotificationCodes.office_opened)
-        .where(Notification.created_at >= since)
-        .where(Notification.created_at < to))
-    result = await session.execute(stmt)
-    return result.scalars().all()
+) -> AsyncResult[Tuple[int, str, date, int]]:
+    """How many times each user opened the office on each of its local days from `first_day`
+    to `last_day`, as (user id, user name, local date, count) rows ordered by user and date."""
+    return await session.stream(
+        select(User.id, User.name, DailyOfficeActivity.local_date, DailyOfficeActivity.opened_count)
+        .select_from(DailyOfficeActivity)
+        .join(User, User.id == DailyOfficeActivity.user_id)
+        .where(DailyOfficeActivity.office_id == office.id)
+        .where(DailyOfficeActivity.local_date >= first_day)
+        .where(DailyOfficeActivity.local_date <= last_day)
+        .where(DailyOfficeActivity.opened_count > 0)
+        .order_by(User.name, User.id, DailyOfficeActivity.local_date))
+
+
+async def stream_owner_activity(
+    owner_id: int,
+    first_day: date,
+    last_day: date,
+    session: AsyncSession,
+    batch_size: int = 1000
+) -> AsyncResult[Tuple[str, str | None, date, datetime | None, datetime | None, int, int, int | None, bool, bool]]:
+    """Daily activity in all the owner's offices on their local days from `first_day` to
+    `last_day`, ordered by office and date, office-wide rows first. Times are local, rows are
+    fetched from a server-side cursor `batch_size` at a time."""
+    def local(column):
+        return func.timezone(Office.timezone, func.timezone('UTC', column), type_=DateTime)
+
+    return await session.stream(
+        select(
+            Office.name,
+            User.name,
+            DailyOfficeActivity.local_date,
+            local(DailyOfficeActivity.first_opened_at),
+            local(DailyOfficeActivity.last_closed_at),
+            DailyOfficeActivity.opened_count,
+            DailyOfficeActivity.closed_count,
+            DailyOfficeActivity.minutes_late,
+            DailyOfficeActivity.not_opened_late,
+            DailyOfficeActivity.not_closed_late)
+        .select_from(DailyOfficeActivity)
+        .join(Office, Office.id == DailyOfficeActivity.office_id)
+        .outerjoin(User, User.id == DailyOfficeActivity.user_id)
+        .where(Office.owner_id == owner_id)
+        .where(DailyOfficeActivity.local_date >= first_day)
+        .where(DailyOfficeActivity.local_date <= last_day)
+        .order_by(Office.name, Office.id, DailyOfficeActivity.local_date, User.name.nulls_first(), User.id)
+        .execution_options(yield_per=batch_size))
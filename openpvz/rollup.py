@@ -0,0 +1,77 @@
+"""Rebuilds daily_office_activity from the notifications, for history or after a fix.
+
+    python -m openpvz.rollup [--since YYYY-MM-DD]
+
+Days are local to each office. Events written while it runs may be missed, so it is best
+run for past days only.
+"""
+import argparse
+import asyncio
+from datetime import date
+from logging import getLogger
+from sqlalchemy import text
+from openpvz import db
+
+
+_logger = getLogger(__name__)
+
+
+# the migration that creates the table runs the same query for all days
+_BACKFILL = text("""
+INSERT INTO daily_office_activity (
+    office_id, user_id, local_date, first_opened_at, last_closed_at, opened_count, closed_count,
+    minutes_late, not_opened_late, not_closed_late
+)
+SELECT
+    e.office_id,
+    e.source_user_id,
+    e.local_date,
+    min(e.created_at) FILTER (WHERE e.code = 'office_opened'),
+    max(e.created_at) FILTER (WHERE e.code = 'office_closed'),
+    count(*) FILTER (WHERE e.code = 'office_opened'),
+    count(*) FILTER (WHERE e.code = 'office_closed'),
+    GREATEST(0, floor(extract(epoch FROM
+        min(e.local_time) FILTER (WHERE e.code = 'office_opened') - (e.local_date + wh.opening_time)
+    ) / 60))::integer,
+    bool_or(e.code = 'office_not_opened_late'),
+    bool_or(e.code = 'office_not_closed_late')
+FROM (
+    SELECT n.*, n.created_at AT TIME ZONE 'UTC' AT TIME ZONE o.timezone AS local_time,
+        (n.created_at AT TIME ZONE 'UTC' AT TIME ZONE o.timezone)::date AS local_date
+    FROM notifications n
+    JOIN offices o ON o.id = n.office_id
+    -- no time zone is more than a day away from UTC, this only prunes partitions
+    WHERE n.created_at >= CAST(:since AS date) - 1
+) e
+LEFT JOIN working_hours wh ON wh.office_id = e.office_id AND wh.day_of_week = extract(isodow FROM e.local_date)
+WHERE e.local_date >= :since
+GROUP BY e.office_id, e.source_user_id, e.local_date, wh.opening_time
+ON CONFLICT ON CONSTRAINT daily_office_activity_office_user_date DO UPDATE SET
+    first_opened_at = EXCLUDED.first_opened_at,
+    last_closed_at = EXCLUDED.last_closed_at,
+    opened_count = EXCLUDED.opened_count,
+    closed_count = EXCLUDED.closed_count,
+    minutes_late = EXCLUDED.minutes_late,
+    not_opened_late = EXCLUDED.not_opened_late,
+    not_closed_late = EXCLUDED.not_closed_late
+""")
+
+
+async def backfill(since: date = date(1, 1, 1)) -> int:
+    """Recomputes the rows of the local days from `since` on. Returns how many were written."""
+    async with db.get_engine().begin() as connection:
+        # the cached watches reports of every office are out of date
+        await connection.execute(text("UPDATE offices SET activity_version = activity_version + 1"))
+        # days without notifications anymore
+        await connection.execute(
+            text("DELETE FROM daily_office_activity WHERE local_date >= :since"), {"since": since})
+        result = await connection.execute(_BACKFILL, {"since": since})
+    _logger.info(f"Backfilled {result.rowcount} daily office activity rows since {since}")
+    return result.rowcount
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--since', type=date.fromisoformat, default=date(1, 1, 1), help="first local day to rebuild")
+    args = parser.parse_args()
+    print(f"{asyncio.run(backfill(args.since))} rows written")
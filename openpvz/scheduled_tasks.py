@@ -1,69 +1,268 @@
-from openpvz.context import BotContext
+from openpvz.context import BotContext, compact_user_data
 from openpvz import db
 from openpvz import repository
-from openpvz.utils import first
-from openpvz.time_utils import tz_now, tz_today
-from openpvz.models import Office, User, Notification
+from openpvz import cache_stats
+from openpvz.time_utils import utc_now
+from openpvz.models import Office
 from openpvz.consts import NotificationCodes
+from openpvz.deadlines import DeadlineHeap, OfficeSchedule, REPORT_WITHIN
+from openpvz.shards import ShardLocks
+from openpvz.office_cache import CachedOffice, office_cache
+from openpvz.partitions import maintain_notification_partitions
+from openpvz.auth import INVITE_TTL
 import openpvz.strings as s
-from datetime import timedelta, datetime
+from openpvz.sender import outbound
+from datetime import date, datetime, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
-import telegram
+from telegram.ext import Application, ConversationHandler, Job, JobQueue
+from logging import getLogger
+from typing import Dict, List, MutableMapping, Tuple
+import itertools
+import json
+import time
+
+
+_logger = getLogger(__name__)
+
+
+# how often a replica rebalances its lateness shards, taking over the ones of replicas that died
+CLAIM_SHARDS_INTERVAL = timedelta(seconds=30)
+
+
+class LatenessScheduler:
+    """Keeps the next opening or closing deadline of every office in a heap and wakes up
+    only when the earliest one is due, so a wake-up costs as much as the offices due then.
+
+    With several replicas running, each one checks only the offices of the shards it holds.
+    """
+
+    def __init__(self) -> None:
+        self._deadlines = DeadlineHeap()
+        self._schedules: Dict[int, OfficeSchedule] = {}
+        self._shards = ShardLocks()
+        self._job_queue: JobQueue | None = None
+        self._job: Job | None = None
+
+    async def start(self, application: Application) -> None:
+        self._job_queue = application.job_queue
+        await self._shards.claim()
+        self._job_queue.run_repeating(claim_lateness_shards, CLAIM_SHARDS_INTERVAL, name="claim_lateness_shards")
+        async with db.begin() as session:
+            schedules = [office.schedule for office in await office_cache.load_all(session)]
+        office_cache.subscribe(self._office_changed_elsewhere)
+        # deadlines passed during a restart are still reported if they are recent enough
+        after = utc_now() - REPORT_WITHIN
+        for schedule in schedules:
+            self._schedule(schedule, after)
+        _logger.info(f"Lateness scheduler started, {len(self._deadlines)} offices scheduled")
+        self._arm()
+
+    def office_changed(self, office: Office) -> None:
+        """Reschedules an office that was created or whose working hours changed.
+        The office has to have an id and its working hours loaded."""
+        self._schedule(OfficeSchedule.from_office(office), utc_now())
+        self._arm()
+
+    def office_removed(self, office_id: int) -> None:
+        self._schedules.pop(office_id, None)
+        self._deadlines.remove(office_id)
+        self._arm()
+
+    async def _office_changed_elsewhere(self, office_id: int, office: CachedOffice | None) -> None:
+        if office is None:
+            self.office_removed(office_id)
+            return
+        self._schedule(office.schedule, utc_now())
+        self._arm()
+
+    async def claim_shards(self) -> None:
+        claimed = await self._shards.claim()
+        if len(claimed) == 0:
+            return
+        # the previous owner might have died right before a deadline
+        after = utc_now() - REPORT_WITHIN
+        for schedule in list(self._schedules.values()):
+            if schedule.office_id % self._shards.shards in claimed:
+                self._schedule(schedule, after)
+        self._arm()
+
+    async def stop(self, application: Application) -> None:
+        await self._shards.release()
+
+    async def run_due(self, context: BotContext) -> None:
+        self._job = None
+        now = utc_now()
+        due = self._deadlines.pop_due(now)
+        try:
+            fresh = [
+                (office_id, code, local_day) for office_id, at, code, local_day in due
+                if now - at <= REPORT_WITHIN and self._shards.owns(office_id)
+            ]
+            if len(fresh) > 0:
+                await self._check(fresh, context)
+        finally:
+            for office_id, at, _, _ in due:
+                schedule = self._schedules.get(office_id)
+                if schedule is not None:
+                    self._schedule(schedule, at)
+            self._arm()
+
+    async def _check(self, due: List[Tuple[int, NotificationCodes, date]], context: BotContext) -> None:
+        """Notifies the owners of the offices late for their deadlines. A notification is
+        filed under the working day of its deadline, not the day it's sent on."""
+        office_ids = [office_id for office_id, _, _ in due]
+        async with db.begin() as session:
+            offices = {office.id: office for office in await repository.get_offices_with_owners(office_ids, session)}
+            notified = await repository.get_notified_on(
+                [(office_id, local_day) for office_id, _, local_day in due],
+                [NotificationCodes.office_not_opened_late, NotificationCodes.office_not_closed_late],
+                session
+            )
+            for office_id, code, local_day in due:
+                office = offices.get(office_id)
+                if office is None:
+                    self._schedules.pop(office_id, None)
+                    continue
+                if (office_id, local_day, code) in notified:
+                    continue
+
+                if code == NotificationCodes.office_not_opened_late and not office.is_open:
+                    await _notify_not_opened_late(office, local_day, context, session)
+
+                if code == NotificationCodes.office_not_closed_late and office.is_open:
+                    await _notify_not_closed_late(office, local_day, context, session)
+
+    def _schedule(self, schedule: OfficeSchedule, after: datetime) -> None:
+        self._schedules[schedule.office_id] = schedule
+        deadline = schedule.next_deadline(after)
+        if deadline is None:
+            self._deadlines.remove(schedule.office_id)
+            return
+        self._deadlines.push(schedule.office_id, *deadline)
+
+    def _arm(self) -> None:
+        if self._job_queue is None:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        next_time = self._deadlines.next_time()
+        if next_time is None:
+            return
+        # a past run date would count as a misfire and be skipped
+        delay = max((next_time - utc_now()).total_seconds(), 0)
+        self._job = self._job_queue.run_once(check_for_being_late, delay, name="check_for_being_late")
+
+
+lateness_scheduler = LatenessScheduler()
 
 
 async def check_for_being_late(context: BotContext):
+    await lateness_scheduler.run_due(context)
+
+
+async def claim_lateness_shards(context: BotContext):
+    await lateness_scheduler.claim_shards()
+
+
+async def _notify_not_opened_late(office: Office, local_day: date, context: BotContext, session: AsyncSession):
+    if not await repository.add_lateness_notification(
+            office, NotificationCodes.office_not_opened_late, local_day, session):
+        return
+    outbound.send_message(context.bot, office.owner.chat_id, text=f"{office.name}: {s.OFFICE_NOT_OPEN_INTIME}")
+
+
+async def _notify_not_closed_late(office: Office, local_day: date, context: BotContext, session: AsyncSession):
+    if not await repository.add_lateness_notification(
+            office, NotificationCodes.office_not_closed_late, local_day, session):
+        return
+    outbound.send_message(context.bot, office.owner.chat_id, text=f"{office.name}: {s.OFFICE_NOT_CLOSED_INTIME}")
+
+
+async def report_pool_stats(context: BotContext):
+    db.report_pool_stats()
+
+
+async def maintain_partitions(context: BotContext):
+    await maintain_notification_partitions()
+
+
+async def delete_expired_invites(context: BotContext):
+    """Pending users whose invite links have expired."""
     async with db.begin() as session:
-        offices = await repository.all_offices_with_working_hours(session)
-        for office in offices:
-            today = tz_today(office.timezone)
-            weekday = today.isoweekday()
-            hours_today = first(office.working_hours, lambda w: w.day_of_week == weekday)
-            now = tz_now(office.timezone)
-            tz = now.tzinfo
-
-            late_for_open_time = datetime.combine(today, hours_today.opening_time, tz) + timedelta(minutes=15)
-            late_for_close_time = datetime.combine(today, hours_today.closing_time, tz) + timedelta(minutes=15)
-            operator_late_for_open = now > late_for_open_time and now <= late_for_open_time + timedelta(minutes=15)
-            operator_late_for_close = now > late_for_close_time and now <= late_for_close_time + timedelta(minutes=15)
-
-            if operator_late_for_close and not office.is_open:
-                continue
+        deleted = await repository.delete_pending_users_created_before(
+            utc_now().replace(tzinfo=None) - INVITE_TTL, session)
+    if deleted > 0:
+        _logger.info(f"Deleted {deleted} pending users with expired invites")
 
-            if operator_late_for_open and office.is_open:
-                continue
 
-            if operator_late_for_open:
-                already_notified_not_open = await repository.check_not_open_notification_today(office, session)
-                if not already_notified_not_open:
-                    await _notify_not_opened_late(office, context, session)
-                    continue
+async def report_cache_stats(context: BotContext):
+    cache_stats.report_cache_stats()
 
-            if operator_late_for_close:
-                already_notified_not_closed = await repository.check_not_closed_notification_today(office, session)
-                if not already_notified_not_closed:
-                    await _notify_not_closed_late(office, context, session)
+
+async def compact_persisted_data(context: BotContext):
+    """Drops expired temporary keys from user_data, and the data and conversation states of
+    chats that belong to no user, e.g. deleted operators or abandoned invites.
+    Conversations are dropped from the running handlers as well as from the persistence.
+    """
+    application = context.application
+    now = time.time()
+    reclaimed = 0
+    changed_user_ids = []
+    for user_id, user_data in list(application.user_data.items()):
+        changed, dropped_bytes = compact_user_data(user_data, now)
+        if changed:
+            changed_user_ids.append(user_id)
+        reclaimed += dropped_bytes
+
+    persistence = application.persistence
+    conversations = getattr(persistence, 'conversations', None) or {}
+    chat_ids = {key[0] for states in conversations.values() for key in states}
+    async with db.begin() as session:
+        registered = await repository.get_registered_chat_ids(chat_ids, session)
+    unregistered_user_ids = {
+        key[-1] for states in conversations.values() for key, state in states.items()
+        if state is not None and key[0] not in registered and key[-1] in application.user_data
+    }
+    # an unregistered chat with data left is still in the middle of signing up. In lazy mode
+    # the data of a user evicted from the cache is empty in memory, so ask the persistence
+    if hasattr(persistence, 'get_user_ids_with_data'):
+        signing_up = await persistence.get_user_ids_with_data(unregistered_user_ids)
+    else:
+        signing_up = {user_id for user_id in unregistered_user_ids if len(application.user_data[user_id]) > 0}
+    live = _live_conversations(application)
+    dropped_conversations = 0
+    dropped_user_ids = set()
+    for name, states in conversations.items():
+        for key, state in list(states.items()):
+            chat_id, user_id = key[0], key[-1]
+            if state is None or chat_id in registered or user_id not in unregistered_user_ids - signing_up:
+                continue
+            live_states = live.get(name, {})
+            if key in live_states:
+                if live_states[key] != state:
+                    # the user has moved on since, e.g. is being handled right now
                     continue
+                del live_states[key]
+            reclaimed += len(json.dumps(key)) + len(json.dumps(state))
+            await persistence.update_conversation(name, key, None)
+            dropped_conversations += 1
+            dropped_user_ids.add(user_id)
+    for user_id in dropped_user_ids:
+        application.drop_user_data(user_id)
+
+    application.mark_data_for_update_persistence(user_ids=set(changed_user_ids) - dropped_user_ids)
+    _logger.info(
+        f"Compacted user_data of {len(changed_user_ids)} users, dropped {dropped_conversations} "
+        f"abandoned conversations, reclaimed {reclaimed} bytes"
+    )
 
 
-async def _notify_not_opened_late(office: Office, context: BotContext, session: AsyncSession):
-    owner: User = await office.awaitable_attrs.owner
-    session.add(Notification(
-        code=NotificationCodes.office_not_opened_late,
-        office_id=office.id
-    ))
-    try:
-        await context.bot.send_message(chat_id=owner.chat_id, text=f"{office.name}: {s.OFFICE_NOT_OPEN_INTIME}")
-    except telegram.error.Forbidden:
-        pass
-
-
-async def _notify_not_closed_late(office: Office, context: BotContext, session: AsyncSession):
-    owner: User = await office.awaitable_attrs.owner
-    session.add(Notification(
-        code=NotificationCodes.office_not_closed_late,
-        office_id=office.id
-    ))
-    try:
-        await context.bot.send_message(chat_id=owner.chat_id, text=f"{office.name}: {s.OFFICE_NOT_CLOSED_INTIME}")
-    except telegram.error.Forbidden:
-        pass
+def _live_conversations(application: Application) -> Dict[str, MutableMapping[tuple, object]]:
+    """States of the running persistent ConversationHandlers by handler name. PTB has no
+    public way to end a conversation from outside of it, so this reaches into the handlers."""
+    return {
+        handler.name: handler._conversations
+        for handler in itertools.chain.from_iterable(application.handlers.values())
+        if isinstance(handler, ConversationHandler) and handler.persistent and handler.name
+    }
@@ -1,6 +1,176 @@
-from telegram import Update
-from telegram.ext import CallbackContext
+import asyncio
+import io
+import time
+from collections import deque
+from logging import getLogger
+from typing import Any, Deque, Dict, Tuple
+from telegram import Bot, Update, error
+from telegram.ext import Application, CallbackContext
 
 
-async def reply(update: Update, context: CallbackContext, *args, **kwargs):
-    await context.bot.send_message(chat_id=update.effective_chat.id, *args, **kwargs)
+_logger = getLogger(__name__)
+
+
+# Telegram's limits: about 30 messages per second overall and 20 per minute in a group
+MESSAGES_PER_SECOND = 30
+GROUP_MESSAGE_INTERVAL = 3.0
+CONCURRENCY = 8
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0  # seconds, doubled after every network error
+
+
+# (bot, name of the Bot method, its arguments besides chat_id, the future of its result if awaited)
+_Outgoing = Tuple[Bot, str, Dict[str, Any], asyncio.Future | None]
+
+
+class OutboundDispatcher:
+    """Sends messages, documents and edits in the background, keeping their order within a chat.
+
+    Every chat with pending requests gets a worker that sends them one by one. Workers share
+    a limit on concurrent requests and a global pace, group chats are paced on their own, and
+    after a RetryAfter every worker waits as long as Telegram asked before trying again.
+    Network errors are retried with a backoff.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = CONCURRENCY,
+        messages_per_second: float = MESSAGES_PER_SECOND,
+        group_message_interval: float = GROUP_MESSAGE_INTERVAL,
+        max_retries: int = MAX_RETRIES,
+        retry_backoff: float = RETRY_BACKOFF,
+    ) -> None:
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._interval = 1 / messages_per_second
+        self._group_interval = group_message_interval
+        self._queues: Dict[int, Deque[_Outgoing]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._next_slot = 0.0
+        self._next_group_slots: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self._stopped = False
+
+    def send(self, bot: Bot, chat_id: int, method: str, **kwargs) -> asyncio.Future:
+        """Calls `bot.<method>(chat_id=chat_id, **kwargs)` after the chat's earlier requests.
+        The future gets its result, or its error once retries are used up."""
+        if chat_id is None:
+            raise ValueError(f"No chat to {method} to")
+        if self._stopped:
+            raise RuntimeError(f"Shutting down, not going to {method} to chat {chat_id}")
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(chat_id, (bot, method, kwargs, future))
+        return future
+
+    def send_message(self, bot: Bot, chat_id: int | None, **kwargs) -> None:
+        """Sends a message without waiting for it, failures are logged."""
+        self._post(bot, chat_id, 'send_message', kwargs)
+
+    def send_document(self, bot: Bot, chat_id: int | None, **kwargs) -> None:
+        """Sends a document without waiting for it, failures are logged."""
+        self._post(bot, chat_id, 'send_document', kwargs)
+
+    async def stop(self, application: Application | None = None, timeout: float = 30) -> None:
+        """Stops accepting requests and waits for the ones still queued to be sent."""
+        self._stopped = True
+        workers = list(self._workers.values())
+        if len(workers) == 0:
+            return
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        if len(pending) > 0:
+            _logger.warning(f"{len(pending)} chats still had unsent messages on shutdown")
+
+    def _post(self, bot: Bot, chat_id: int | None, method: str, kwargs: Dict[str, Any]) -> None:
+        if chat_id is None:
+            # e.g. an owner who has never started the bot
+            _logger.warning(f"No chat to {method} to, skipping")
+            return
+        if self._stopped:
+            _logger.warning(f"Shutting down, dropping {method} to chat {chat_id}")
+            return
+        self._enqueue(chat_id, (bot, method, kwargs, None))
+
+    def _enqueue(self, chat_id: int, outgoing: _Outgoing) -> None:
+        self._queues.setdefault(chat_id, deque()).append(outgoing)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    async def _drain(self, chat_id: int) -> None:
+        queue = self._queues[chat_id]
+        try:
+            while len(queue) > 0:
+                bot, method, kwargs, future = queue[0]
+                try:
+                    result = await self._send(bot, chat_id, method, kwargs)
+                except Exception as e:
+                    if future is None:
+                        _log_failure(chat_id, method, e)
+                    elif not future.done():
+                        future.set_exception(e)
+                else:
+                    if future is not None and not future.done():
+                        future.set_result(result)
+                queue.popleft()
+        finally:
+            del self._workers[chat_id]
+            if len(queue) == 0:
+                del self._queues[chat_id]
+
+    async def _send(self, bot: Bot, chat_id: int, method: str, kwargs: Dict[str, Any]) -> Any:
+        # a retried upload is read from where it started again
+        files = {name: value.tell() for name, value in kwargs.items() if isinstance(value, io.IOBase)}
+        backoff = self.retry_backoff
+        for attempt in range(self.max_retries + 1):
+            for name, position in files.items():
+                kwargs[name].seek(position)
+            if chat_id < 0:
+                await self._wait_for_group_slot(chat_id)
+            async with self._semaphore:
+                await self._wait_for_slot()
+                try:
+                    return await getattr(bot, method)(chat_id=chat_id, **kwargs)
+                except error.RetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    _logger.warning(f"Flood control exceeded, waiting {e.retry_after}s")
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                    continue
+                except error.BadRequest:
+                    # a NetworkError too, but sending it again won't help
+                    raise
+                except error.NetworkError as e:
+                    if attempt == self.max_retries:
+                        raise
+                    _logger.warning(f"Failed to {method} to chat {chat_id}, retrying in {backoff}s: {e}")
+            await asyncio.sleep(backoff)
+            backoff *= 2
+
+    async def _wait_for_slot(self) -> None:
+        now = time.monotonic()
+        at = max(now, self._paused_until, self._next_slot)
+        self._next_slot = at + self._interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def _wait_for_group_slot(self, chat_id: int) -> None:
+        # a group chat has a single worker, so nothing else reserves its slots meanwhile
+        now = time.monotonic()
+        at = max(now, self._next_group_slots.get(chat_id, 0.0))
+        self._next_group_slots[chat_id] = at + self._group_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+outbound = OutboundDispatcher()
+
+
+def _log_failure(chat_id: int, method: str, e: Exception) -> None:
+    if isinstance(e, error.Forbidden):
+        _logger.warning(f"User blocked the bot, chat_id: {chat_id}")
+    else:
+        _logger.error(f"Failed to {method}, chat_id: {chat_id}", exc_info=e)
+
+
+async def reply(update: Update, context: CallbackContext, **kwargs):
+    outbound.send_message(context.bot, update.effective_chat.id, **kwargs)
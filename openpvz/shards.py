@@ -0,0 +1,106 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from logging import getLogger
+from typing import Set
+from openpvz import db
+import math
+import os
+
+
+_logger = getLogger(__name__)
+
+
+LATENESS_SHARDS = int(os.getenv('LATENESS_SHARDS', 16))
+# first key of the two-key advisory locks, keeps them apart from any other advisory locks
+_LOCK_NAMESPACE = 0x6f70767a
+# second key of the lock every replica holds shared for as long as it runs, shards are 0..shards-1
+_MEMBERSHIP_KEY = 0x7fffffff
+
+
+class ShardLocks:
+    """Splits offices into shards by `office_id % shards` and claims them with session-level
+    advisory locks held on a dedicated connection.
+
+    Every replica also holds a shared membership lock on that connection, so the replicas
+    alive are the holders of that lock. Each claim takes free shards up to a fair share of
+    `ceil(shards / replicas)` and gives back the shards over it, so replicas that join get
+    their share and the shards of a dead one, whose locks went away with its connection,
+    are taken over by the others.
+    """
+
+    def __init__(self, shards: int = LATENESS_SHARDS) -> None:
+        self.shards = shards
+        self.owned: Set[int] = set()
+        self._connection: AsyncConnection | None = None
+
+    def owns(self, office_id: int) -> bool:
+        return office_id % self.shards in self.owned
+
+    async def claim(self) -> Set[int]:
+        """Rebalances to a fair share of the shards. Returns the shards taken by this call."""
+        try:
+            await self._ensure_connection()
+            fair_share = math.ceil(self.shards / await self._count_replicas())
+            given_back = set(sorted(self.owned)[fair_share:])
+            for shard in given_back:
+                await self._connection.execute(
+                    text("SELECT pg_advisory_unlock(:namespace, :shard)"),
+                    {"namespace": _LOCK_NAMESPACE, "shard": shard}
+                )
+                self.owned.discard(shard)
+            claimed = set()
+            for shard in range(self.shards):
+                if len(self.owned) + len(claimed) >= fair_share:
+                    break
+                if shard in self.owned or shard in given_back:
+                    continue
+                result = await self._connection.execute(
+                    text("SELECT pg_try_advisory_lock(:namespace, :shard)"),
+                    {"namespace": _LOCK_NAMESPACE, "shard": shard}
+                )
+                if result.scalar():
+                    claimed.add(shard)
+        except Exception:
+            _logger.exception("Failed to claim lateness shards, releasing all of them")
+            await self.release()
+            return set()
+        if len(given_back) > 0:
+            _logger.info(f"Gave back lateness shards {sorted(given_back)} to the other replicas")
+        if len(claimed) > 0:
+            self.owned |= claimed
+            _logger.info(f"Claimed lateness shards {sorted(claimed)}, owning {len(self.owned)}/{self.shards}")
+        return claimed
+
+    async def release(self) -> None:
+        self.owned = set()
+        if self._connection is not None:
+            try:
+                # the locks belong to the database session, which must not go back to the pool
+                await self._connection.invalidate()
+                await self._connection.close()
+            except Exception:
+                _logger.exception("Failed to close the shard locks connection")
+            self._connection = None
+
+    async def _count_replicas(self) -> int:
+        result = await self._connection.execute(
+            text("""
+                SELECT count(*) FROM pg_locks
+                WHERE locktype = 'advisory' AND classid = :namespace AND objid = :key AND objsubid = 2
+                    AND granted
+            """),
+            {"namespace": _LOCK_NAMESPACE, "key": _MEMBERSHIP_KEY}
+        )
+        return max(result.scalar(), 1)
+
+    async def _ensure_connection(self) -> None:
+        if self._connection is not None:
+            # the locks are gone together with a broken connection
+            await self._connection.execute(text("SELECT 1"))
+            return
+        connection = await db.get_engine().connect()
+        self._connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await self._connection.execute(
+            text("SELECT pg_advisory_lock_shared(:namespace, :key)"),
+            {"namespace": _LOCK_NAMESPACE, "key": _MEMBERSHIP_KEY}
+        )
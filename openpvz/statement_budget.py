@@ -0,0 +1,57 @@
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import getLogger
+from typing import Iterator, List
+from sqlalchemy import event
+from openpvz import db
+from openpvz.exceptions import StatementBudgetExceeded
+
+
+_logger = getLogger(__name__)
+
+
+# debug mode: SQL statements one Telegram update may run, 0 turns counting off
+SQL_STATEMENT_BUDGET = int(os.getenv('SQL_STATEMENT_BUDGET', 0))
+# raise instead of logging a warning when an update goes over the budget, as the tests do
+SQL_STATEMENT_BUDGET_STRICT = os.getenv('SQL_STATEMENT_BUDGET_STRICT', 'false').lower() in ('1', 'true', 'yes')
+
+_statements: ContextVar[List[str] | None] = ContextVar('statements', default=None)
+
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany) -> None:
+    statements = _statements.get()
+    if statements is not None:
+        statements.append(statement)
+
+
+def _count_statements() -> None:
+    # only added once counting is on, not to slow down every statement otherwise
+    engine = db.get_engine().sync_engine
+    if not event.contains(engine, "before_cursor_execute", _record_statement):
+        event.listen(engine, "before_cursor_execute", _record_statement)
+
+
+@contextmanager
+def statement_budget(name: str, budget: int | None = None, strict: bool | None = None) -> Iterator[List[str]]:
+    """Counts the statements run inside the block, in this task and the ones it starts.
+    Yields the list they are recorded into, which stays empty while counting is off.
+    The budget and strictness default to SQL_STATEMENT_BUDGET and SQL_STATEMENT_BUDGET_STRICT,
+    a block inside another one is counted towards the outer one."""
+    budget = SQL_STATEMENT_BUDGET if budget is None else budget
+    strict = SQL_STATEMENT_BUDGET_STRICT if strict is None else strict
+    statements: List[str] = []
+    if budget <= 0 or _statements.get() is not None:
+        yield statements
+        return
+    _count_statements()
+    token = _statements.set(statements)
+    try:
+        yield statements
+    finally:
+        _statements.reset(token)
+    if len(statements) > budget:
+        message = f"{name} ran {len(statements)} SQL statements, the budget is {budget}:\n" + "\n".join(statements)
+        if strict:
+            raise StatementBudgetExceeded(message)
+        _logger.warning(message)
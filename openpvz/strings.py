@@ -1,4 +1,5 @@
 ASK_FOR_NAME = 'Введите ваше имя и фамилию.'
+NAME_TAKEN = 'Это имя уже занято.'
 OPEN_OFFICE = 'Открыть филиал'
 CLOSE_OFFICE = 'Закрыть филиал'
 ADD_OFFICE = 'Добавить филиал'
@@ -25,6 +26,7 @@ ENTER_OFFICE_NAME = 'Введите название пункта.'
 ENTER_WORKING_HOURS = "Введите часы работы в формате 'ЧЧ:ММ-ЧЧ:ММ'"
 CLOSING_LESS_THAN_OPENING = "Время открытия не может быть больше времени закрытия."
 OFFICE_CREATED = 'Пункт создан.'
+TIMEZONE_NOT_FOUND = 'Не удалось определить часовой пояс пункта. Попробуйте отправить название ещё раз.'
 SEND_THIS_LINK = 'Пошлите эту ссылку вашему новому работнику:'
 CHOOSE_OPERATOR = 'Выберите оператора.'
 NO_SUCH_OPERATOR = 'Такого оператора не существует!'
@@ -42,3 +44,23 @@ NO_OFFICES = 'У вас нет зарегистрированных пункто
 OFFICE_NOT_OPEN_INTIME = "пункт всё ещё не открыт через 15 минут после начала работы!"
 OFFICE_NOT_CLOSED_INTIME = "пункт всё ещё не закрыт через 15 минут после окончания работы!"
 WATCHES_REPORT = "Отчёт по сменам"
+GEOFENCE_RADIUS = "Радиус геозоны"
+CURRENT_GEOFENCE_RADIUS = "Сейчас пункт можно открыть или закрыть на расстоянии до, м:"
+ENTER_GEOFENCE_RADIUS = "Введите новый радиус в метрах, от 10 до 1000."
+GEOFENCE_RADIUS_CHANGED = "Радиус геозоны изменён."
+EXPORT_REPORTS = "Выгрузка по всем пунктам"
+ENTER_EXPORT_PERIOD = "Введите период в формате 'ДД.ММ.ГГГГ-ДД.ММ.ГГГГ'"
+FIRST_DAY_AFTER_LAST = "Начало периода не может быть позже конца."
+CHOOSE_EXPORT_FORMAT = "Выберите формат файла."
+EXPORT_CSV = "CSV"
+EXPORT_CSV_GZ = "CSV.GZ"
+REPORT_STARTED = "Отчёт готовится, пришлю его сюда."
+REPORT_IN_PROGRESS = "Отчёт уже готовится."
+REPORT_FAILED = "Не удалось подготовить отчёт, попробуйте ещё раз."
+EXPORT_PROGRESS = "Выгружено строк:"
+BULK_INVITE = "Пакет ссылок"
+UPLOAD_ROSTER = "Список операторов"
+ENTER_LINKS_COUNT = "Сколько ссылок для операторов создать? Введите число от 1 до 500."
+SEND_ROSTER = "Пришлите файл CSV с именами операторов в первом столбце, до 500 строк."
+NO_NEW_NAMES_IN_ROSTER = "В списке нет новых имён."
+ROSTER_SKIPPED = "Пропущено имён (уже заняты или длиннее 50 символов):"
@@ -1,26 +1,46 @@
-from datetime import datetime, date
+from datetime import datetime, date, time
+from functools import lru_cache
 import pytz
 
 
 DEFAULT_TIMEZONE = pytz.timezone("Europe/Moscow")
 
 
-def tz_now(timezone: pytz.BaseTzInfo | str | None = None) -> datetime:
+Timezone = pytz.BaseTzInfo | str
+
+
+@lru_cache(maxsize=None)
+def timezone_by_name(name: str) -> pytz.BaseTzInfo:
+    return pytz.timezone(name)
+
+
+def _resolve(timezone: Timezone | None) -> pytz.BaseTzInfo:
     if timezone is None:
-        timezone = DEFAULT_TIMEZONE
+        return DEFAULT_TIMEZONE
     if isinstance(timezone, str):
-        timezone = pytz.timezone(timezone)
-    now = pytz.utc.fromutc(datetime.utcnow())
-    return now.astimezone(timezone)
+        return timezone_by_name(timezone)
+    return timezone
 
 
-def tz_today(timezone: pytz.BaseTzInfo | str | None = None) -> date:
-    if timezone is None:
-        timezone = DEFAULT_TIMEZONE
+def utc_now() -> datetime:
+    return pytz.utc.fromutc(datetime.utcnow())
+
+
+def tz_now(timezone: Timezone | None = None) -> datetime:
+    return utc_now().astimezone(_resolve(timezone))
+
+
+def tz_today(timezone: Timezone | None = None) -> date:
     return tz_now(timezone).date()
 
 
 def date_to_tz_datetime(date: date, timezone=None) -> datetime:
-    if timezone is None:
-        timezone = DEFAULT_TIMEZONE
+    timezone = _resolve(timezone)
     return timezone.localize(datetime(year=date.year, month=date.month, day=date.day), is_dst=False)
+
+
+@lru_cache(maxsize=4096)
+def local_to_utc(timezone: pytz.BaseTzInfo, day: date, at: time) -> datetime:
+    """Wall clock time of a day in a timezone as UTC. Offices share timezones and working
+    hours, so the same few values are asked for over and over."""
+    return timezone.localize(datetime.combine(day, at), is_dst=False).astimezone(pytz.utc)
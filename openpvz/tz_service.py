@@ -1,3 +1,5 @@
+import asyncio
+import os
 import requests
 import logging
 
@@ -5,13 +7,50 @@ import logging
 _logger = logging.getLogger(__name__)
 
 
-def get_timezone(longitude: float, latitude: float) -> str | None:
+# seconds to wait for the timezone API, which is only used without timezonefinder
+TIMEZONE_API_TIMEOUT = float(os.getenv('TIMEZONE_API_TIMEOUT', 5))
+
+try:
+    # timezone boundaries bundled with the package, looked up in memory
+    from timezonefinder import TimezoneFinder
+except ImportError:
+    TimezoneFinder = None
+
+_finder = None
+
+
+async def get_timezone(longitude: float, latitude: float) -> str | None:
+    """Name of the timezone at the point. Looked up offline if timezonefinder is installed,
+    otherwise asked from an HTTP API in a worker thread."""
+    if TimezoneFinder is not None:
+        if _finder is None:
+            # loading the boundaries takes a few hundred milliseconds, once
+            await asyncio.to_thread(_get_finder)
+        return lookup_timezone(longitude, latitude)
+    return await asyncio.to_thread(fetch_timezone, longitude, latitude)
+
+
+def lookup_timezone(longitude: float, latitude: float) -> str | None:
+    return _get_finder().timezone_at(lng=longitude, lat=latitude)
+
+
+def fetch_timezone(longitude: float, latitude: float) -> str | None:
     try:
-        response = requests.get(f"http://timezonefinder.michelfe.it/api/0_{longitude}_{latitude}")
-    except requests.exceptions.RequestException:
-        _logger.exception("Request get_last_videos_created threw exception")
+        response = requests.get(
+            f"http://timezonefinder.michelfe.it/api/0_{longitude}_{latitude}",
+            timeout=TIMEZONE_API_TIMEOUT
+        )
+        result = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        _logger.exception("Failed to get the timezone from the API")
         return None
-    result = response.json()
     if result['status_code'] != 200:
         return None
     return result['tz_name']
+
+
+def _get_finder():
+    global _finder
+    if _finder is None:
+        _finder = TimezoneFinder()
+    return _finder
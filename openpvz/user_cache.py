@@ -0,0 +1,151 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Dict, List, Set, Tuple
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from openpvz.cache_stats import CacheStats
+from openpvz.models import User, UserRole
+
+
+_logger = getLogger(__name__)
+
+
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))  # seconds
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+# publish changes with NOTIFY, the office cache listener hands the ones of other replicas over
+USER_CACHE_NOTIFY = os.getenv('USER_CACHE_NOTIFY', 'true').lower() in ('1', 'true', 'yes')
+USER_CHANGES_CHANNEL = 'user_changes'
+
+# chat ids changed in a session, dropped from the cache once more after its commit
+_CHANGED_CHAT_IDS = "openpvz_changed_chat_ids"
+# NOTIFY payloads of the users changed in a session, sent right before its commit
+_CHANGE_MESSAGES = "openpvz_user_change_messages"
+
+
+@dataclass(frozen=True)
+class CachedUser:
+    id: int
+    chat_id: int
+    name: str
+    role: UserRole
+    owner_id: int | None
+
+    @classmethod
+    def from_user(cls, user: User) -> 'CachedUser':
+        return cls(id=user.id, chat_id=user.chat_id, name=user.name, role=user.role, owner_id=user.owner_id)
+
+    def attach(self, session: AsyncSession) -> User:
+        """A persistent User in `session` built without a query. Relationships are loaded
+        lazily as usual, and changes are flushed as for a loaded user."""
+        user = User(id=self.id, chat_id=self.chat_id, name=self.name, role=self.role, owner_id=self.owner_id)
+        make_transient_to_detached(user)
+        session.add(user)
+        return user
+
+
+class UserCache:
+    """chat_id -> user cache with a time to live, unknown chats included.
+
+    Whatever changes a user's identity, role or owner calls `user_changed` or `user_deleted`.
+    The entry is dropped right away and once more after the commit, so a reader that
+    loaded the user before the commit can't keep the old state cached. With USER_CACHE_NOTIFY
+    the session also sends a NOTIFY delivered on commit, and every replica drops the entry
+    in `on_notify`.
+    """
+
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_size: int = USER_CACHE_SIZE) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = CacheStats("User cache", lambda: len(self._entries), "chats")
+        self._entries: OrderedDict[int, Tuple[float, CachedUser | None]] = OrderedDict()
+
+    def get(self, chat_id: int) -> Tuple[bool, CachedUser | None]:
+        """Returns whether the chat is cached and its user, None for a chat without one."""
+        entry = self._entries.get(chat_id)
+        if entry is None or entry[0] <= time.monotonic():
+            self.stats.misses += 1
+            return False, None
+        self.stats.hits += 1
+        self._entries.move_to_end(chat_id)
+        return True, entry[1]
+
+    def put(self, chat_id: int, user: User | None) -> None:
+        cached = CachedUser.from_user(user) if user is not None else None
+        self._entries[chat_id] = (time.monotonic() + self.ttl, cached)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int) -> None:
+        self._entries.pop(chat_id, None)
+
+    def user_changed(self, user: User) -> None:
+        self._forget({user.chat_id}, user, {"chat_id": user.chat_id})
+
+    def user_deleted(self, user: User) -> None:
+        self._forget(
+            self._with_employees(user.chat_id, user.id), user, {"chat_id": user.chat_id, "deleted_id": user.id})
+
+    def on_notify(self, payload: str) -> None:
+        """Drops the user changed by any replica, this one included."""
+        message = json.loads(payload)
+        chat_ids = {message["chat_id"]}
+        if message.get("deleted_id") is not None:
+            chat_ids = self._with_employees(message["chat_id"], message["deleted_id"])
+        for chat_id in chat_ids:
+            self.invalidate(chat_id)
+
+    def clear(self) -> None:
+        self._entries = OrderedDict()
+
+    def _with_employees(self, chat_id: int, user_id: int) -> Set[int]:
+        # employees are deleted along with their owner
+        chat_ids = {chat_id}
+        owner_ids = {user_id}
+        while len(owner_ids) > 0:
+            employees = [
+                cached for _, cached in self._entries.values()
+                if cached is not None and cached.owner_id in owner_ids and cached.chat_id not in chat_ids
+            ]
+            chat_ids |= {cached.chat_id for cached in employees}
+            owner_ids = {cached.id for cached in employees}
+        return chat_ids
+
+    def _forget(self, chat_ids: Set[int], user: User, message: Dict[str, int]) -> None:
+        for chat_id in chat_ids:
+            self.invalidate(chat_id)
+        session = object_session(user)
+        if session is not None:
+            session.info.setdefault(_CHANGED_CHAT_IDS, set()).update(chat_ids)
+            if USER_CACHE_NOTIFY:
+                session.info.setdefault(_CHANGE_MESSAGES, []).append(json.dumps(message))
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(Session, "before_commit")
+def _publish_changes(session: Session) -> None:
+    messages: List[str] = session.info.pop(_CHANGE_MESSAGES, [])
+    for payload in messages:
+        session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": USER_CHANGES_CHANNEL, "payload": payload}
+        )
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_committed_changes(session: Session) -> None:
+    for chat_id in session.info.pop(_CHANGED_CHAT_IDS, ()):
+        user_cache.invalidate(chat_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_changes(session: Session) -> None:
+    session.info.pop(_CHANGED_CHAT_IDS, None)
+    session.info.pop(_CHANGE_MESSAGES, None)
@@ -0,0 +1,14 @@
+import os
+
+
+# the modules read their settings on import, these let them load outside of a deployment.
+# Tests that need PostgreSQL skip themselves unless DB_* point at a database with the migrations
+for name, value in {
+    'TELEGRAM_TOKEN': '123456:test',
+    'TELEGRAM_BOT_NAME': 'openpvz_test_bot',
+    'AUTH_SECRET_KEY': 'test',
+    'DB_NAME': 'openpvz_test',
+    'DB_USER': 'openpvz',
+    'DB_PASSWORD': 'openpvz',
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,21 @@
+import unittest
+from sqlalchemy import text
+from openpvz import db
+
+
+class DatabaseTestCase(unittest.IsolatedAsyncioTestCase):
+    """Runs against the database the DB_* variables point at, with the migrations applied,
+    and skips itself if there is none."""
+
+    async def asyncSetUp(self):
+        try:
+            async with db.get_engine().connect() as connection:
+                # the first connection also runs the dialect's own queries, keep them out of the tests
+                await connection.execute(text("SELECT 1 FROM pending_users LIMIT 1"))
+        except Exception as e:
+            await db.get_engine().dispose()
+            self.skipTest(f"No migrated database: {e}")
+
+    async def asyncTearDown(self):
+        # pooled connections belong to the event loop of this test
+        await db.get_engine().dispose()
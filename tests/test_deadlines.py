@@ -0,0 +1,40 @@
+import unittest
+from datetime import date, datetime, time
+import pytz
+from openpvz.consts import NotificationCodes
+from openpvz.deadlines import DeadlineHeap, OfficeSchedule
+from openpvz.models import WorkingHours
+
+
+def _schedule(opening: time, closing: time) -> OfficeSchedule:
+    return OfficeSchedule(1, "Europe/Moscow", [
+        WorkingHours(day_of_week=day, opening_time=opening, closing_time=closing) for day in range(1, 8)
+    ])
+
+
+class NextDeadlineTest(unittest.TestCase):
+    def test_opening_and_closing(self):
+        schedule = _schedule(time(9, 0), time(21, 0))
+        # 10:00 in Moscow
+        self.assertEqual(
+            schedule.next_deadline(datetime(2026, 10, 19, 7, 0, tzinfo=pytz.utc)),
+            (datetime(2026, 10, 19, 18, 15, tzinfo=pytz.utc), NotificationCodes.office_not_closed_late,
+             date(2026, 10, 19)))
+
+    def test_late_closing_belongs_to_the_day_it_closes(self):
+        schedule = _schedule(time(9, 0), time(23, 50))
+        # 23:55 in Moscow, the closing deadline is at 00:05 of the next day
+        at, code, local_day = schedule.next_deadline(datetime(2026, 10, 19, 20, 55, tzinfo=pytz.utc))
+        self.assertEqual(at.astimezone(schedule.timezone).date(), date(2026, 10, 20))
+        self.assertEqual((code, local_day), (NotificationCodes.office_not_closed_late, date(2026, 10, 19)))
+
+
+class DeadlineHeapTest(unittest.TestCase):
+    def test_pops_the_due_deadlines_with_their_day(self):
+        heap = DeadlineHeap()
+        at = datetime(2026, 10, 19, 21, 5, tzinfo=pytz.utc)
+        heap.push(1, at, NotificationCodes.office_not_closed_late, date(2026, 10, 19))
+        heap.push(2, at.replace(hour=22), NotificationCodes.office_not_closed_late, date(2026, 10, 19))
+        heap.push(2, at.replace(hour=23), NotificationCodes.office_not_closed_late, date(2026, 10, 20))
+        self.assertEqual(heap.pop_due(at), [(1, at, NotificationCodes.office_not_closed_late, date(2026, 10, 19))])
+        self.assertEqual(heap.next_time(), at.replace(hour=23))
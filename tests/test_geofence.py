@@ -0,0 +1,100 @@
+import math
+import random
+import unittest
+from dataclasses import dataclass
+from sqlalchemy import func, literal, select
+from sqlalchemy.dialects import postgresql
+from openpvz import db
+from openpvz import repository
+from openpvz.geofence import EARTH_RADIUS, GeofenceGrid, distance
+from openpvz.office_cache import CachedOffice
+from openpvz.models import Office
+from openpvz.utils import Location
+from tests.database import DatabaseTestCase
+
+
+@dataclass
+class _Place:
+    id: int
+    location: Location
+    geofence_radius: int
+
+
+def _moved(location: Location, meters: float, bearing: float) -> Location:
+    """The point `meters` away from `location` towards `bearing` degrees, on the sphere."""
+    angle = meters / EARTH_RADIUS
+    bearing = math.radians(bearing)
+    lat, lon = math.radians(location.latitude), math.radians(location.longitude)
+    moved_lat = math.asin(math.sin(lat) * math.cos(angle) + math.cos(lat) * math.sin(angle) * math.cos(bearing))
+    moved_lon = lon + math.atan2(
+        math.sin(bearing) * math.sin(angle) * math.cos(lat), math.cos(angle) - math.sin(lat) * math.sin(moved_lat))
+    return Location(latitude=math.degrees(moved_lat), longitude=math.degrees(moved_lon))
+
+
+class GeofenceTest(unittest.TestCase):
+    def test_distance(self):
+        moscow = Location(latitude=55.7539, longitude=37.6208)
+        petersburg = Location(latitude=59.9398, longitude=30.3146)
+        self.assertAlmostEqual(distance(moscow, petersburg) / 1000, 634, delta=2)
+        self.assertAlmostEqual(distance(moscow, _moved(moscow, 100, 45)), 100, places=6)
+
+    def test_grid_finds_the_nearest_fence(self):
+        random.seed(1)
+        places = [
+            _Place(i, Location(latitude=55.75 + random.uniform(-0.05, 0.05),
+                               longitude=37.62 + random.uniform(-0.05, 0.05)), random.randint(10, 1000))
+            for i in range(300)
+        ]
+        grid = GeofenceGrid(places)
+        for _ in range(1000):
+            point = Location(
+                latitude=55.75 + random.uniform(-0.06, 0.06), longitude=37.62 + random.uniform(-0.06, 0.06))
+            inside = [
+                (distance(point, p.location), p.id) for p in places if distance(point, p.location) <= p.geofence_radius]
+            found = grid.nearest(point)
+            self.assertEqual(found.id if found is not None else None, min(inside)[1] if inside else None)
+
+    def test_grid_wraps_around_the_antimeridian(self):
+        random.seed(3)
+        places = [
+            _Place(i, Location(latitude=random.uniform(-70, 70),
+                               longitude=random.choice([-1, 1]) * random.uniform(179.98, 180)),
+                   random.randint(10, 1000))
+            for i in range(300)
+        ]
+        grid = GeofenceGrid(places)
+        for place in places:
+            point = _moved(place.location, place.geofence_radius * 0.9, random.choice([90, 270]))
+            self.assertIsNotNone(grid.nearest(point))
+        fiji = _Place(1, Location(latitude=-17.0, longitude=179.9995), 200)
+        self.assertIs(GeofenceGrid([fiji]).nearest(Location(latitude=-17.0, longitude=-179.9995)), fiji)
+
+    def test_point_takes_longitude_first(self):
+        point = repository.location_point(Location(latitude=55.75, longitude=37.62))
+        params = point.compile(dialect=postgresql.dialect()).params
+        self.assertEqual([params[name] for name in sorted(params)][:2], [37.62, 55.75])
+
+    def test_cached_office_reads_longitude_and_latitude(self):
+        office = Office(
+            id=1, owner_id=2, name="office", timezone="Europe/Moscow", geofence_radius=100, working_hours=[])
+        cached = CachedOffice.from_row(office, 37.62, 55.75)
+        self.assertEqual(cached.location, Location(latitude=55.75, longitude=37.62))
+
+
+class PostgisAgreementTest(DatabaseTestCase):
+    """The PostGIS fallback and the in-memory geofences accept the same check-ins."""
+
+    async def test_both_agree_near_the_radius(self):
+        random.seed(2)
+        office = Location(latitude=55.75, longitude=37.62)
+        async with db.get_engine().connect() as connection:
+            for _ in range(200):
+                radius = random.randint(10, 1000)
+                point = _moved(office, radius + random.uniform(-0.5, 0.5), random.uniform(0, 360))
+                a, b = repository.location_point(office), repository.location_point(point)
+                result = await connection.execute(
+                    select(func.ST_DWithin(a, b, literal(radius), False), func.ST_Distance(a, b, False)))
+                within, meters = result.one()
+                self.assertAlmostEqual(meters, distance(office, point), places=3)
+                grid = GeofenceGrid([_Place(1, office, radius)])
+                self.assertEqual(within, grid.nearest(point) is not None)
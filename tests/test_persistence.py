@@ -0,0 +1,55 @@
+import unittest
+from typing import Any, Dict
+from unittest import mock
+from openpvz.persistence import PostgresPersistence
+
+
+class _Rows:
+    """An engine whose connections answer the lazy per-user SELECT from a dict."""
+
+    def __init__(self, rows: Dict[int, Dict[str, Any]]) -> None:
+        self.rows = rows
+
+    def connect(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, statement, params):
+        return mock.Mock(scalar_one_or_none=mock.Mock(return_value=self.rows.get(params["key"])))
+
+
+class LazyUserDataTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.persistence = PostgresPersistence(
+            engine=_Rows({1: {"role": "operator"}, 2: {"page": "1"}}),
+            on_flush=True, lazy=True, cache_size=1, update_interval=0)
+        self.persistence._user_data, self.persistence._chat_data = {}, {}
+        self.persistence._loaded = True
+
+    async def test_loads_on_first_access(self):
+        data = {}
+        await self.persistence.refresh_user_data(1, data)
+        self.assertEqual(data, {"role": "operator"})
+
+    async def test_writes_after_eviction_keep_the_persisted_data(self):
+        first, second = {}, {}
+        await self.persistence.refresh_user_data(1, first)
+        await self.persistence.refresh_user_data(2, second)
+        self.assertEqual(first, {})
+        # a job still holding the evicted dict
+        first["office"] = 7
+        await self.persistence.update_user_data(1, first)
+        self.assertEqual(first, {"role": "operator", "office": 7})
+        self.assertEqual(self.persistence._user_data[1], {"role": "operator", "office": 7})
+
+    async def test_reloads_an_evicted_user(self):
+        first, second = {}, {}
+        await self.persistence.refresh_user_data(1, first)
+        await self.persistence.refresh_user_data(2, second)
+        await self.persistence.refresh_user_data(1, first)
+        self.assertEqual(first, {"role": "operator"})
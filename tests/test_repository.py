@@ -0,0 +1,94 @@
+from datetime import date, datetime
+from uuid import uuid4
+from sqlalchemy import delete
+from openpvz import db
+from openpvz import repository
+from openpvz.consts import NotificationCodes
+from openpvz.models import DailyOfficeActivity, Office, User, UserRole
+from openpvz.reports import create_report
+from openpvz.utils import Location
+from tests.database import DatabaseTestCase
+
+
+FIRST_DAY = date(2026, 10, 1)
+LAST_DAY = date(2026, 10, 3)
+
+
+def _activity(office: Office, user: User | None, day: date, **activity) -> DailyOfficeActivity:
+    return DailyOfficeActivity(
+        office_id=office.id, user_id=user.id if user is not None else None, local_date=day, **activity)
+
+
+class ReportQueriesTest(DatabaseTestCase):
+    """The reports read the daily activity of an owner's offices."""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        suffix = uuid4().hex[:6]
+        async with db.begin() as session:
+            owner = User(chat_id=-int(suffix, 16) - 1, name=f"owner {suffix}", role=UserRole.OWNER)
+            session.add(owner)
+            await session.flush()
+            anna = User(chat_id=owner.chat_id - 1, name=f"anna {suffix}", role=UserRole.OPERATOR, owner_id=owner.id)
+            boris = User(chat_id=owner.chat_id - 2, name=f"boris {suffix}", role=UserRole.OPERATOR, owner_id=owner.id)
+            office = Office(
+                name=f"office {suffix}",
+                location=repository.location_point(Location(latitude=55.75, longitude=37.62)),
+                owner_id=owner.id,
+                timezone="Europe/Moscow",
+            )
+            session.add_all([anna, boris, office])
+            await session.flush()
+            session.add_all([
+                _activity(office, anna, date(2026, 10, 1), opened_count=2,
+                          first_opened_at=datetime(2026, 10, 1, 6, 5), minutes_late=5),
+                _activity(office, anna, date(2026, 10, 2), opened_count=1),
+                _activity(office, boris, date(2026, 10, 2), opened_count=1),
+                # only closed the office
+                _activity(office, boris, date(2026, 10, 3), closed_count=1),
+                # before the period
+                _activity(office, boris, date(2026, 9, 30), opened_count=1),
+                _activity(office, None, date(2026, 10, 2), not_opened_late=True),
+            ])
+            self.owner_id, self.office_id, self.suffix = owner.id, office.id, suffix
+
+    async def asyncTearDown(self):
+        async with db.begin() as session:
+            await session.execute(delete(DailyOfficeActivity).where(DailyOfficeActivity.office_id == self.office_id))
+            # everything else goes along with the owner
+            await session.execute(delete(User).where(User.id == self.owner_id))
+        await super().asyncTearDown()
+
+    async def test_watches_report(self):
+        async with db.begin() as session:
+            office = await repository.get_office(self.office_id, session)
+            rows = [tuple(row) async for row in await repository.stream_watches(office, FIRST_DAY, LAST_DAY, session)]
+        self.assertEqual(create_report(FIRST_DAY, LAST_DAY, rows).decode('utf-8'), (
+            "Дата,10.01,10.02,10.03\n"
+            f"anna {self.suffix},2,1,\n"
+            f"boris {self.suffix},,1,\n"
+        ))
+
+    async def test_owner_activity(self):
+        async with db.begin() as session:
+            rows = [tuple(row) async for row in await repository.stream_owner_activity(
+                self.owner_id, FIRST_DAY, LAST_DAY, session)]
+        self.assertEqual([(row[1], row[2], row[5], row[6]) for row in rows], [
+            (f"anna {self.suffix}", date(2026, 10, 1), 2, 0),
+            (None, date(2026, 10, 2), 0, 0),
+            (f"anna {self.suffix}", date(2026, 10, 2), 1, 0),
+            (f"boris {self.suffix}", date(2026, 10, 2), 1, 0),
+            (f"boris {self.suffix}", date(2026, 10, 3), 0, 1),
+        ])
+        # times are local to the office
+        self.assertEqual(rows[0][3], datetime(2026, 10, 1, 9, 5))
+        self.assertEqual(rows[0][7], 5)
+        self.assertTrue(rows[1][8])
+
+    async def test_notified_on(self):
+        async with db.begin() as session:
+            notified = await repository.get_notified_on(
+                [(self.office_id, date(2026, 10, 2)), (self.office_id, date(2026, 10, 3))],
+                [NotificationCodes.office_not_opened_late, NotificationCodes.office_not_closed_late],
+                session)
+        self.assertEqual(notified, {(self.office_id, date(2026, 10, 2), NotificationCodes.office_not_opened_late)})
@@ -0,0 +1,77 @@
+import asyncio
+import io
+import unittest
+from unittest import mock
+from telegram import error
+from openpvz.sender import OutboundDispatcher
+
+
+def _dispatcher() -> OutboundDispatcher:
+    return OutboundDispatcher(messages_per_second=1000, group_message_interval=0, retry_backoff=0)
+
+
+class OutboundDispatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def test_keeps_the_order_within_a_chat(self):
+        bot = mock.AsyncMock()
+        sent = []
+        bot.send_message.side_effect = lambda **kwargs: sent.append(kwargs["text"])
+        bot.send_document.side_effect = lambda **kwargs: sent.append(kwargs["filename"])
+        dispatcher = _dispatcher()
+        dispatcher.send_message(bot, 1, text="started")
+        document = dispatcher.send(bot, 1, 'send_document', document=b"", filename="report.csv")
+        dispatcher.send_message(bot, 1, text="menu")
+        await document
+        await dispatcher.stop()
+        self.assertEqual(sent, ["started", "report.csv", "menu"])
+
+    async def test_retries_network_errors(self):
+        bot = mock.AsyncMock()
+        file = io.BytesIO(b"rows")
+        uploaded = []
+
+        async def send_document(chat_id, document, **kwargs):
+            uploaded.append(document.read())
+            if len(uploaded) < 3:
+                raise error.TimedOut()
+            return "message"
+        bot.send_document.side_effect = send_document
+        with self.assertLogs('openpvz.sender', 'WARNING'):
+            result = await _dispatcher().send(bot, 1, 'send_document', document=file)
+        self.assertEqual(result, "message")
+        self.assertEqual(uploaded, [b"rows"] * 3)
+
+    async def test_gives_up_after_the_retries(self):
+        bot = mock.AsyncMock()
+        bot.send_message.side_effect = error.NetworkError("down")
+        dispatcher = _dispatcher()
+        with self.assertLogs('openpvz.sender', 'WARNING'), self.assertRaises(error.NetworkError):
+            await dispatcher.send(bot, 1, 'send_message', text="hi")
+        self.assertEqual(bot.send_message.await_count, dispatcher.max_retries + 1)
+
+    async def test_does_not_retry_bad_requests(self):
+        bot = mock.AsyncMock()
+        bot.send_document.side_effect = error.BadRequest("wrong file id")
+        with self.assertRaises(error.BadRequest):
+            await _dispatcher().send(bot, 1, 'send_document', document="file id")
+        bot.send_document.assert_awaited_once()
+
+    async def test_skips_users_without_a_chat(self):
+        bot = mock.AsyncMock()
+        dispatcher = _dispatcher()
+        with self.assertLogs('openpvz.sender', 'WARNING'):
+            dispatcher.send_message(bot, None, text="late")
+        with self.assertRaises(ValueError):
+            dispatcher.send(bot, None, 'send_message', text="late")
+        await asyncio.sleep(0)
+        bot.send_message.assert_not_called()
+
+    async def test_stops_accepting_on_shutdown(self):
+        bot = mock.AsyncMock()
+        dispatcher = _dispatcher()
+        dispatcher.send_message(bot, 1, text="before")
+        await dispatcher.stop()
+        with self.assertLogs('openpvz.sender', 'WARNING'):
+            dispatcher.send_message(bot, 1, text="after")
+        with self.assertRaises(RuntimeError):
+            dispatcher.send(bot, 1, 'send_message', text="after")
+        bot.send_message.assert_awaited_once_with(chat_id=1, text="before")
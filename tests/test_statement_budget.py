@@ -0,0 +1,138 @@
+import asyncio
+import unittest
+from datetime import time
+from types import SimpleNamespace
+from unittest import mock
+from uuid import uuid4
+from sqlalchemy import delete
+from telegram import Location as TelegramLocation
+from telegram.ext import Application, ContextTypes
+from openpvz import db
+from openpvz import handlers
+from openpvz import repository
+from openpvz.consts import TELEGRAM_TOKEN, BotState, OfficeStatus
+from openpvz.context import BotContext
+from openpvz.exceptions import StatementBudgetExceeded
+from openpvz.models import Office, User, UserRole, WorkingHours
+from openpvz.office_cache import office_cache
+from openpvz.reports import report_cache
+from openpvz.sender import outbound
+from openpvz.statement_budget import statement_budget
+from openpvz.user_cache import CachedUser, user_cache
+from openpvz.utils import Location
+from tests.database import DatabaseTestCase
+
+
+# the user, the office, the notification, the office's is_open and activity version, the day's activity
+# and the owner's chat
+CHECK_IN_BUDGET = 6
+# the user, the offices and their working hours
+OFFICE_LIST_BUDGET = 3
+# the user and the office, then the office and its rows again in the background
+WATCHES_REPORT_BUDGET = 4
+
+OFFICE_LOCATION = Location(latitude=55.75, longitude=37.62)
+
+
+class StatementBudgetTest(unittest.TestCase):
+    def test_strict_budget_raises(self):
+        with self.assertRaises(StatementBudgetExceeded):
+            with statement_budget("handler", budget=1, strict=True) as statements:
+                statements.extend(["SELECT 1", "SELECT 2"])
+
+    def test_nested_blocks_count_towards_the_outer_one(self):
+        with statement_budget("update", budget=2, strict=True) as outer:
+            with statement_budget("handler", budget=1, strict=True) as inner:
+                inner.append("SELECT 1")
+            outer.append("SELECT 2")
+        self.assertEqual(outer, ["SELECT 2"])
+
+    def test_off_without_a_budget(self):
+        with statement_budget("handler", budget=0, strict=True) as statements:
+            statements.extend(["SELECT 1", "SELECT 2"])
+
+
+class HandlerBudgetTest(DatabaseTestCase):
+    """Representative updates run within their statement budgets, which fails on N+1 queries."""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        suffix = uuid4().hex[:6]
+        async with db.begin() as session:
+            owner = User(chat_id=-int(suffix, 16) - 1, name=f"owner {suffix}", role=UserRole.OWNER)
+            session.add(owner)
+            await session.flush()
+            operator = User(
+                chat_id=owner.chat_id - 1, name=f"operator {suffix}", role=UserRole.OPERATOR, owner_id=owner.id)
+            office = Office(
+                name=f"office {suffix}",
+                location=repository.location_point(OFFICE_LOCATION),
+                owner_id=owner.id,
+                timezone="Europe/Moscow",
+                working_hours=[
+                    WorkingHours(day_of_week=day, opening_time=time(0, 0), closing_time=time(23, 59))
+                    for day in range(1, 8)
+                ]
+            )
+            session.add_all([operator, office])
+            await session.flush()
+            self.owner, self.operator = CachedUser.from_user(owner), CachedUser.from_user(operator)
+            self.office_id = office.id
+        office_cache.clear()
+        user_cache.clear()
+        report_cache.clear()
+        self.application = Application.builder().token(TELEGRAM_TOKEN)\
+            .context_types(ContextTypes(context=BotContext)).build()
+        patcher = mock.patch.object(outbound, 'send_message')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        async with db.begin() as session:
+            # everything else goes along with the owner
+            await session.execute(delete(User).where(User.id == self.owner.id))
+        await super().asyncTearDown()
+
+    def _update(self, user: CachedUser, **message) -> SimpleNamespace:
+        return SimpleNamespace(
+            effective_chat=SimpleNamespace(id=user.chat_id),
+            message=SimpleNamespace(**{"text": None, "location": None, **message}))
+
+    def _context(self, user: CachedUser) -> BotContext:
+        return BotContext(self.application, chat_id=user.chat_id, user_id=user.chat_id)
+
+    async def test_check_in(self):
+        async with db.begin() as session:
+            # the geofences of the owner are cached after the first check-in
+            await office_cache.get_by_owner(self.owner.id, session)
+        context = self._context(self.operator)
+        context.set_office_status(OfficeStatus.OPENING)
+        location = TelegramLocation(
+            longitude=OFFICE_LOCATION.longitude, latitude=OFFICE_LOCATION.latitude, live_period=60)
+        with statement_budget("check-in", budget=CHECK_IN_BUDGET, strict=True):
+            state = await handlers.handle_current_geo(self._update(self.operator, location=location), context)
+        self.assertEqual(state, BotState.MAIN_MENU)
+        async with db.begin() as session:
+            self.assertTrue((await repository.get_office(self.office_id, session)).is_open)
+
+    async def test_office_list(self):
+        with statement_budget("office list", budget=OFFICE_LIST_BUDGET, strict=True):
+            state = await handlers.offices_settings(self._update(self.owner), self._context(self.owner))
+        self.assertEqual(state, BotState.OWNER_OFFICES)
+
+    async def test_watches_report(self):
+        context = self._context(self.owner)
+        context.set_chosen_id(self.office_id)
+        tasks = []
+
+        def create_task(application, coroutine, update=None):
+            tasks.append(asyncio.create_task(coroutine))
+            return tasks[-1]
+        with mock.patch.object(Application, 'create_task', create_task), \
+                mock.patch('openpvz.reports._send_report') as send_report, \
+                mock.patch('openpvz.reports._report_failed'):
+            with statement_budget("watches report", budget=WATCHES_REPORT_BUDGET, strict=True):
+                state = await handlers.watches_report(self._update(self.owner), context)
+                await asyncio.gather(*tasks)
+        self.assertEqual(state, BotState.MAIN_MENU)
+        send_report.assert_called_once()
@@ -0,0 +1,48 @@
+import unittest
+from unittest import mock
+import requests
+from openpvz import tz_service
+
+
+MOSCOW = (37.62, 55.75)
+
+
+@unittest.skipIf(tz_service.TimezoneFinder is None, "timezonefinder is not installed")
+class LookupTimezoneTest(unittest.IsolatedAsyncioTestCase):
+    def test_lookup(self):
+        self.assertEqual(tz_service.lookup_timezone(*MOSCOW), "Europe/Moscow")
+        self.assertEqual(tz_service.lookup_timezone(-74.0, 40.71), "America/New_York")
+
+    async def test_get_timezone_stays_offline(self):
+        with mock.patch.object(requests, 'get') as get:
+            self.assertEqual(await tz_service.get_timezone(*MOSCOW), "Europe/Moscow")
+        get.assert_not_called()
+
+
+@mock.patch.object(tz_service, 'TimezoneFinder', None)
+class FetchTimezoneTest(unittest.IsolatedAsyncioTestCase):
+    """Without timezonefinder the timezone is asked from the API."""
+
+    def _response(self, body: dict) -> mock.Mock:
+        return mock.Mock(json=mock.Mock(return_value=body))
+
+    async def test_found(self):
+        with mock.patch.object(requests, 'get', return_value=self._response(
+                {"status_code": 200, "tz_name": "Europe/Moscow"})) as get:
+            self.assertEqual(await tz_service.get_timezone(*MOSCOW), "Europe/Moscow")
+        self.assertTrue(get.call_args.args[0].endswith("/0_37.62_55.75"))
+        self.assertEqual(get.call_args.kwargs["timeout"], tz_service.TIMEZONE_API_TIMEOUT)
+
+    async def test_not_found(self):
+        with mock.patch.object(requests, 'get', return_value=self._response({"status_code": 404})):
+            self.assertIsNone(await tz_service.get_timezone(*MOSCOW))
+
+    async def test_api_down(self):
+        with mock.patch.object(requests, 'get', side_effect=requests.exceptions.ConnectTimeout()), \
+                self.assertLogs(tz_service.__name__):
+            self.assertIsNone(await tz_service.get_timezone(*MOSCOW))
+
+    async def test_not_json(self):
+        response = mock.Mock(json=mock.Mock(side_effect=ValueError()))
+        with mock.patch.object(requests, 'get', return_value=response), self.assertLogs(tz_service.__name__):
+            self.assertIsNone(await tz_service.get_timezone(*MOSCOW))